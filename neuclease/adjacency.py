@@ -1,15 +1,22 @@
-from itertools import combinations
+import heapq
+from collections import deque, OrderedDict
+from contextlib import closing
+from itertools import combinations, islice
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 from dvidutils import LabelMapper
 
-from neuclease.dvid.labelmap import fetch_labelindex, fetch_labelarray_voxels, decode_labelindex_blocks
-from neuclease.util.graph import connected_components, connected_components_nonconsecutive
+from neuclease.dvid.labelmap import (fetch_labelindex, fetch_labelarray_voxels, fetch_labelmap_specificblocks,
+                                     decode_labelindex_blocks)
+from neuclease.util.graph import connected_components_nonconsecutive
 from neuclease.dvid.labelmap._labelmap import fetch_supervoxels
 
-def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None, search_distance=1, connect_non_adjacent=False):
+def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None, search_distance=1, connect_non_adjacent=False,
+                             *, batch_size=16, lookahead=1, threads=4, halo=False, halo_cache_size=64,
+                             return_block_table=False):
     """
     Given a body and an intra-body merge graph defined by the given
     list of "known" supervoxel-to-supervoxel edges within that body,
@@ -31,16 +38,24 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
         
         - This function does not attempt to find ALL adjacencies between supervoxels;
           it stops looking as soon as they form a single connected component.
+          Also, it only returns the edges that were needed to unify the components,
+          i.e. it never returns two edges between the same pair of components.
+          Blocks are searched in greedy "set cover" order: the next block to search
+          is the one whose supervoxels span the most components that are still
+          unlinked (according to the adjacencies found so far).
 
         - This function only considers two supervoxels "adjacent" if they are
           literally touching each other in the scale-0 segmentation. If there is
           a small gap between them, then they are not considered adjacent.
         
-        - This function does not attempt to find inter-block adjacencies;
+        - Unless halo=True, this function does not attempt to find inter-block adjacencies;
           only adjacencies within each block are detected.
           So, in pathological cases where a supervoxel is only adjacent to the
           rest of the body on a block-aligned edge, the adjacency will not be
           detected by this funciton.
+          With halo=True, adjacencies across the faces between blocks are also
+          detected, but only between blocks that were downloaded anyway.
+          (No blocks are downloaded merely to inspect their faces.)
         
     Args:
         server, uuid, instance:
@@ -70,9 +85,35 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
             body into a single connected component, generate edges for supervoxels
             that are not adjacent, but merely are in the same block (if it helps
             unify the body).
-    
+
+        batch_size:
+            How many blocks to fetch from DVID per request (via /specificblocks).
+
+        lookahead:
+            How many batches of blocks to download in the background while
+            the current batch is being searched. If 0, no downloads happen
+            in the background.
+            Note: Blocks are prioritized (see notes above) when their batch
+            is requested, so a large lookahead may cause some blocks to be
+            downloaded needlessly.
+
+        threads:
+            How many threads to use to inflate each batch of downloaded blocks.
+
+        halo:
+            If True, keep recently downloaded blocks in a small cache, and also search
+            for adjacencies across the faces between each new block and its cached neighbors.
+
+        halo_cache_size:
+            How many blocks to keep in the cache when halo=True.
+
+        return_block_table:
+            If True, construct and return a table of debug information about
+            the adjacencies found in each block (see below).  Otherwise, None is
+            returned in its place, since constructing it is relatively expensive.
+
     Returns:
-        (new_edges, orig_num_cc, final_num_cc, block_tables),
+        (new_edges, orig_num_cc, final_num_cc, block_table),
         Where:
             new_edges are the new edges found via inspection of supervoxel adjacencies,
             
@@ -81,14 +122,13 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
             
             final_num_cc is the number of disjoint components after adding the new_edges,
             
-            block_tables contains debug information about the adjacencies found in each
-                block of analyzed segmentation
+            block_table contains debug information about the adjacencies found in each
+                block of analyzed segmentation (or None, if return_block_table=False).
+                Adjacencies found across block faces (with halo=True) are not listed.
                 
         Ideally, final_num_cc == 1, but in some cases the body's supervoxels may not be
         directly adjacent, or the adjacencies were not detected.  (See notes above.)
     """
-    from skimage.morphology import dilation
-    
     BLOCK_TABLE_COLS = ['z', 'y', 'x', 'sv_a', 'sv_b', 'cc_a', 'cc_b', 'detected', 'applied']
     known_edges = np.asarray(known_edges, np.uint64)
     if svs is None:
@@ -100,7 +140,8 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
     orig_num_cc = final_num_cc = cc.max()+1
     
     if orig_num_cc == 1:
-        return np.zeros((0,2), np.uint64), orig_num_cc, final_num_cc, pd.DataFrame(columns=BLOCK_TABLE_COLS)
+        block_table = pd.DataFrame(columns=BLOCK_TABLE_COLS) if return_block_table else None
+        return np.zeros((0,2), np.uint64), orig_num_cc, final_num_cc, block_table
 
     labelindex = fetch_labelindex(server, uuid, instance, body, format='protobuf')
     encoded_block_coords = np.fromiter(labelindex.blocks.keys(), np.uint64, len(labelindex.blocks))
@@ -110,83 +151,79 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
     svs_set = set(svs)
 
     sv_adj_found = []
-    cc_adj_found = set()
     block_tables = {}
     
     searched_block_svs = {}
-    
-    for coord_zyx, sv_counts in zip(coords_zyx, labelindex.blocks.values()):
-        # Given the supervoxels in this block, what CC adjacencies
-        # MIGHT we find if we were to inspect the segmentation?
-        block_svs = np.fromiter(sv_counts.counts.keys(), np.uint64)
-        block_ccs = cc_mapper.apply(block_svs)
-        possible_cc_adjacencies = set(combinations( set(block_ccs), 2 ))
-        
-        # We only aim to find (at most) a single link between each CC pair.
-        # That is, we don't care about adjacencies between CC that we've already linked so far.
-        possible_cc_adjacencies -= cc_adj_found
-        if not possible_cc_adjacencies:
-            continue
-
-        searched_block_svs[(*coord_zyx,)] = block_svs
-        
-        # Not used in the search; only returned for debug purposes.
-        try:
-            block_adj_table = _init_adj_table(coord_zyx, block_svs, cc_mapper)
-        except:
-            raise
 
-        block_vol = fetch_block_vol(server, uuid, instance, coord_zyx, svs_set)
-        if search_distance > 0:
-            # It would be nice to do a proper spherical dilation,
-            # but apparently dilation() is special-cased to be WAY
-            # faster with a square structuring element, and we prefer
-            # speed over cleaner dilation.
-            # footprint = skimage.morphology.ball(dilation)
-            radius = search_distance//2
-            footprint = np.ones(3*(1+2*radius,), np.uint8)
-            dilated_block_vol = dilation(block_vol, footprint)
-            
-            # Since dilation is a max-filter, we might have accidentally
-            # erased small, low-valued supervoxels, erasing the adjacendies.
-            # Overlay the original volume to make sure they still count.
-            block_vol = np.where(block_vol, block_vol, dilated_block_vol)
-        
-        sv_adjacencies = compute_label_adjacencies(block_vol)
-        sv_adjacencies['cc_a'] = cc_mapper.apply( sv_adjacencies['sv_a'].values )
-        sv_adjacencies['cc_b'] = cc_mapper.apply( sv_adjacencies['sv_b'].values )
-        
-        found_new_adj = False
-        for row in sv_adjacencies.itertuples(index=False):
-            if (row.cc_a != row.cc_b):
-                sv_adj = (row.sv_a, row.sv_b)
-                cc_adj = (row.cc_a, row.cc_b)
-                
-                # Normalize
-                if row.cc_a > row.cc_b:
-                    cc_adj = (row.cc_b, row.cc_a)
-
-                if row.sv_a > row.sv_b:
-                    sv_adj = (row.sv_b, row.sv_a)
-
-                block_adj_table.loc[sv_adj, 'detected'] = True
-                    
-                if cc_adj not in cc_adj_found:
-                    found_new_adj = True
-                    cc_adj_found.add( cc_adj )
-                    sv_adj_found.append( sv_adj )
-                    
-                    block_adj_table.loc[sv_adj, 'applied'] = True
-
-        block_tables[(*coord_zyx,)] = block_adj_table
-
-        # If we made at least one change and we've 
-        # finally unified all components, then we're done.
-        if found_new_adj:
-            final_num_cc = connected_components(np.array(list(cc_adj_found), np.uint64), orig_num_cc).max()+1
+    # The components we've linked so far (via sv_adj_found)
+    cc_union_find = _UnionFind(orig_num_cc)
+
+    prioritized_blocks = _iter_blocks_by_priority(coords_zyx, labelindex, cc_mapper, cc_union_find)
+    fetched_blocks = _iter_fetched_blocks(server, uuid, instance, prioritized_blocks, svs_set,
+                                          batch_size, lookahead, threads)
+
+    def link_components(sv_adjacencies):
+        """
+        Given some normalized sv adjacencies (sv_a < sv_b), record the ones
+        that link components which weren't already linked.
+        Returns the adjacencies between different components,
+        and the indexes of those that were recorded.
+        """
+        cc_adjacencies = cc_mapper.apply(sv_adjacencies.reshape(-1)).reshape(-1, 2)
+
+        keep = (cc_adjacencies[:, 0] != cc_adjacencies[:, 1])
+        sv_adjacencies = sv_adjacencies[keep]
+        cc_adjacencies = np.sort(cc_adjacencies[keep], axis=1)
+
+        # We need (at most) one edge per component pair, so we only
+        # need to consider the first sv adjacency for each cc adjacency.
+        _, first_rows = np.unique(cc_adjacencies, axis=0, return_index=True)
+        applied_rows = []
+        for row in np.sort(first_rows):
+            if cc_union_find.union(*cc_adjacencies[row]):
+                sv_adj_found.append( tuple(sv_adjacencies[row]) )
+                applied_rows.append(row)
+
+        return sv_adjacencies, applied_rows
+
+    # Recently downloaded (undilated) blocks, for halo mode.
+    halo_cache = OrderedDict()
+
+    with closing(fetched_blocks):
+        for coord_zyx, block_svs, block_vol in fetched_blocks:
+            # The block was prioritized before its batch was fetched;
+            # since then, its components may have been linked already.
+            # (But in halo mode, we can still check its faces.)
+            if cc_union_find.num_distinct(cc_mapper.apply(block_svs)) > 1:
+                searched_block_svs[(*coord_zyx,)] = block_svs
+
+                # Note: These pairs are already normalized (sv_a < sv_b)
+                dilated_block_vol = _dilate_labels(block_vol, search_distance)
+                sv_adjacencies = compute_label_adjacencies(dilated_block_vol)[['sv_a', 'sv_b']].values
+                sv_adjacencies, applied_rows = link_components(sv_adjacencies)
+
+                # Not used in the search; only returned for debug purposes.
+                if return_block_table:
+                    block_adj_table = _init_adj_table(coord_zyx, block_svs, cc_mapper)
+                    block_adj_table.loc[[*map(tuple, sv_adjacencies)], 'detected'] = True
+                    block_adj_table.loc[[*map(tuple, sv_adjacencies[applied_rows])], 'applied'] = True
+                    block_tables[(*coord_zyx,)] = block_adj_table
+
+            if halo:
+                for face_vol in _iter_face_volumes(coord_zyx, block_vol, halo_cache, search_distance):
+                    if cc_union_find.num_sets > 1:
+                        dilated_face_vol = _dilate_labels(face_vol, search_distance)
+                        link_components(compute_label_adjacencies(dilated_face_vol)[['sv_a', 'sv_b']].values)
+
+                halo_cache[(*coord_zyx,)] = block_vol
+                if len(halo_cache) > halo_cache_size:
+                    halo_cache.popitem(last=False)
+
+            # If we've finally unified all components, then we're done.
+            final_num_cc = cc_union_find.num_sets
             if final_num_cc == 1:
                 break
-    
+        
     # If we couldn't connect everything via direct adjacencies,
     # we can just add edges for any supervoxels that share a block.
     if final_num_cc > 1 and connect_non_adjacent:
@@ -196,23 +233,21 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
             # We only need one SV per connected component,
             # so load them into a dict.
             selected_svs = dict(zip(block_ccs, block_svs))
-            for (sv_a, sv_b) in combinations(sorted(selected_svs.values()), 2):
-                (cc_a, cc_b) = cc_mapper.apply(np.array([sv_a, sv_b], np.uint64))
-                if cc_a > cc_b:
-                    cc_a, cc_b = cc_b, cc_a
-                
-                if (cc_a, cc_b) not in cc_adj_found:
-                    if sv_a > sv_b:
-                        sv_a, sv_b = sv_b, sv_a
 
-                    cc_adj_found.add( (cc_a, cc_b) )
+            # Link the first SV to all the others (if they aren't linked already).
+            sv_a, *other_svs = sorted(selected_svs.values())
+            for sv_b in other_svs:
+                (cc_a, cc_b) = cc_mapper.apply(np.array([sv_a, sv_b], np.uint64))
+                if cc_union_find.union(cc_a, cc_b):
                     sv_adj_found.append( (sv_a, sv_b) )
+                    if return_block_table:
+                        block_tables[(*coord_zyx,)].loc[(sv_a, sv_b), 'applied'] = True
 
-                    block_tables[(*coord_zyx,)].loc[(sv_a, sv_b), 'applied'] = True
-
-        final_num_cc = connected_components(np.array(list(cc_adj_found), np.uint64), orig_num_cc).max()+1
+        final_num_cc = cc_union_find.num_sets
     
-    if len(block_tables) == 0:
+    if not return_block_table:
+        block_table = None
+    elif len(block_tables) == 0:
         block_table = pd.DataFrame(columns=BLOCK_TABLE_COLS)
     else:
         block_table = pd.concat(block_tables.values(), sort=False).reset_index()
@@ -222,6 +257,212 @@ def find_missing_adjacencies(server, uuid, instance, body, known_edges, svs=None
     return new_edges, int(orig_num_cc), int(final_num_cc), block_table
 
 
+
+def _dilate_labels(vol, search_distance):
+    """
+    Dilate the labels in the given volume by search_distance//2,
+    but without overwriting any nonzero voxels.
+    """
+    if search_distance <= 0:
+        return vol
+
+    from skimage.morphology import dilation
+
+    # It would be nice to do a proper spherical dilation,
+    # but apparently dilation() is special-cased to be WAY
+    # faster with a square structuring element, and we prefer
+    # speed over cleaner dilation.
+    # footprint = skimage.morphology.ball(dilation)
+    radius = search_distance//2
+    footprint = np.ones(3*(1+2*radius,), np.uint8)
+    dilated_vol = dilation(vol, footprint)
+
+    # Since dilation is a max-filter, we might have accidentally
+    # erased small, low-valued supervoxels, erasing the adjacendies.
+    # Overlay the original volume to make sure they still count.
+    return np.where(vol, vol, dilated_vol)
+
+
+def _iter_face_volumes(coord_zyx, block_vol, block_cache, search_distance):
+    """
+    For each of the given block's 6 face-adjacent neighbors which
+    can be found in block_cache (a dict of {(z,y,x): block_vol}),
+    yield a thin volume straddling the face between the two blocks.
+
+    _dilate_labels() links labels which are up to 2*(search_distance//2)
+    voxels apart, so the volume extends one voxel more than that into each
+    block, which is enough to find all adjacencies across the face that
+    would be found within a block.
+    """
+    depth = 2*(search_distance//2) + 1
+    coord_zyx = np.asarray(coord_zyx)
+    for axis in range(3):
+        offset = np.zeros(3, int)
+        offset[axis] = 64
+
+        lower_vol = block_cache.get( (*(coord_zyx - offset),) )
+        if lower_vol is not None:
+            lower_slab = lower_vol[(slice(None),)*axis + (np.s_[-depth:],)]
+            upper_slab = block_vol[(slice(None),)*axis + (np.s_[:depth],)]
+            yield np.concatenate((lower_slab, upper_slab), axis=axis)
+
+        upper_vol = block_cache.get( (*(coord_zyx + offset),) )
+        if upper_vol is not None:
+            lower_slab = block_vol[(slice(None),)*axis + (np.s_[-depth:],)]
+            upper_slab = upper_vol[(slice(None),)*axis + (np.s_[:depth],)]
+            yield np.concatenate((lower_slab, upper_slab), axis=axis)
+
+
+def _iter_blocks_by_priority(coords_zyx, labelindex, cc_mapper, cc_union_find):
+    """
+    Yield (coord_zyx, block_svs) for the blocks of the given labelindex,
+    in greedy set-cover order, i.e. the block which could link the most
+    still-unlinked component pairs comes first.
+
+    Blocks whose supervoxels all belong to the same component (or set of
+    already-linked components) can't help, so they are never yielded.
+
+    The caller is expected to update cc_union_find between iterations,
+    as components are linked.  A block's score can only decrease as
+    components are merged, so scores are re-evaluated lazily:
+    a block is yielded only if its updated score is still at least
+    as good as the (possibly stale) score of the next block in line.
+    """
+    # Priority queue of (-score, block_index)
+    block_svs_list = []
+    block_ccs_list = []
+    queue = []
+    for i, sv_counts in enumerate(labelindex.blocks.values()):
+        block_svs = np.fromiter(sv_counts.counts.keys(), np.uint64)
+        block_ccs = np.unique(cc_mapper.apply(block_svs))
+        block_svs_list.append(block_svs)
+        block_ccs_list.append(block_ccs)
+
+        # A block spanning k components can link k*(k-1)/2 pairs of them,
+        # but for ranking purposes, k itself is equivalent.
+        if len(block_ccs) > 1:
+            queue.append((-len(block_ccs), i))
+
+    heapq.heapify(queue)
+    while queue:
+        _, i = heapq.heappop(queue)
+        score = cc_union_find.num_distinct(block_ccs_list[i])
+        if score <= 1:
+            # Everything in this block is already linked.
+            continue
+
+        if queue and score < -queue[0][0]:
+            # Another block might be better; try again later.
+            heapq.heappush(queue, (-score, i))
+            continue
+
+        yield coords_zyx[i], block_svs_list[i]
+
+
+def _iter_fetched_blocks(server, uuid, instance, blocks, svs_set, batch_size=16, lookahead=1, threads=4):
+    """
+    Given an iterable of (coord_zyx, block_svs), fetch the corresponding
+    blocks of supervoxel segmentation from DVID in batches, and
+    yield (coord_zyx, block_svs, block_vol) for each one.
+    The block volumes are filtered to exclude supervoxels outside of svs_set.
+
+    Up to ``lookahead`` batches are downloaded (and inflated) in the background
+    while the caller processes the current batch.  The input iterable is consumed
+    (one batch at a time) only as needed to keep that many batches in flight.
+
+    Note:
+        If the caller stops iterating early, it should close() the generator,
+        which cancels any downloads that haven't started yet.
+    """
+    assert batch_size >= 1
+    assert lookahead >= 0
+    blocks = iter(blocks)
+    pending = deque()
+
+    executor = ThreadPoolExecutor(max(1, lookahead), thread_name_prefix='fetch-blocks')
+    try:
+        while True:
+            # Keep the pipeline full
+            while len(pending) <= lookahead:
+                batch = [*islice(blocks, batch_size)]
+                if not batch:
+                    break
+                corners = np.array([coord_zyx for coord_zyx, _ in batch])
+                future = executor.submit(_fetch_block_batch, server, uuid, instance, corners, svs_set, threads)
+                pending.append((batch, future))
+
+            if not pending:
+                break
+
+            batch, future = pending.popleft()
+            block_vols = future.result()
+            for coord_zyx, block_svs in batch:
+                yield coord_zyx, block_svs, block_vols[(*coord_zyx,)]
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _fetch_block_batch(server, uuid, instance, corners_zyx, svs_set, threads):
+    """
+    Fetch the given blocks of supervoxels in a single request,
+    and filter each one with filter_vol().
+
+    Returns:
+        dict of {(z,y,x): block_vol}.
+        Blocks which DVID omits from its response (i.e. empty blocks) are returned as zeros.
+    """
+    blocks = fetch_labelmap_specificblocks(server, uuid, instance, corners_zyx, supervoxels=True,
+                                           format='blocks', threads=threads)
+    block_vols = {}
+    for corner in corners_zyx:
+        corner = tuple(corner.tolist())
+        block_vol = blocks.get(corner)
+        if block_vol is None:
+            block_vol = np.zeros((64,64,64), np.uint64)
+        else:
+            block_vol = filter_vol(block_vol, svs_set)
+        block_vols[corner] = block_vol
+    return block_vols
+
+
+class _UnionFind:
+    """
+    Minimal union-find over the integers 0..N-1,
+    which keeps track of the number of disjoint sets.
+    """
+    def __init__(self, N):
+        self.parents = list(range(N))
+        self.num_sets = N
+
+    def find(self, x):
+        parents = self.parents
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
+
+    def union(self, a, b):
+        """
+        Merge the sets containing a and b.
+        Returns True if they were previously disjoint.
+        """
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return False
+        self.parents[max(root_a, root_b)] = min(root_a, root_b)
+        self.num_sets -= 1
+        return True
+
+    def num_distinct(self, xs):
+        """
+        Return the number of distinct sets among the given elements.
+        """
+        return len({self.find(x) for x in xs})
+
+
 def fetch_block_vol(server, uuid, instance, coord_zyx, svs_set=None):
     """
     Fetch a block of segmentation starting at the given coordinate.
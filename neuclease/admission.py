@@ -0,0 +1,133 @@
+"""
+Admission control for expensive server requests.
+"""
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised by AdmissionController.submit() if a request can't be accepted right now.
+    """
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Runs requests in a fixed-size pool of worker threads.
+
+    At most ``num_workers`` requests run at once, and at most ``max_queued``
+    more may wait for a worker.  Also, each user may have at most ``max_per_user``
+    requests running or waiting at once.  Requests beyond those limits are
+    rejected immediately (via AdmissionRejected), rather than piling up
+    until every request is slower than the client's timeout.
+    """
+
+    def __init__(self, num_workers, max_queued, max_per_user=0, retry_after=5):
+        """
+        Args:
+            num_workers:
+                Size of the worker pool.
+            max_queued:
+                How many requests may wait for a free worker.
+            max_per_user:
+                How many requests (running or waiting) each user may have.
+                If 0, there is no per-user limit.
+            retry_after:
+                How many seconds rejected clients should wait before trying again.
+        """
+        assert num_workers > 0
+        self.num_workers = num_workers
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.retry_after = retry_after
+
+        self._executor = ThreadPoolExecutor(num_workers, thread_name_prefix='admitted')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._pending_per_user = defaultdict(int)
+
+        self.rejected = 0
+
+
+    def check(self, user):
+        """
+        Raise AdmissionRejected if a request from the given user would be rejected right now.
+
+        This is useful for rejecting requests quickly, before doing any preliminary
+        work for them.  (The request may still be rejected by submit() if other
+        requests are submitted in the meantime.)
+        """
+        with self._lock:
+            self._check(user)
+
+
+    def _check(self, user):
+        if self._pending >= self.num_workers + self.max_queued:
+            self.rejected += 1
+            raise AdmissionRejected(f"Server is busy ({self._pending} requests pending)", self.retry_after)
+
+        if self.max_per_user and self._pending_per_user.get(user, 0) >= self.max_per_user:
+            self.rejected += 1
+            raise AdmissionRejected(f"Too many requests from user {user} "
+                                    f"({self._pending_per_user[user]} pending)", self.retry_after)
+
+
+    def submit(self, user, func, *args, **kwargs):
+        """
+        Run ``func(*args, **kwargs)`` in the worker pool (eventually),
+        or raise AdmissionRejected if the limits have been reached.
+
+        If the returned future is cancelled before it starts running,
+        its place in the queue is released.
+
+        Returns:
+            concurrent.futures.Future
+        """
+        with self._lock:
+            self._check(user)
+            self._pending += 1
+            self._pending_per_user[user] += 1
+
+        def run():
+            with self._lock:
+                self._running += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                self._release(user)
+
+        try:
+            future = self._executor.submit(run)
+        except BaseException:
+            self._release(user)
+            raise
+
+        # If the future is cancelled, run() never gets a chance to release it.
+        future.add_done_callback(lambda f: f.cancelled() and self._release(user))
+        return future
+
+
+    def _release(self, user):
+        with self._lock:
+            self._pending -= 1
+            self._pending_per_user[user] -= 1
+            if self._pending_per_user[user] == 0:
+                del self._pending_per_user[user]
+
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._running,
+                'queued': self._pending - self._running,
+                'rejected': self.rejected,
+                'users': dict(self._pending_per_user)
+            }
@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import vigra.graphs as vg
 import networkx as nx
+from numba import jit
 
 from dvidutils import LabelMapper
 
@@ -21,6 +22,8 @@ def get_cleave_method(method_string):
     """
     if method_string == 'seeded-mst':
         return seeded_mst, False
+    if method_string == 'seeded-mst-networkx':
+        return seeded_mst_networkx, False
     if method_string == 'seeded-watershed':
         return edge_weighted_watershed, False # note: requires package: "nifty"
     if method_string == 'agglomerative-clustering':
@@ -55,7 +58,7 @@ def cleave(edges, edge_weights, seeds_dict, node_ids, node_sizes=None, method='s
             in the results as disconnected components.
         
         method:
-            One of: 'seeded-mst', 'seeded-watershed', 'agglomerative-clustering', 'echo-seeds'
+            One of: 'seeded-mst', 'seeded-mst-networkx', 'seeded-watershed', 'agglomerative-clustering', 'echo-seeds'
 
     Returns:
     
@@ -78,50 +81,365 @@ def cleave(edges, edge_weights, seeds_dict, node_ids, node_sizes=None, method='s
                 and thus not labeled during agglomeration. False otherwise.
         
     """
+    graph = prepare_cleave_graph(edges, edge_weights, node_ids)
+    return cleave_prepared(graph, seeds_dict, node_sizes, method)
+
+
+CleaveGraph = namedtuple("CleaveGraph", "node_ids node_table cleaned_edges edge_weights mst_order")
+def prepare_cleave_graph(edges, edge_weights, node_ids):
+    """
+    Prepare a graph for cleave_prepared(), which can then be cleaved
+    repeatedly (e.g. with different seeds) without repeating this work.
+
+    The edges are cleaned (normalized form, no duplicates, no loops)
+    and relabeled with consecutive node IDs, and the order in which
+    seeded_mst() visits them is precomputed.
+
+    Args:
+        edges, edge_weights, node_ids:
+            See cleave()
+
+    Returns:
+        CleaveGraph, namedtuple with fields:
+        (node_ids, node_table, cleaned_edges, edge_weights, mst_order)
+        where node_table is a hash table for looking up each node's
+        position in node_ids (see _lookup_nodes()).
+    """
     assert isinstance(node_ids, np.ndarray)
     assert node_ids.dtype in (np.uint32, np.uint64)
     assert node_ids.ndim == 1
+
+    node_table, cons_edges, edge_weights = _relabel_and_clean_edges(edges, edge_weights, node_ids)
+    mst_order = _seeded_mst_order(cons_edges, edge_weights)
+    return CleaveGraph(node_ids, node_table, cons_edges, edge_weights, mst_order)
+
+
+def _relabel_and_clean_edges(edges, edge_weights, node_ids):
+    """
+    Relabel the given edges with consecutive node IDs (i.e. their positions in node_ids),
+    and clean them (normalized form, no duplicates, no loops).
+    Of any duplicated edges, the last one (and its weight) is kept.
+    The kept edges remain in their original relative order.
+
+    This is equivalent to (but much faster than) sorting the edges,
+    calling DataFrame.drop_duplicates(keep='last'), dropping the loops,
+    and then applying a LabelMapper.
+
+    Returns:
+        (node_table, cons_edges, edge_weights)
+    """
+    node_table = _build_node_table(node_ids.astype(np.uint64, copy=False))
+
+    edges = np.asarray(edges).reshape(-1, 2)
+    edge_weights = np.asarray(edge_weights)
+    if len(edges) == 0:
+        return node_table, np.zeros((0,2), np.uint32), np.zeros(0, np.float32)
+
+    assert len(edges) == len(edge_weights)
+    cons_edges, keep, bad_edge = _clean_edges(edges.astype(np.uint64, copy=False), *node_table, len(node_ids))
+    if bad_edge != -1:
+        raise KeyError(f"Edge {edges[bad_edge].tolist()} refers to a node that is not in node_ids")
+
+    # Note: The input edges are not modified, since they may be cached by the caller.
+    keep = keep.nonzero()[0]
+    return node_table, cons_edges[keep], edge_weights[keep]
+
+
+@jit(nopython=True, nogil=True)
+def _clean_edges(edges, table_keys, table_values, N):
+    """
+    Helper for _relabel_and_clean_edges().
+
+    Relabel the given edges with consecutive node IDs (i.e. their positions in node_ids),
+    oriented according to their original IDs (u < v), and determine which edges to keep:
+    self-loops are dropped, and of any duplicated edges, only the last is kept.
+
+    Returns:
+        (cons_edges, keep, bad_edge), where bad_edge is the index
+        of an edge with an unknown node (or -1 if there is none).
+    """
+    E = len(edges)
+    cons_edges = np.empty((E, 2), np.uint32)
+    keep = np.zeros(E, np.bool_)
+    for i in range(E):
+        u = edges[i, 0]
+        v = edges[i, 1]
+        if u > v:
+            u, v = v, u
+
+        a = _lookup_node(table_keys, table_values, u)
+        b = _lookup_node(table_keys, table_values, v)
+        if a == -1 or b == -1:
+            return cons_edges, keep, i
+
+        cons_edges[i, 0] = a
+        cons_edges[i, 1] = b
+
+    # Group the edges by their first node (a counting sort, preserving the edge order),
+    # and within each group, mark the last occurrence of each second node.
+    group_starts = np.zeros(N+1, np.int64)
+    for i in range(E):
+        group_starts[cons_edges[i, 0] + 1] += 1
+    for a in range(N):
+        group_starts[a+1] += group_starts[a]
+
+    grouped = np.empty(E, np.int64)
+    group_ends = group_starts[:-1].copy()
+    for i in range(E):
+        a = cons_edges[i, 0]
+        grouped[group_ends[a]] = i
+        group_ends[a] += 1
+
+    last_occurrence = np.empty(N, np.int64)
+    for a in range(N):
+        for j in range(group_starts[a], group_starts[a+1]):
+            i = grouped[j]
+            last_occurrence[cons_edges[i, 1]] = i
+        for j in range(group_starts[a], group_starts[a+1]):
+            i = grouped[j]
+            b = cons_edges[i, 1]
+            keep[i] = (last_occurrence[b] == i) and (b != a)
+
+    return cons_edges, keep, -1
+
+
+# Multiplier for Fibonacci hashing
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+@jit(nopython=True, nogil=True)
+def _hash_slot(node_id, mask):
+    return ((node_id * _HASH_MULTIPLIER) >> np.uint64(32)) & mask
+
+
+@jit(nopython=True, nogil=True)
+def _build_node_table(node_ids):
+    """
+    Build an open-addressing hash table from each node ID to its position in node_ids.
+    (For large graphs, that's much faster to query than a sorted array.)
+
+    Returns:
+        (table_keys, table_values), where empty slots have value -1.
+    """
+    bits = 1
+    while (1 << bits) < 2 * len(node_ids):
+        bits += 1
+
+    table_keys = np.zeros(1 << bits, np.uint64)
+    table_values = np.full(1 << bits, -1, np.int64)
+    mask = np.uint64((1 << bits) - 1)
+
+    for i in range(len(node_ids)):
+        slot = _hash_slot(node_ids[i], mask)
+        while table_values[slot] != -1 and table_keys[slot] != node_ids[i]:
+            slot = (slot + np.uint64(1)) & mask
+        table_keys[slot] = node_ids[i]
+        table_values[slot] = i
+    return table_keys, table_values
+
+
+@jit(nopython=True, nogil=True)
+def _lookup_node(table_keys, table_values, node_id):
+    """
+    Return the position of the given node in the table built by
+    _build_node_table(), or -1 if it isn't present.
+    """
+    mask = np.uint64(len(table_keys) - 1)
+    slot = _hash_slot(node_id, mask)
+    while table_values[slot] != -1 and table_keys[slot] != node_id:
+        slot = (slot + np.uint64(1)) & mask
+    return table_values[slot]
+
+
+@jit(nopython=True, nogil=True)
+def _lookup_nodes(table_keys, table_values, node_ids):
+    """
+    Vectorized form of _lookup_node().
+    """
+    positions = np.empty(len(node_ids), np.int64)
+    for i in range(len(node_ids)):
+        positions[i] = _lookup_node(table_keys, table_values, node_ids[i])
+    return positions
+
+
+def cleave_prepared(graph, seeds_dict, node_sizes=None, method='seeded-mst'):
+    """
+    Cleave a graph which was prepared via prepare_cleave_graph().
+
+    Args:
+        graph:
+            CleaveGraph
+
+        seeds_dict, node_sizes, method:
+            See cleave()
+
+    Returns:
+        CleaveResults (see cleave())
+    """
+    node_ids = graph.node_ids
     assert node_sizes is None or node_sizes.shape == node_ids.shape
 
     cleave_func, requires_sizes = get_cleave_method(method)
     assert not requires_sizes or node_sizes is not None, \
         f"The specified cleave method ({method}) requires node sizes but none were provided."
-    
-    # Relabel node ids consecutively
-    cons_node_ids = np.arange(len(node_ids), dtype=np.uint32)
-    mapper = LabelMapper(node_ids, cons_node_ids)
 
     # Initialize sparse seed label array
-    seed_labels = np.zeros_like(cons_node_ids)
+    seed_labels = np.zeros(len(node_ids), np.uint32)
     for seed_class, seed_nodes in seeds_dict.items():
         seed_nodes = np.asarray(seed_nodes, dtype=np.uint64)
-        mapper.apply_inplace(seed_nodes)
-        seed_labels[seed_nodes] = seed_class
-    
-    if len(edges) == 0:
+        positions = _lookup_nodes(*graph.node_table, seed_nodes)
+        if (positions == -1).any():
+            raise KeyError(f"Seeds for class {seed_class} include nodes that are not in node_ids")
+        seed_labels[positions] = seed_class
+
+    if len(graph.cleaned_edges) == 0:
         # No edges: Return empty results (just seeds)
         return CleaveResults(seed_labels, set(seeds_dict.keys()), not seed_labels.all())
 
-    # Clean the edges (normalized form, no duplicates, no loops)
-    edges.sort(axis=1)
-    edges_df = pd.DataFrame({'u': edges[:,0], 'v': edges[:,1], 'weight': edge_weights})
-    edges_df.drop_duplicates(['u', 'v'], keep='last', inplace=True)
-    edges_df = edges_df.query('u != v')
-    edges = edges_df[['u', 'v']].values
-    edge_weights = edges_df['weight'].values
-
-    # Relabel edges for consecutive nodes
-    cons_edges = mapper.apply(edges)
-    assert cons_edges.dtype == np.uint32
-
-    cleave_results = cleave_func(cons_edges, edge_weights, seed_labels, node_sizes)
+    if cleave_func is seeded_mst:
+        cleave_results = seeded_mst(graph.cleaned_edges, graph.edge_weights, seed_labels, node_sizes, edge_order=graph.mst_order)
+    else:
+        cleave_results = cleave_func(graph.cleaned_edges, graph.edge_weights, seed_labels, node_sizes)
     assert isinstance(cleave_results, CleaveResults)
     return cleave_results
 
 
-def seeded_mst(cleaned_edges, edge_weights, seed_labels, _node_sizes=None):
+def seeded_mst(cleaned_edges, edge_weights, seed_labels, _node_sizes=None, *, edge_order=None):
+    """
+    Partition a graph using a seeded minimum-spanning forest.
+
+    This is a compiled implementation of Kruskal's algorithm, operating
+    directly on the edge arrays.  Edges are visited in order of increasing
+    weight, and each edge merges the components of its endpoints unless both
+    components already contain a seed.  (That's equivalent to connecting all
+    seeds to a virtual root node, as seeded_mst_networkx() does.)
+    Each resulting component contains at most one seed node.
+
+    Ties are visited in the same order that networkx visits them,
+    so the results are identical to those of seeded_mst_networkx().
+
+    Args:
+        cleaned_edges:
+            array, (E,2), uint32
+            Must not contain duplicate edges.
+
+        edge_weights:
+            array, (E,), float32
+
+        seed_labels:
+            array (N,), uint32
+            All un-seeded nodes should be marked as 0.
+
+        edge_order:
+            Optional. The precomputed result of _seeded_mst_order(),
+            e.g. from prepare_cleave_graph().
+
+    Returns:
+        CleaveResults (see seeded_mst_networkx())
+    """
+    assert len(cleaned_edges) == len(edge_weights)
+    cleaned_edges = np.asarray(cleaned_edges).reshape(-1, 2)
+    if edge_order is None:
+        edge_order = _seeded_mst_order(cleaned_edges, edge_weights)
+
+    output_labels, component_labels = _seeded_kruskal(cleaned_edges, edge_order, seed_labels)
+    contains_unlabeled_components = not output_labels.all()
+
+    # Any label which still has more than one component
+    # (after joining adjacent components with the same label) is disconnected.
+    # (Same result as _find_disconnected_components(), but much faster.)
+    labels, counts = np.unique(component_labels, return_counts=True)
+    disconnected_components = set(labels[counts > 1].tolist())
+    return CleaveResults(output_labels, disconnected_components, contains_unlabeled_components)
+
+
+def _seeded_mst_order(cleaned_edges, edge_weights):
+    """
+    Return the order in which seeded_mst() visits the given edges.
+    """
+    edge_weights = np.asarray(edge_weights)
+    if np.isnan(edge_weights).any():
+        raise ValueError("NaN found in edge weights")
+
+    # networkx sorts edges stably by weight, from its edge iteration order,
+    # which is grouped by the lesser node ID and otherwise follows the input order.
+    return np.lexsort((cleaned_edges.min(axis=1), edge_weights))
+
+
+@jit(nopython=True, nogil=True)
+def _seeded_kruskal(edges, edge_order, seed_labels):
+    """
+    Helper for seeded_mst().
+    Visit the edges in the given order, joining the endpoints' components
+    (via union-find) unless both components are already seeded.
+    Then label each component with its seed label (or 0).
+
+    Returns:
+        (output_labels, component_labels), where component_labels lists the
+        label of each seeded component, after joining any components that
+        share a label and are adjacent via any edge (not just the MST edges).
+    """
+    N = len(seed_labels)
+    parents = np.arange(N)
+    ranks = np.zeros(N, np.uint8)
+    component_labels = seed_labels.copy()
+
+    for e in edge_order:
+        u = _find_root(parents, edges[e, 0])
+        v = _find_root(parents, edges[e, 1])
+        if u == v or (component_labels[u] != 0 and component_labels[v] != 0):
+            continue
+
+        if ranks[u] < ranks[v]:
+            u, v = v, u
+        parents[v] = u
+        if ranks[u] == ranks[v]:
+            ranks[u] += 1
+        if component_labels[u] == 0:
+            component_labels[u] = component_labels[v]
+
+    output_labels = np.empty_like(seed_labels)
+    for i in range(N):
+        output_labels[i] = component_labels[_find_root(parents, i)]
+
+    for e in range(len(edges)):
+        u = _find_root(parents, edges[e, 0])
+        v = _find_root(parents, edges[e, 1])
+        if u != v and component_labels[u] == component_labels[v]:
+            parents[v] = u
+
+    num_seeded_components = 0
+    for i in range(N):
+        if parents[i] == i and component_labels[i] != 0:
+            num_seeded_components += 1
+
+    seeded_component_labels = np.empty(num_seeded_components, seed_labels.dtype)
+    j = 0
+    for i in range(N):
+        if parents[i] == i and component_labels[i] != 0:
+            seeded_component_labels[j] = component_labels[i]
+            j += 1
+
+    return output_labels, seeded_component_labels
+
+
+@jit(nopython=True, nogil=True)
+def _find_root(parents, node):
+    """
+    Union-find 'find', with path halving.
+    """
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+
+def seeded_mst_networkx(cleaned_edges, edge_weights, seed_labels, _node_sizes=None):
     """
     Partition a graph using the a minimum-spanning tree.
+    (This is the original networkx-based implementation of seeded_mst(),
+    which is much slower but kept for reference.)
+
     To ensure that seeded nodes cannot be merged together prematurely,
     a virtual root node is inserted into the graph and given artificially
     strong affinity (low edge weight) to all seeded nodes.
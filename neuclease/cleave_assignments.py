@@ -0,0 +1,123 @@
+"""
+Encoding of cleave assignments for the cleave server's responses,
+either as JSON lists or in a compact binary format.
+
+The binary format (mimetype application/octet-stream) is little-endian:
+
+    offset  size  contents
+    ------  ----  --------
+         0     4  magic bytes: b'NCLV'
+         4     4  uint32 format version (1)
+         8     8  uint64 M: length of the metadata, in bytes (a multiple of 8)
+        16     M  metadata: UTF-8 JSON, padded with spaces.
+                  Contains everything in the usual JSON response except "assignments".
+      16+M     8  uint64 S: number of sections
+                  followed by S sections, each of which contains:
+                    - uint64 label
+                    - uint64 count
+                    - count * uint64 supervoxel IDs (sorted)
+
+Since every field is 8-byte aligned, the supervoxel arrays can be read without copying.
+"""
+import struct
+
+import ujson
+import numpy as np
+
+BINARY_MIMETYPE = 'application/octet-stream'
+BINARY_MAGIC = b'NCLV'
+BINARY_FORMAT_VERSION = 1
+
+
+def group_assignments(node_ids, labels):
+    """
+    Group the given nodes by label.
+
+    Args:
+        node_ids:
+            array (N,)
+        labels:
+            array (N,), the label of each node
+
+    Returns:
+        (unique_labels, groups), where groups is a list of
+        (sorted) node ID arrays, one per label.
+    """
+    node_ids = np.asarray(node_ids, np.uint64)
+    labels = np.asarray(labels)
+    assert node_ids.shape == labels.shape
+    if len(labels) == 0:
+        return labels, []
+
+    order = np.lexsort((node_ids, labels))
+    sorted_labels = labels[order]
+    group_starts = 1 + np.flatnonzero(sorted_labels[1:] != sorted_labels[:-1])
+    unique_labels = sorted_labels[np.concatenate(([0], group_starts))]
+    groups = np.split(node_ids[order], group_starts)
+    return unique_labels, groups
+
+
+def assignments_to_json(assignments):
+    """
+    Convert a dict of { label: array } to { str(label): list },
+    as sent in the JSON cleave response.
+    """
+    return { str(label): np.asarray(group).tolist() for label, group in assignments.items() }
+
+
+def encode_binary_response(cleave_response):
+    """
+    Encode the given cleave response (a dict, including "assignments"
+    as { label: array }) in the binary format described above.
+
+    Returns:
+        bytes
+    """
+    metadata = {k: v for k,v in cleave_response.items() if k != "assignments"}
+    metadata = ujson.dumps(metadata).encode('utf-8')
+    metadata += b' ' * (-len(metadata) % 8)
+
+    assignments = cleave_response.get("assignments", {})
+    parts = [BINARY_MAGIC, struct.pack('<IQ', BINARY_FORMAT_VERSION, len(metadata)), metadata,
+             struct.pack('<Q', len(assignments))]
+
+    for label, group in assignments.items():
+        group = np.asarray(group, '<u8')
+        parts.append(struct.pack('<QQ', int(label), len(group)))
+        parts.append(group.tobytes())
+
+    return b''.join(parts)
+
+
+def decode_binary_response(buf):
+    """
+    Decode a cleave response in the binary format described above.
+
+    Returns:
+        dict, in the same form as the JSON response, except that the
+        assignments are given as arrays, i.e. { str(label): array }.
+    """
+    buf = memoryview(buf)
+    if bytes(buf[:4]) != BINARY_MAGIC:
+        raise ValueError("Not a binary cleave response")
+
+    version, metadata_len = struct.unpack_from('<IQ', buf, 4)
+    if version != BINARY_FORMAT_VERSION:
+        raise ValueError(f"Unsupported binary cleave response version: {version}")
+
+    offset = 16
+    cleave_response = ujson.loads(bytes(buf[offset:offset+metadata_len]).decode('utf-8'))
+    offset += metadata_len
+
+    num_sections, = struct.unpack_from('<Q', buf, offset)
+    offset += 8
+
+    assignments = {}
+    for _ in range(num_sections):
+        label, count = struct.unpack_from('<QQ', buf, offset)
+        offset += 16
+        assignments[str(label)] = np.frombuffer(buf, '<u8', count, offset)
+        offset += 8 * count
+
+    cleave_response["assignments"] = assignments
+    return cleave_response
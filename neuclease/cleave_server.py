@@ -2,10 +2,13 @@ import os
 import sys
 import copy
 import signal
+import time
+import socket
 import logging
 import argparse
 from io import StringIO
 from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from http import HTTPStatus
 from datetime import datetime
 
@@ -14,26 +17,99 @@ import pandas as pd
 
 import requests
 from flask import Flask, request, abort, redirect, url_for, jsonify, Response, make_response
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
 
 from .logging_setup import init_logging, log_exceptions, PrefixedLogger
-from .merge_table import MERGE_TABLE_DTYPE
+from .merge_table import MERGE_TABLE_DTYPE, load_mapping
 from .merge_graph import LabelmapMergeGraph
-from .cleave import cleave, InvalidCleaveMethodError
-from .dvid import DvidInstanceInfo
-from .util import Timer
+from .edge_prefetch import EdgePrefetcher
+from .metrics import REGISTRY, CLEAVE_STAGE_SECONDS, Counter, Gauge
+from .cleave import cleave_prepared, InvalidCleaveMethodError
+from .cleave_assignments import BINARY_MIMETYPE, group_assignments, assignments_to_json, encode_binary_response
+from .admission import AdmissionController, AdmissionRejected
+from .dvid import (DvidInstanceInfo, read_kafka_messages, read_kafka_latest_offset,
+                   fetch_supervoxel_splits, fetch_complete_mappings, fetch_mutation_id)
+from .util import Timer, SingleFlight
 from neuclease.dvid._dvid import default_dvid_session
 
 # Globals
 MERGE_GRAPH = None
 DEFAULT_METHOD = "seeded-mst"
+BATCH_CLEAVE_THREADS = 4
+BATCH_CLEAVE_EXECUTOR = None # ThreadPoolExecutor for /compute-cleaves, if CLEAVE_ADMISSION is None (see main())
+MAX_BATCH_CLEAVES = 1000
+BATCH_ADMISSION_RETRY_SECONDS = 1.0 # How long a batch waits before trying again to submit a cleave
+CLEAVE_ADMISSION = None # AdmissionController for /compute-cleave (see main())
+CLEAVE_SINGLE_FLIGHT = SingleFlight()
 LOGFILE = None # Will be set in __main__, below
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
+# Metrics (see /metrics)
+IN_FLIGHT_REQUESTS = Gauge('cleave_server_requests_in_flight', 'Number of requests currently being handled')
+ERROR_RESPONSES = Counter('cleave_server_errors_total', 'Number of error responses, by HTTP status', ['status'])
+
+def _edge_cache_stat(name):
+    return lambda: (MERGE_GRAPH.edge_cache_stats()[name] if MERGE_GRAPH is not None else 0)
+
+Counter('cleave_server_edge_cache_hits_total', 'Edge cache hits', function=_edge_cache_stat('hits'))
+Counter('cleave_server_edge_cache_misses_total', 'Edge cache misses', function=_edge_cache_stat('misses'))
+Counter('cleave_server_edge_cache_evictions_total', 'Edge cache evictions', function=_edge_cache_stat('evictions'))
+Gauge('cleave_server_edge_cache_bytes', 'Size of the edge cache', function=_edge_cache_stat('bytes'))
+
+def _prefetch_stat(name):
+    return lambda: (MERGE_GRAPH.prefetcher.stats()[name]
+                    if MERGE_GRAPH is not None and MERGE_GRAPH.prefetcher is not None else 0)
+
+Counter('cleave_server_prefetched_bodies_total', 'Bodies whose edges were prefetched', function=_prefetch_stat('prefetched'))
+Counter('cleave_server_prefetch_skipped_total', 'Prefetch candidates which were already cached', function=_prefetch_stat('skipped'))
+Counter('cleave_server_prefetch_failures_total', 'Bodies whose edges could not be prefetched', function=_prefetch_stat('failed'))
+Gauge('cleave_server_prefetch_pending', 'Bodies waiting to be prefetched', function=_prefetch_stat('pending'))
+
+REJECTED_REQUESTS = Counter('cleave_server_rejected_requests_total', 'Cleave requests rejected because the server was too busy')
+COLLAPSED_REQUESTS = Counter('cleave_server_collapsed_requests_total',
+                             'Cleave requests which shared the result of an identical request already in progress')
+Gauge('cleave_server_queued_cleaves', 'Cleave requests waiting for a worker',
+      function=lambda: (CLEAVE_ADMISSION.stats()['queued'] if CLEAVE_ADMISSION is not None else 0))
+
+
+class _RequestMetricsMiddleware:
+    """
+    WSGI middleware to count in-flight requests and error responses.
+    (Implemented as middleware rather than via Flask hooks,
+    so that unhandled exceptions are counted, too.)
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        def _start_response(status, headers, exc_info=None):
+            status_code = int(status.split()[0])
+            if status_code >= 400:
+                ERROR_RESPONSES.inc(status=status_code)
+            return start_response(status, headers, exc_info)
+
+        # The request is still in flight until the server closes the response
+        # iterable, i.e. after the response body (which may be streamed) is sent.
+        IN_FLIGHT_REQUESTS.inc()
+        try:
+            app_iter = self.wsgi_app(environ, _start_response)
+        except BaseException:
+            IN_FLIGHT_REQUESTS.dec()
+            raise
+        return ClosingIterator(app_iter, IN_FLIGHT_REQUESTS.dec)
+
+app.wsgi_app = _RequestMetricsMiddleware(app.wsgi_app)
+
 
 def main(debug_mode=False, stdout_logging=False):
     global MERGE_GRAPH
     global LOGFILE
+    global BATCH_CLEAVE_THREADS
+    global BATCH_CLEAVE_EXECUTOR
+    global MAX_BATCH_CLEAVES
+    global CLEAVE_ADMISSION
 
     # Terminate results in normal shutdown
     signal.signal(signal.SIGTERM, lambda signum, stack_frame: exit(1))
@@ -65,7 +141,52 @@ def main(debug_mode=False, stdout_logging=False):
 
     parser.add_argument('--skip-focused-merge-update', action='store_true')
     parser.add_argument('--skip-split-sv-update', action='store_true')
+    parser.add_argument('--split-sv-fetch-threads', type=int, default=0,
+                        help="If given, fetch the supervoxels for split supervoxel edges in parallel batches, using this many threads.")
+    parser.add_argument('--save-snapshot', required=False,
+                        help="After initialization, save the merge graph (merge table and mapping) to the given directory, "
+                        "so it can be restored via --restore-snapshot the next time the server is launched.")
+    parser.add_argument('--restore-snapshot', required=False,
+                        help="Skip the usual initialization procedure, and restore the merge graph from a directory "
+                        "written via --save-snapshot.  Mutations since the snapshot was saved are read from kafka.")
+    parser.add_argument('--live-kafka-updates', action='store_true',
+                        help="After initialization, keep following the primary instance's kafka log, "
+                        "and apply each mutation to the in-memory mapping as it arrives.")
+    parser.add_argument('--prefetch-threads', type=int, default=0,
+                        help="If nonzero, use this many background threads to prefetch edges for recently edited bodies "
+                        "(as reported via --live-kafka-updates), so they are already cached when a cleave is requested.")
+    parser.add_argument('--prefetch-interval', type=float, default=1.0,
+                        help="Minimum time (in seconds) between prefetched bodies, per prefetch thread.")
+    parser.add_argument('--edge-cache-gb', type=float, default=4.0,
+                        help="Memory budget for the cache of recently extracted body edges (in each worker).")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of server processes. If more than one, the merge graph is memory-mapped from a snapshot "
+                        "(see --save-snapshot) and shared by all workers, which are forked after initialization. "
+                        "Each worker follows the kafka log independently (if --live-kafka-updates is given), "
+                        "recording the updates in its own (small) overlay on top of the shared snapshot. "
+                        "Note: Requests which change server state (e.g. /primary-uuid) only affect the worker that receives them.")
+    parser.add_argument('--batch-cleave-threads', type=int, default=4,
+                        help="Number of cleaves to compute concurrently for each /compute-cleaves request.")
+    parser.add_argument('--max-batch-cleaves', type=int, default=1000,
+                        help="Max number of cleave requests in a single /compute-cleaves request.")
+    parser.add_argument('--cleave-threads', type=int, default=8,
+                        help="Number of /compute-cleave requests to compute concurrently (in each worker). "
+                        "If 0, each request is computed in its own request thread, with no limit.")
+    parser.add_argument('--cleave-queue-size', type=int, default=32,
+                        help="Number of /compute-cleave requests that may wait for a free cleave thread. "
+                        "Further requests are rejected (503) until the queue drains.")
+    parser.add_argument('--max-cleaves-per-user', type=int, default=4,
+                        help="Number of /compute-cleave requests (running or queued) allowed for each user. If 0, no limit.")
+    parser.add_argument('--retry-after', type=int, default=5,
+                        help="Seconds after which clients should retry a rejected request (sent in the Retry-After header).")
     args = parser.parse_args()
+    BATCH_CLEAVE_THREADS = args.batch_cleave_threads
+    MAX_BATCH_CLEAVES = args.max_batch_cleaves
+    if args.cleave_threads > 0:
+        CLEAVE_ADMISSION = AdmissionController(args.cleave_threads, args.cleave_queue_size,
+                                               args.max_cleaves_per_user, args.retry_after)
+    else:
+        BATCH_CLEAVE_EXECUTOR = ThreadPoolExecutor(BATCH_CLEAVE_THREADS, thread_name_prefix='batch-cleave')
 
     # By default, initialization is same as primary unless otherwise specified
     args.initialization_dvid_server = args.initialization_dvid_server or args.primary_dvid_server
@@ -97,51 +218,233 @@ def main(debug_mode=False, stdout_logging=False):
         primary_instance_info = DvidInstanceInfo(args.primary_dvid_server, args.primary_uuid, args.primary_labelmap_instance)
         initialization_instance_info = DvidInstanceInfo(args.initialization_dvid_server, args.initialization_uuid, args.initialization_labelmap_instance)
 
-        kafka_msgs = None
+        use_kafka = all(primary_instance_info) and not args.testing
+
+        if args.restore_snapshot:
+            MERGE_GRAPH = LabelmapMergeGraph.load_snapshot(args.restore_snapshot, args.debug_export_dir, no_kafka=args.testing,
+                                                           edge_cache_bytes=int(args.edge_cache_gb * 2**30),
+                                                           shared=(args.workers > 1))
+            if MERGE_GRAPH.primary_uuid != primary_instance_info.uuid:
+                logger.warning(f"Snapshot was saved with primary UUID {MERGE_GRAPH.primary_uuid}, "
+                               f"but the server was launched with primary UUID {primary_instance_info.uuid}")
+                MERGE_GRAPH.set_primary_uuid(primary_instance_info.uuid)
+
+            if use_kafka and MERGE_GRAPH.kafka_offset is None:
+                logger.warning("Snapshot has no kafka offset. Mutations since it was saved can't be replayed.")
+            elif use_kafka:
+                MERGE_GRAPH.replay_kafka_updates(*primary_instance_info)
+        else:
+            MERGE_GRAPH = _init_merge_graph(args, primary_instance_info, initialization_instance_info, use_kafka)
+
+        if args.save_snapshot:
+            MERGE_GRAPH.save_snapshot(args.save_snapshot)
+
+        if args.workers > 1 and not args.restore_snapshot:
+            # Reload from a snapshot, so the merge graph is memory-mapped (read-only)
+            # instead of living in this process's heap, and the workers can share it.
+            snapshot_dir = args.save_snapshot
+            if not snapshot_dir:
+                snapshot_dir = f'{args.log_dir}/merge-graph-snapshot'
+                MERGE_GRAPH.save_snapshot(snapshot_dir)
+            MERGE_GRAPH = LabelmapMergeGraph.load_snapshot(snapshot_dir, args.debug_export_dir, no_kafka=args.testing,
+                                                           edge_cache_bytes=int(args.edge_cache_gb * 2**30),
+                                                           shared=True)
+
+        def start_background_threads():
+            if args.prefetch_threads:
+                MERGE_GRAPH.prefetcher = EdgePrefetcher(MERGE_GRAPH, args.prefetch_threads, args.prefetch_interval)
+                MERGE_GRAPH.prefetcher.start()
+
+            if args.live_kafka_updates and use_kafka:
+                logger.info(f"Following kafka log from offset {MERGE_GRAPH.kafka_offset}")
+                MERGE_GRAPH.start_kafka_updates(*primary_instance_info, MERGE_GRAPH.kafka_offset)
+
+        # In multi-process mode, each worker starts its own threads (after fork).
+        if args.workers == 1:
+            start_background_threads()
+
+        if args.suspend_before_launch:
+            pid = os.getpid()
+            print(f"Suspending process.  Please use 'kill -CONT {pid}' to resume app startup.")
+            sys.stdout.flush()
+            os.kill(pid, signal.SIGSTOP)
+            print(f"Process resumed.")
+
+    logger.info("Merge graph loaded. Starting server.")
+    print("Merge graph loaded. Starting server.")
+    if args.workers > 1:
+        assert not debug_mode, "Multiple workers can't be used in debug mode"
+        _run_workers(args.port, args.workers, start_background_threads)
+    else:
+        app.run(host='0.0.0.0', port=args.port, debug=debug_mode, threaded=not debug_mode, use_reloader=debug_mode)
+
+
+def _init_merge_graph(args, primary_instance_info, initialization_instance_info, use_kafka):
+    """
+    Load the merge table, append edges for focused merges and split supervoxels,
+    and apply the mapping, according to the server's command-line args.
+
+    The inputs to each step (the merge table, focused decisions, split events,
+    and mapping) are independent, so they are fetched concurrently.
+    Then they are applied to the merge graph in the usual order.
+    The kafka log is read at most once, and a per-phase timing breakdown is logged at the end.
+    """
+    timings = {}
+    def timed(phase, fn, *fn_args, **fn_kwargs):
+        with Timer(phase, logger) as timer:
+            result = fn(*fn_args, **fn_kwargs)
+        timings[phase] = timer.seconds
+        return result
+
+    def load_kafka_msgs():
         if args.primary_kafka_log:
             assert args.primary_kafka_log.endswith('.jsonl'), \
                 "Supply the kafka log in .jsonl format"
-            kafka_msgs = []
-            for line in open(args.primary_kafka_log, 'r'):
-                kafka_msgs.append(ujson.loads(line))
+            return [ujson.loads(line) for line in open(args.primary_kafka_log, 'r')]
+        if args.testing:
+            # For testing purposes, we have a special means of avoiding kafka
+            return []
+        return read_kafka_messages(*primary_instance_info)
+
+    def fetch_mapping():
+        if args.mapping_file:
+            return timed("Loading mapping", load_mapping, args.mapping_file)
+        if not all(primary_instance_info):
+            return None
+        kafka_msgs = timed("Reading kafka log", load_kafka_msgs)
+        return timed("Fetching complete mapping", fetch_complete_mappings, *primary_instance_info,
+                     include_retired=True, kafka_msgs=kafka_msgs)
+
+    with Timer() as total_timer, ThreadPoolExecutor(4) as executor:
+        # Note the current kafka offset before fetching the mapping,
+        # so no mutations can be missed by live updates or snapshot restores.
+        # (Replaying a mutation that is already reflected in the mapping is harmless.)
+        if use_kafka:
+            kafka_start_offset = read_kafka_latest_offset(*primary_instance_info)
 
         print("Loading merge table...")
-        with Timer(f"Loading merge table from: {args.merge_table or 'NONE'}", logger):
-            MERGE_GRAPH = LabelmapMergeGraph(args.merge_table, primary_instance_info.uuid, args.debug_export_dir, no_kafka=args.testing)
+        merge_graph_future = executor.submit( timed, f"Loading merge table from: {args.merge_table or 'NONE'}",
+                                              LabelmapMergeGraph, args.merge_table, primary_instance_info.uuid,
+                                              args.debug_export_dir, no_kafka=args.testing,
+                                              edge_cache_bytes=int(args.edge_cache_gb * 2**30) )
 
+        focused_merges_future = None
         if not args.skip_focused_merge_update:
-            with Timer(f"Loading focused merge decisions", logger):
-                num_focused_merges = MERGE_GRAPH.append_edges_for_focused_merges(*initialization_instance_info[:2], 'segmentation_merged')
+            focused_merges_future = executor.submit( timed, "Fetching focused merge decisions",
+                                                     LabelmapMergeGraph.fetch_focused_merges,
+                                                     *initialization_instance_info[:2], 'segmentation_merged' )
+
+        split_events_future = None
+        if all(primary_instance_info) and not args.skip_split_sv_update:
+            split_events_future = executor.submit( timed, "Fetching supervoxel split events",
+                                                   fetch_supervoxel_splits, *initialization_instance_info, 'dvid' )
+
+        mapping_future = executor.submit(fetch_mapping)
+
+        # Now apply everything in order, as each input becomes available.
+        merge_graph = merge_graph_future.result()
+
+        if focused_merges_future is not None:
+            focused_merges = focused_merges_future.result()
+            num_focused_merges = 0
+            if focused_merges is not None:
+                num_focused_merges = timed( "Appending focused merge edges", merge_graph.append_edges_for_focused_merges,
+                                            *initialization_instance_info[:2], 'segmentation_merged', focused_merges )
             logger.info(f"Loaded {num_focused_merges} merge decisions.")
 
         # Apply splits first
-        if all(primary_instance_info) and not args.skip_split_sv_update:
-            with Timer(f"Appending split supervoxel edges for supervoxels in", logger):
-                bad_edges = MERGE_GRAPH.append_edges_for_split_supervoxels( initialization_instance_info, read_from='dvid', kafka_msgs=kafka_msgs )
+        if split_events_future is not None:
+            bad_edges = timed( "Appending split supervoxel edges", merge_graph.append_edges_for_split_supervoxels,
+                               initialization_instance_info, read_from='dvid', threads=args.split_sv_fetch_threads,
+                               split_events=split_events_future.result() )
 
-                if len(bad_edges) > 0:
-                    bad_edges_name = f'BAD-SPLIT-EDGES-{args.primary_uuid[:4]}.csv'
-                    bad_edges_filepath = args.log_dir + '/' + bad_edges_name
-                    bad_edges.to_csv(bad_edges_filepath, index=False, header=True)
-                    logger.error(f"Some edges belonging to split supervoxels could not be preserved, due to {len(bad_edges)} bad representative points.")
-                    logger.error(f"See {bad_edges_filepath}")
+            if len(bad_edges) > 0:
+                bad_edges_name = f'BAD-SPLIT-EDGES-{args.primary_uuid[:4]}.csv'
+                bad_edges_filepath = args.log_dir + '/' + bad_edges_name
+                bad_edges.to_csv(bad_edges_filepath, index=False, header=True)
+                logger.error(f"Some edges belonging to split supervoxels could not be preserved, due to {len(bad_edges)} bad representative points.")
+                logger.error(f"See {bad_edges_filepath}")
 
-        # Apply mapping (after splits), either from file or from DVID.
-        if args.mapping_file:
-            MERGE_GRAPH.apply_mapping(args.mapping_file)
-        elif all(primary_instance_info):
-            MERGE_GRAPH.fetch_and_apply_mapping(*primary_instance_info, kafka_msgs)
+        # Apply mapping (after splits)
+        mapping = mapping_future.result()
+        if mapping is not None:
+            timed("Applying mapping", merge_graph.apply_mapping, mapping)
 
-        if args.suspend_before_launch:
-            pid = os.getpid()
-            print(f"Suspending process.  Please use 'kill -CONT {pid}' to resume app startup.")
-            sys.stdout.flush()
-            os.kill(pid, signal.SIGSTOP)
-            print(f"Process resumed.")
+        if use_kafka:
+            merge_graph.kafka_offset = kafka_start_offset
 
-    logger.info("Merge graph loaded. Starting server.")
-    print("Merge graph loaded. Starting server.")
-    app.run(host='0.0.0.0', port=args.port, debug=debug_mode, threaded=not debug_mode, use_reloader=debug_mode)
+    breakdown = '\n'.join(f"  {phase}: {seconds:.1f}s" for phase, seconds in timings.items())
+    logger.info(f"Merge graph initialization took {total_timer.seconds:.1f}s. Breakdown:\n{breakdown}")
+    return merge_graph
+
+
+def _run_workers(port, num_workers, worker_init=None):
+    """
+    Serve requests from several "pre-forked" worker processes,
+    which all accept connections from the same listening socket.
+
+    The workers are forked from this process after the merge graph has been
+    loaded, so they all share its memory: the merge graph is memory-mapped
+    (read-only) from a snapshot (see LabelmapMergeGraph.load_snapshot(shared=True)).
+    Each worker records the updates it applies (e.g. from the kafka log)
+    in small overlays, so the shared arrays are never copied.
+
+    This function never returns. Workers that exit are replaced,
+    and all workers are terminated if this process receives SIGTERM or SIGINT.
+
+    Args:
+        port:
+            The port to listen on.
+        num_workers:
+            How many worker processes to launch.
+        worker_init:
+            Optional function to call in each worker process before it starts serving,
+            e.g. to start background threads (which don't survive fork()).
+    """
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(('0.0.0.0', port))
+    listen_socket.listen(128)
+    listen_socket.set_inheritable(True)
+
+    def start_worker():
+        pid = os.fork()
+        if pid != 0:
+            logger.info(f"Started worker process {pid}")
+            return pid
+
+        # Worker process
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if worker_init:
+                worker_init()
+            server = make_server('0.0.0.0', port, app, threaded=True, fd=listen_socket.fileno())
+            server.serve_forever()
+        except BaseException:
+            logger.error("Worker process failed", exc_info=True)
+        finally:
+            os._exit(1)
+
+    workers = set()
+
+    def stop_workers(signum, stack_frame):
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    for _ in range(num_workers):
+        workers.add(start_worker())
+
+    while True:
+        pid, status = os.wait()
+        if pid in workers:
+            workers.remove(pid)
+            logger.error(f"Worker process {pid} exited with status {status}. Starting a replacement.")
+            workers.add(start_worker())
 
 
 @app.route('/')
@@ -198,6 +501,10 @@ def compute_cleave():
         "segmentation-instance": "segmentation",
         "mesh-instance": "segmentation_meshes_tars"
     }
+
+    The response is JSON, unless the request's Accept header prefers
+    application/octet-stream, in which case the response is sent in a
+    compact binary format (see neuclease.cleave_assignments).
     """
     with Timer() as timer:
         data = request.json
@@ -218,20 +525,212 @@ def compute_cleave():
     
         req_string = ujson.dumps(data, sort_keys=True)
         body_logger.info(f"Received cleave request: {req_string}")
-        cleave_results, status_code = _run_cleave(data)
-
-        json_response = jsonify(cleave_results)
+        try:
+            cleave_results, status_code = _admit_cleave(data, body_logger)
+        except AdmissionRejected as ex:
+            REJECTED_REQUESTS.inc()
+            body_logger.warning(f"Rejecting request: {ex.reason}")
+            cleave_results = copy.copy(data)
+            cleave_results.setdefault("errors", []).append(ex.reason)
+            response = jsonify(cleave_results)
+            response.headers['Retry-After'] = str(ex.retry_after)
+            return response, HTTPStatus.SERVICE_UNAVAILABLE
+
+        if request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE:
+            with CLEAVE_STAGE_SECONDS.time(stage='serialize_binary'):
+                response = Response(encode_binary_response(cleave_results), mimetype=BINARY_MIMETYPE)
+        else:
+            with CLEAVE_STAGE_SECONDS.time(stage='serialize_json'):
+                cleave_results["assignments"] = assignments_to_json(cleave_results["assignments"])
+                response = jsonify(cleave_results)
     
     body_logger.info(f"Total time: {timer.timedelta}")
-    return json_response, status_code
+    return response, status_code
+
+
+@app.route('/compute-cleaves', methods=['POST'])
+@log_exceptions(logger)
+def compute_cleaves():
+    """
+    Compute several cleaves at once, e.g. for scripted cleaves of many bodies.
+
+    The request body is a JSON list of cleave requests, each in the same
+    format as for /compute-cleave.  The cleaves are computed concurrently
+    (see --batch-cleave-threads), and the results are streamed back as
+    newline-delimited JSON, in the order they are completed (not the
+    order they were requested).  Each cleave is started only when one of
+    the batch's earlier cleaves has finished, and if the client disconnects,
+    the remaining cleaves are not computed at all.
+    At most --max-batch-cleaves requests may be sent in one batch.
+
+    The cleaves are subject to the same admission control as /compute-cleave
+    (see --cleave-threads).  If the server is too busy to start the batch,
+    the request is rejected (503).  Once the batch has started, its remaining
+    cleaves wait for a place in the queue rather than being rejected.
+
+    Each result has the same format as the /compute-cleave response,
+    with two additional fields:
+
+        "batch-index": The position of the corresponding request in the list
+        "status-code": The HTTP status that /compute-cleave would have returned
+    """
+    batch = request.json
+    if not isinstance(batch, list) or not all(isinstance(data, dict) for data in batch):
+        abort(Response('Request body must be a JSON list of cleave requests', status=400))
+
+    if len(batch) > MAX_BATCH_CLEAVES:
+        abort(Response(f'Too many cleave requests in one batch ({len(batch)}). '
+                       f'The limit is {MAX_BATCH_CLEAVES}.', status=HTTPStatus.REQUEST_ENTITY_TOO_LARGE))
+
+    user = batch[0].get("user", "unknown") if batch else "unknown"
+    logger.info(f"User {user}: Received batch of {len(batch)} cleave requests")
+
+    timestamp = str(datetime.now())
+    for i, data in enumerate(batch):
+        data['batch-index'] = i
+        data['request-timestamp'] = timestamp
+
+    if CLEAVE_ADMISSION is not None:
+        try:
+            CLEAVE_ADMISSION.check(user)
+        except AdmissionRejected as ex:
+            REJECTED_REQUESTS.inc()
+            logger.warning(f"User {user}: Rejecting batch: {ex.reason}")
+            response = jsonify({"errors": [ex.reason]})
+            response.headers['Retry-After'] = str(ex.retry_after)
+            return response, HTTPStatus.SERVICE_UNAVAILABLE
+
+    def generate_results():
+        remaining = iter(batch)
+        next_data = None
+        pending = set()
+        try:
+            with Timer() as timer:
+                while True:
+                    # Keep at most BATCH_CLEAVE_THREADS of this batch's cleaves in the queue.
+                    while len(pending) < BATCH_CLEAVE_THREADS:
+                        if next_data is None:
+                            next_data = next(remaining, None)
+                        if next_data is None:
+                            break
+                        try:
+                            pending.add(_submit_batch_cleave(next_data))
+                            next_data = None
+                        except AdmissionRejected as ex:
+                            if pending:
+                                # Try again after one of our own cleaves has finished.
+                                break
+                            time.sleep(min(ex.retry_after, BATCH_ADMISSION_RETRY_SECONDS))
+
+                    if not pending:
+                        break
+
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        cleave_results, status_code = future.result()
+                        cleave_results["assignments"] = assignments_to_json(cleave_results.get("assignments", {}))
+                        cleave_results["status-code"] = int(status_code)
+                        yield ujson.dumps(cleave_results) + '\n'
+            logger.info(f"User {user}: Batch of {len(batch)} cleaves took {timer.timedelta}")
+        finally:
+            # If the client disconnected, don't bother finishing the batch.
+            for future in pending:
+                future.cancel()
+
+    return Response(generate_results(), mimetype='application/x-ndjson')
+
+
+def _submit_batch_cleave(data):
+    """
+    Submit a cleave from a /compute-cleaves batch to the admission-controlled
+    worker pool (if any), or to the batch executor.
+
+    Raises:
+        AdmissionRejected if the server is too busy to accept the cleave.
+
+    Returns:
+        Future
+    """
+    if CLEAVE_ADMISSION is None:
+        return BATCH_CLEAVE_EXECUTOR.submit(_run_cleave_or_error, data)
+    return CLEAVE_ADMISSION.submit(data.get("user", "unknown"), _run_cleave_or_error, data)
+
+
+def _run_cleave_or_error(data):
+    """
+    Call _run_cleave(), but convert unexpected exceptions
+    into an error response instead of raising them.
+    (The exception is logged by _run_cleave() itself.)
+    """
+    try:
+        return _run_cleave(data)
+    except Exception as ex:
+        cleave_response = copy.copy(data)
+        cleave_response.setdefault("errors", []).append(f"Internal error: {type(ex).__name__}: {ex}")
+        return cleave_response, HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+def _admit_cleave(data, body_logger):
+    """
+    Run _run_cleave() in the admission-controlled worker pool
+    (see --cleave-threads), and wait for the results.
+
+    If an identical request (same body, seeds, and mutation ID) is already
+    in progress (e.g. due to a double-click), it isn't computed twice.
+    Instead, this request waits for the other request's results.
+
+    Raises:
+        AdmissionRejected if the server is too busy to accept the request.
+
+    Returns:
+        (cleave_results, status_code)
+    """
+    user = data.get("user", "unknown")
+    instance_info = DvidInstanceInfo(data["server"] + ':' + str(data["port"]), data["uuid"], data["segmentation-instance"])
+    body_id = data["body-id"]
+
+    # If the server is too busy, reject the request before doing any work for it.
+    if CLEAVE_ADMISSION is not None:
+        CLEAVE_ADMISSION.check(user)
+
+    try:
+        session = default_dvid_session(appname='cleave-server', user=user)
+        with CLEAVE_STAGE_SECONDS.time(stage='fetch_mutation_id'):
+            mutid = fetch_mutation_id(*instance_info, body_id, session=session)
+    except requests.HTTPError:
+        # _run_cleave() will encounter (and report) the same error.
+        mutid = None
+
+    seeds = tuple(sorted((int(label), tuple(sorted(svs))) for label, svs in data["seeds"].items() if svs))
+    method = data.get("method", DEFAULT_METHOD)
+    find_missing_edges = data.get("find-missing-edges", True)
+    key = (*instance_info, body_id, seeds, method, find_missing_edges, mutid)
+
+    def run():
+        if CLEAVE_ADMISSION is None:
+            return _run_cleave(data, mutid)
+        return CLEAVE_ADMISSION.submit(user, _run_cleave, data, mutid).result()
+
+    (cleave_results, status_code), joined = CLEAVE_SINGLE_FLIGHT.run(key, run)
+
+    # The results may be shared with other requests, so copy before modifying.
+    cleave_results = copy.copy(cleave_results)
+    if joined:
+        COLLAPSED_REQUESTS.inc()
+        body_logger.info("Using the results of an identical request which was already in progress")
+        cleave_results.update({k: v for k,v in data.items() if k != "seeds"})
+
+    return cleave_results, status_code
 
 
 @log_exceptions(logger)
-def _run_cleave(data):
+def _run_cleave(data, mutid=None):
     """
     Helper function that actually performs the cleave,
     and can be run in a separate process.
     Must not use any flask functions.
+
+    If the body's mutation ID has already been fetched, it can be provided.
     """
     global logger
     global MERGE_TABLE
@@ -248,6 +747,8 @@ def _run_cleave(data):
     body_logger = PrefixedLogger(logger, f"User {user}: Body {body_id}: ")
 
     instance_info = DvidInstanceInfo(server, uuid, segmentation_instance)
+    if MERGE_GRAPH.prefetcher is not None:
+        MERGE_GRAPH.prefetcher.note_request(*instance_info, body_id)
 
     # Remove empty seed classes (if any)
     for label in list(seeds.keys()):
@@ -271,7 +772,7 @@ def _run_cleave(data):
     with Timer() as timer:
         try:
             session = default_dvid_session(appname='cleave-server', user=user)
-            mutid, supervoxels, edges, scores = MERGE_GRAPH.extract_edges(*instance_info, body_id, find_missing_edges, session=session, logger=body_logger)
+            mutid, supervoxels, cleave_graph = MERGE_GRAPH.extract_cleave_graph(*instance_info, body_id, find_missing_edges, session=session, logger=body_logger, mutid=mutid)
         except requests.HTTPError as ex:
             status_name = str(HTTPStatus(ex.response.status_code)).split('.')[1]
             if ex.response.status_code == HTTPStatus.NOT_FOUND:
@@ -295,8 +796,8 @@ def _run_cleave(data):
 
     try:
         # Perform the cleave computation
-        with Timer() as timer:
-            results = cleave(edges, scores, seeds, supervoxels, method=method)
+        with Timer() as timer, CLEAVE_STAGE_SECONDS.time(stage='cleave'):
+            results = cleave_prepared(cleave_graph, seeds, method=method)
     except InvalidCleaveMethodError as ex:
         body_logger.error(str(ex))
         body_logger.info("Responding with error BAD_REQUEST.")
@@ -305,11 +806,11 @@ def _run_cleave(data):
         
     body_logger.info(f"Computing cleave took {timer.timedelta}")
 
-    # Convert assignments to JSON
-    df = pd.DataFrame({'node': supervoxels, 'label': results.output_labels})
-    df.sort_values('node', inplace=True)
-    for label, group in df.groupby('label'):
-        cleave_response["assignments"][str(label)] = group['node'].tolist()
+    # Group the supervoxels by label.
+    # (They're converted to JSON lists or binary by the caller.)
+    with CLEAVE_STAGE_SECONDS.time(stage='format_assignments'):
+        labels, groups = group_assignments(supervoxels, results.output_labels)
+        cleave_response["assignments"] = dict(zip(map(str, labels.tolist()), groups))
 
     if results.disconnected_components:
         msg = (f"Cleave result contains non-contiguous objects for seeds: "
@@ -344,6 +845,24 @@ def set_primary_uuid():
     return response, HTTPStatus.OK
 
 
+@app.route('/metrics')
+def metrics():
+    """
+    Server metrics, in the Prometheus text format.
+    Note: In multi-process mode (--workers), each worker reports only its own metrics.
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/edge-cache-stats')
+def edge_cache_stats():
+    global MERGE_GRAPH
+    stats = MERGE_GRAPH.edge_cache_stats()
+    if MERGE_GRAPH.prefetcher is not None:
+        stats['prefetch'] = MERGE_GRAPH.prefetcher.stats()
+    return jsonify(stats), HTTPStatus.OK
+
+
 @app.route('/body-edge-table', methods=['POST'])
 def body_edge_table():
     """
@@ -364,6 +883,8 @@ def body_edge_table():
     body_logger = PrefixedLogger(logger, f"User {user}: Body {body_id}: ")
 
     instance_info = DvidInstanceInfo(server, uuid, segmentation_instance)
+    if MERGE_GRAPH.prefetcher is not None:
+        MERGE_GRAPH.prefetcher.note_request(*instance_info, body_id)
 
     body_logger.info("Recevied body-edge-table request")
 
@@ -6,10 +6,20 @@ import platform
 import functools
 import threading
 from collections import namedtuple
+from contextlib import contextmanager
 
+import numpy as np
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.protobuf.message import Message as ProtobufMessage
 from libdvid import DVIDNodeService
 
+from ..util import SingleFlight
+from .response_cache import DvidResponseCache, CachingSession, DEFAULT_RESPONSE_CACHE_BYTES
+from .telemetry import DvidTelemetry, TelemetrySession
+
 # On Mac, requests uses a system library which is not fork-safe,
 # resulting in segfaults such as the following:
 #
@@ -30,6 +40,7 @@ if platform.system() == "Darwin" and 'no_proxy' not in os.environ:
     os.environ["no_proxy"] = "*"
 
 DEFAULT_DVID_SESSIONS = {}
+DEFAULT_DVID_ADAPTERS = {}
 DEFAULT_DVID_NODE_SERVICES = {}
 DEFAULT_APPNAME = "neuclease"
 
@@ -38,12 +49,139 @@ DvidInstanceInfo = namedtuple("DvidInstanceInfo", "server uuid instance")
 
 DVID_ADMIN_TOKEN = os.environ.get("DVID_ADMIN_TOKEN", None)
 
+# Connection and retry settings for the sessions created by new_dvid_session().
+# The defaults can be overridden via environment variables (see below),
+# or via configure_dvid_sessions().
+DVID_SESSION_SETTINGS = {
+    # Max number of connections to keep open per DVID server.
+    # (The connection pool is shared by all threads' default sessions.)
+    'pool_size': int(os.environ.get("NEUCLEASE_DVID_POOL_SIZE", 64)),
+
+    # If False, send 'Connection: close' with every request.
+    'keep_alive': os.environ.get("NEUCLEASE_DVID_KEEP_ALIVE", "1").lower() not in ('0', 'false', 'no'),
+
+    # How many times to retry GET/HEAD requests which failed due to a connection
+    # error or a temporary server error (502, 503, 504).
+    # DVID responds with 503 when it is throttling requests.
+    'retries': int(os.environ.get("NEUCLEASE_DVID_RETRIES", 3)),
+
+    # Retries are delayed via exponential backoff: backoff_factor * 2**(retry-1) seconds,
+    # plus a random delay of up to backoff_jitter seconds, but no more than backoff_max.
+    # (If the server sends a Retry-After header, that is respected instead.)
+    'backoff_factor': float(os.environ.get("NEUCLEASE_DVID_BACKOFF_FACTOR", 0.5)),
+    'backoff_jitter': float(os.environ.get("NEUCLEASE_DVID_BACKOFF_JITTER", 0.5)),
+    'backoff_max': float(os.environ.get("NEUCLEASE_DVID_BACKOFF_MAX", 60.0)),
+}
+
+RETRY_STATUS_CODES = (502, 503, 504)
+
+# Older versions of urllib3 don't support these options.
+_RETRY_PARAMS = inspect.signature(Retry.__init__).parameters
+
+
+def configure_dvid_sessions(**settings):
+    """
+    Change the connection and retry settings (see DVID_SESSION_SETTINGS)
+    used for all new_dvid_session() and default_dvid_session() objects.
+
+    The default sessions which have already been created are discarded,
+    so subsequent calls to default_dvid_session() will return new sessions
+    which use the new settings.
+
+    Example:
+
+        >>> configure_dvid_sessions(pool_size=128, retries=5)
+    """
+    invalid = set(settings.keys()) - set(DVID_SESSION_SETTINGS.keys())
+    assert not invalid, f"Invalid session settings: {invalid}"
+    DVID_SESSION_SETTINGS.update(settings)
+    DEFAULT_DVID_SESSIONS.clear()
+    DEFAULT_DVID_ADAPTERS.clear()
+
+
+def new_dvid_session(appname=DEFAULT_APPNAME, user=getpass.getuser(), admintoken=DVID_ADMIN_TOKEN, *,
+                     adapter=None, **settings):
+    """
+    Create a new requests.Session object that automatically appends the
+    'u' and 'app' query string parameters to every request, configured
+    according to DVID_SESSION_SETTINGS (and the given overrides, if any).
+
+    Unless you need custom settings, use default_dvid_session() instead,
+    which caches one session per thread and shares a single connection
+    pool among them.
+
+    Args:
+        appname, user, admintoken:
+            Sent as query string parameters with every request.
+        adapter:
+            Optional. An HTTPAdapter to use for all requests,
+            instead of creating a new one from the settings.
+        settings:
+            Overrides for any of the settings in DVID_SESSION_SETTINGS.
+    """
+    invalid = set(settings.keys()) - set(DVID_SESSION_SETTINGS.keys())
+    assert not invalid, f"Invalid session settings: {invalid}"
+    settings = {**DVID_SESSION_SETTINGS, **settings}
+
+    s = requests.Session()
+    s.params = { 'u': user, 'app': appname }
+    if admintoken:
+        s.params['admintoken'] = admintoken
+
+    if adapter is None:
+        adapter = _new_dvid_adapter(settings)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+
+    if not settings['keep_alive']:
+        s.headers['Connection'] = 'close'
+
+    return s
+
+
+def _new_dvid_adapter(settings):
+    retry_kwargs = {
+        'total': settings['retries'],
+        'connect': settings['retries'],
+        'read': settings['retries'],
+        'status': settings['retries'],
+        'status_forcelist': RETRY_STATUS_CODES,
+        'backoff_factor': settings['backoff_factor'],
+
+        # After the last retry, return the error response as usual
+        # (so the caller's raise_for_status() reports it, including the response body).
+        'raise_on_status': False,
+        'respect_retry_after_header': True,
+    }
+
+    # Only GET/HEAD requests are retried.
+    # (Most DVID POSTs are not idempotent.)
+    if 'allowed_methods' in _RETRY_PARAMS:
+        retry_kwargs['allowed_methods'] = frozenset(['GET', 'HEAD'])
+    else:
+        retry_kwargs['method_whitelist'] = frozenset(['GET', 'HEAD'])
+
+    if 'backoff_jitter' in _RETRY_PARAMS:
+        retry_kwargs['backoff_jitter'] = settings['backoff_jitter']
+    if 'backoff_max' in _RETRY_PARAMS:
+        retry_kwargs['backoff_max'] = settings['backoff_max']
+
+    retries = Retry(**retry_kwargs)
+    return HTTPAdapter(pool_connections=settings['pool_size'], pool_maxsize=settings['pool_size'], max_retries=retries)
+
+
 def default_dvid_session(appname=DEFAULT_APPNAME, user=getpass.getuser(), admintoken=DVID_ADMIN_TOKEN):
     """
     Return a default requests.Session() object that automatically appends the
     'u' and 'app' query string parameters to every request.
     The Session object is cached, so this function will return the same Session
     object if called again from the same thread with the same arguments.
+
+    All of the default sessions (in the current process) share a single
+    connection pool, so threads (e.g. in a thread pool) which are started after
+    the pool has warmed up can reuse existing connections rather than opening new ones.
+    The connection and retry settings are given by DVID_SESSION_SETTINGS.
+    (See configure_dvid_sessions().)
     """
     # TODO:
     # Proper authentication will involve fetching a JWT from this endpoint:
@@ -57,16 +195,253 @@ def default_dvid_session(appname=DEFAULT_APPNAME, user=getpass.getuser(), admint
     try:
         s = DEFAULT_DVID_SESSIONS[(appname, user, admintoken, thread_id, pid)]
     except KeyError:
-        s = requests.Session()
-        s.params = { 'u': user, 'app': appname }
-        if admintoken:
-            s.params['admintoken'] = admintoken
+        # Unlike sessions, adapters (i.e. connection pools) are threadsafe,
+        # so we share one among all threads.
+        try:
+            adapter = DEFAULT_DVID_ADAPTERS[pid]
+        except KeyError:
+            adapter = DEFAULT_DVID_ADAPTERS.setdefault(pid, _new_dvid_adapter(DVID_SESSION_SETTINGS))
 
+        s = new_dvid_session(appname, user, admintoken, adapter=adapter)
         DEFAULT_DVID_SESSIONS[(appname, user, admintoken, thread_id, pid)] = s
 
     return s
 
 
+# See enable_dvid_response_cache()
+DVID_RESPONSE_CACHE = None
+
+
+def enable_dvid_response_cache(directory=None, max_bytes=None):
+    """
+    Enable the on-disk cache for GET responses from locked DVID nodes,
+    used by all functions decorated with dvid_api_wrapper.
+    (See neuclease.dvid.response_cache.)
+
+    The cache can also be enabled by setting the NEUCLEASE_DVID_CACHE_DIR
+    (and optionally NEUCLEASE_DVID_CACHE_BYTES) environment variables.
+
+    Args:
+        directory:
+            Where to store the cached responses.
+            The cache persists across sessions, and it may be shared by multiple processes.
+            Default: $NEUCLEASE_DVID_CACHE_DIR, or ~/.cache/neuclease/dvid-responses
+        max_bytes:
+            Max total size of the cached responses.
+            Default: $NEUCLEASE_DVID_CACHE_BYTES, or 10 GB
+
+    Returns:
+        The DvidResponseCache
+    """
+    global DVID_RESPONSE_CACHE
+    if directory is None:
+        directory = os.environ.get("NEUCLEASE_DVID_CACHE_DIR",
+                                   os.path.expanduser("~/.cache/neuclease/dvid-responses"))
+    if max_bytes is None:
+        max_bytes = int(os.environ.get("NEUCLEASE_DVID_CACHE_BYTES", DEFAULT_RESPONSE_CACHE_BYTES))
+
+    DVID_RESPONSE_CACHE = DvidResponseCache(directory, max_bytes)
+    return DVID_RESPONSE_CACHE
+
+
+def disable_dvid_response_cache():
+    """
+    Disable the on-disk response cache.
+    (The cached files are not deleted.)
+    """
+    global DVID_RESPONSE_CACHE
+    DVID_RESPONSE_CACHE = None
+
+
+if os.environ.get("NEUCLEASE_DVID_CACHE_DIR"):
+    enable_dvid_response_cache()
+
+
+# See enable_dvid_single_flight()
+DVID_SINGLE_FLIGHT = None
+
+
+def enable_dvid_single_flight():
+    """
+    Coalesce concurrent identical calls to the 'fetch' functions decorated
+    with dvid_api_wrapper: if a thread calls such a function while another
+    thread is already waiting for a call with the same arguments, it doesn't
+    send its own request.  Instead, it waits for the other call to finish,
+    and receives a copy of its (parsed) result.
+
+    This is useful in multithreaded servers (and thread pools) which tend to
+    request the same data in bursts.  Only calls whose sessions identify the
+    same client (the same 'u', 'app', and 'admintoken' parameters, and the
+    same Authorization header) are coalesced.
+    Calls with arguments that can't be used as a key (e.g. DataFrames)
+    are never coalesced.
+
+    Arrays, pandas objects, protobuf messages, and lists, tuples, dicts,
+    and sets (of any of those) are copied for each caller.  Other objects
+    (rarely returned by the fetch functions) are shared by all callers,
+    so they must not be modified.
+
+    The coalescing can also be enabled by setting the NEUCLEASE_DVID_SINGLE_FLIGHT
+    environment variable.
+
+    Returns:
+        The util.SingleFlight object, which keeps counts of the calls and joins.
+    """
+    global DVID_SINGLE_FLIGHT
+    if DVID_SINGLE_FLIGHT is None:
+        DVID_SINGLE_FLIGHT = SingleFlight()
+    return DVID_SINGLE_FLIGHT
+
+
+def disable_dvid_single_flight():
+    """
+    Stop coalescing concurrent identical calls.
+    (Calls already in progress are not affected.)
+    """
+    global DVID_SINGLE_FLIGHT
+    DVID_SINGLE_FLIGHT = None
+
+
+if os.environ.get("NEUCLEASE_DVID_SINGLE_FLIGHT", "0").lower() not in ('0', 'false', 'no', ''):
+    enable_dvid_single_flight()
+
+
+# The active DvidTelemetry registries.
+# See enable_dvid_telemetry() and dvid_telemetry()
+DVID_TELEMETRY = ()
+
+
+def enable_dvid_telemetry(telemetry=None):
+    """
+    Record the HTTP requests sent by all functions decorated with dvid_api_wrapper
+    (from all threads), until disable_dvid_telemetry() is called.
+    (See neuclease.dvid.telemetry.)
+
+    Requests which are avoided via the response cache or single-flight are not recorded.
+
+    Args:
+        telemetry:
+            Optional. The DvidTelemetry registry to record to.
+            By default, a new one is created.
+
+    Returns:
+        The DvidTelemetry registry
+
+    Example:
+
+        >>> telemetry = enable_dvid_telemetry()
+        >>> do_work()
+        >>> print(telemetry.summary(top=10))
+    """
+    global DVID_TELEMETRY
+    if telemetry is None:
+        telemetry = DvidTelemetry()
+    if telemetry not in DVID_TELEMETRY:
+        DVID_TELEMETRY = (*DVID_TELEMETRY, telemetry)
+    return telemetry
+
+
+def disable_dvid_telemetry(telemetry=None):
+    """
+    Stop recording to the given DvidTelemetry registry,
+    or to all registries if none is given.
+    """
+    global DVID_TELEMETRY
+    if telemetry is None:
+        DVID_TELEMETRY = ()
+    else:
+        DVID_TELEMETRY = tuple(t for t in DVID_TELEMETRY if t is not telemetry)
+
+
+@contextmanager
+def dvid_telemetry(csv_path=None):
+    """
+    Context manager.
+    Record the DVID requests sent during the 'with' block
+    (from all threads) to a new DvidTelemetry registry.
+    Other registries (e.g. from enable_dvid_telemetry() or an
+    enclosing 'with' block) continue to record in the meantime.
+
+    Args:
+        csv_path:
+            Optional. If given, the records are written to this CSV
+            file at the end of the 'with' block.
+
+    Example:
+
+        >>> with dvid_telemetry('my-job-requests.csv') as telemetry:
+        ...     do_work()
+        >>> print(telemetry.summary(top=10))
+    """
+    telemetry = enable_dvid_telemetry(DvidTelemetry())
+    try:
+        yield telemetry
+    finally:
+        disable_dvid_telemetry(telemetry)
+        if csv_path:
+            telemetry.to_csv(csv_path)
+
+
+def _single_flight_key(f, server, args, kwargs, session):
+    """
+    Return a hashable key for the given call,
+    or None if some arguments can't be converted to a key.
+    """
+    try:
+        key = (f.__module__, f.__qualname__, server, _freeze_arg(args), _freeze_arg(kwargs),
+               _session_identity(session))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _session_identity(session):
+    """
+    Return the parts of the given session which identify the client.
+    """
+    params = getattr(session, 'params', None)
+    if not isinstance(params, dict):
+        raise TypeError("Can't determine the session's client parameters")
+
+    identity = sorted((k, str(v)) for k,v in params.items() if k in ('u', 'app', 'admintoken'))
+    return (*identity, session.headers.get('Authorization'))
+
+
+def _freeze_arg(arg):
+    if isinstance(arg, (list, tuple)):
+        return (type(arg).__name__, *map(_freeze_arg, arg))
+    if isinstance(arg, dict):
+        return ('dict', *sorted((k, _freeze_arg(v)) for k,v in arg.items()))
+    if isinstance(arg, np.ndarray):
+        return ('ndarray', arg.dtype.str, arg.shape, arg.tobytes())
+    if isinstance(arg, (pd.core.generic.NDFrame, pd.Index)):
+        raise TypeError("pandas objects are not used as keys")
+    return arg
+
+
+def _copy_shared_result(result):
+    """
+    Copy the mutable results that callers commonly modify in-place,
+    so that the callers of a coalesced call don't interfere with each other.
+    """
+    if isinstance(result, (np.ndarray, pd.core.generic.NDFrame, pd.Index)):
+        return result.copy()
+    if isinstance(result, ProtobufMessage):
+        result_copy = type(result)()
+        result_copy.CopyFrom(result)
+        return result_copy
+    if isinstance(result, tuple):
+        items = map(_copy_shared_result, result)
+        if hasattr(result, '_fields'):
+            # namedtuple
+            return type(result)(*items)
+        return tuple(items)
+    if isinstance(result, (dict, list, set)):
+        return copy.deepcopy(result)
+    return result
+
+
 def default_node_service(server, uuid, appname=DEFAULT_APPNAME, user=getpass.getuser()):
     """
     Return a DVIDNodeService for the given server and uuid.
@@ -98,20 +473,48 @@ def dvid_api_wrapper(f):
       (DVID error responses often include useful information in the response body,
       but requests doesn't normally include the error response body in the exception string.
       This fixes that.)
+    - If the response cache is enabled (see enable_dvid_response_cache()),
+      GET requests for data in locked nodes are served from the cache when possible.
+    - If single-flight is enabled (see enable_dvid_single_flight()), concurrent
+      identical calls to 'fetch' functions share a single call.
+    - If telemetry is enabled (see enable_dvid_telemetry()), each HTTP request is recorded.
     """
     argspec = inspect.getfullargspec(f)
     assert 'session' in argspec.kwonlyargs, \
         f"Cannot wrap {f.__name__}: DVID API wrappers must accept 'session' as a keyword-only argument."
 
+    # Only read-only functions may be coalesced.
+    # (Generators can't be shared among callers.)
+    coalescable = f.__name__.startswith('fetch') and not inspect.isgeneratorfunction(f)
+
     @functools.wraps(f)
     def wrapper(server, *args, session=None, **kwargs):
         assert isinstance(server, str)
         if not server.startswith('http://') and not server.startswith('https://'):
             server = 'http://' + server
 
+        single_flight = DVID_SINGLE_FLIGHT
+        if coalescable and single_flight is not None:
+            if session is None:
+                session = default_dvid_session()
+            key = _single_flight_key(f, server, args, kwargs, session)
+            if key is not None:
+                result, _joined = single_flight.run(key, _call, server, args, kwargs, session)
+                return _copy_shared_result(result)
+
+        return _call(server, args, kwargs, session)
+
+    def _call(server, args, kwargs, session):
         if session is None:
             session = default_dvid_session()
 
+        # Nested calls share the session (and therefore the telemetry) of the outermost call.
+        if DVID_TELEMETRY and not getattr(session, 'records_dvid_telemetry', False):
+            session = TelemetrySession(session, DVID_TELEMETRY, f.__name__)
+
+        if DVID_RESPONSE_CACHE is not None and not isinstance(session, CachingSession):
+            session = CachingSession(session, DVID_RESPONSE_CACHE)
+
         try:
             return f(server, *args, **kwargs, session=session)
         except requests.RequestException as ex:
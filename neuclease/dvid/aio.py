@@ -0,0 +1,475 @@
+"""
+Asynchronous (asyncio) versions of some frequently used DVID fetch functions.
+
+The functions in neuclease.dvid are all blocking, so the only way to keep
+many requests in flight at once is to use many threads (e.g. via
+compute_parallel(threads=...)).  The functions here can keep hundreds
+of requests in flight from a single thread.
+
+They accept the same arguments and return the same results as their
+counterparts in neuclease.dvid (and share the same response parsing code),
+except that they must be awaited, and they require an AsyncDvidSession.
+
+Requires aiohttp, which is not otherwise a dependency of neuclease.
+
+Example:
+
+    import asyncio
+    from neuclease.dvid import aio
+
+    async def fetch_all_sizes(server, uuid, bodies):
+        async with aio.AsyncDvidSession() as session:
+            return await aio.fetch_sizes_batched(server, uuid, 'segmentation', bodies, session=session)
+
+    sizes = asyncio.run(fetch_all_sizes('emdata4:8900', 'abc9', bodies))
+"""
+import asyncio
+import getpass
+import logging
+import functools
+from itertools import chain
+
+import ujson
+import numpy as np
+import pandas as pd
+
+try:
+    import aiohttp
+except ImportError as ex:
+    raise ImportError("neuclease.dvid.aio requires the 'aiohttp' package") from ex
+
+from ..util import iter_batches
+from ._dvid import DEFAULT_APPNAME, DVID_ADMIN_TOKEN, DVID_SESSION_SETTINGS
+from .annotation import load_elements_as_dataframe, load_synapses_as_dataframes
+from .keyvalue._keyvalue import _encode_keys, _parse_keyvalues
+from .labelmap._labelmap import _sizes_series, _mapping_result
+from .labelmap._labelindex import _parse_labelindex, _parse_labelindices
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 100
+
+
+class AsyncDvidSession:
+    """
+    Wrapper around aiohttp.ClientSession that automatically appends the
+    'u' and 'app' query string parameters to every request, just like
+    neuclease.dvid.default_dvid_session().
+
+    Must be created (and used) within a running event loop, preferably via ``async with``.
+    """
+
+    def __init__(self, appname=DEFAULT_APPNAME, user=getpass.getuser(), admintoken=DVID_ADMIN_TOKEN, *,
+                 max_connections=None, timeout=None):
+        """
+        Args:
+            appname, user, admintoken:
+                Sent as query string parameters with every request.
+            max_connections:
+                Max number of simultaneous connections (to all servers).
+                By default, DVID_SESSION_SETTINGS['pool_size'] is used.
+            timeout:
+                Optional. Total timeout for each request, in seconds.
+        """
+        self.params = { 'u': user, 'app': appname }
+        if admintoken:
+            self.params['admintoken'] = admintoken
+
+        if max_connections is None:
+            max_connections = DVID_SESSION_SETTINGS['pool_size']
+
+        connector = aiohttp.TCPConnector(limit=max_connections)
+        self.client_session = aiohttp.ClientSession(connector=connector,
+                                                    timeout=aiohttp.ClientTimeout(total=timeout))
+
+    async def close(self):
+        await self.client_session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def get(self, url, *, params=None, json=None, data=None):
+        """
+        Send a GET request and return the response body (bytes).
+
+        If the response indicates an error, an aiohttp.ClientResponseError
+        is raised, whose message includes the response body (if any),
+        since DVID error messages are often helpful.
+        """
+        params = {**self.params, **(params or {})}
+        if json is not None:
+            data = ujson.dumps(json)
+
+        async with self.client_session.get(url, params=params, data=data) as r:
+            content = await r.read()
+            if r.status >= 400:
+                MAX_ERR_DISPLAY = 10_000
+                err = content[:MAX_ERR_DISPLAY].decode('utf-8', errors='replace')
+                msg = f"Error accessing GET {r.url}\n{r.reason}\n{err}"
+                raise aiohttp.ClientResponseError(r.request_info, r.history, status=r.status,
+                                                  message=msg, headers=r.headers)
+            return content
+
+    async def get_json(self, url, *, params=None, json=None, data=None):
+        return ujson.loads(await self.get(url, params=params, json=json, data=data))
+
+
+def async_dvid_api_wrapper(f):
+    """
+    Decorator for the coroutine functions in this module, analogous to dvid_api_wrapper.
+
+    - If the server address doesn't begin with 'http://' or 'https://', it is prefixed with 'http://'
+    - If 'session' was not provided by the caller, a temporary one is created for the call.
+      (That's inefficient, so callers should create an AsyncDvidSession and pass it to every call.)
+    """
+    @functools.wraps(f)
+    async def wrapper(server, *args, session=None, **kwargs):
+        assert isinstance(server, str)
+        if not server.startswith('http://') and not server.startswith('https://'):
+            server = 'http://' + server
+
+        if session is not None:
+            return await f(server, *args, **kwargs, session=session)
+
+        async with AsyncDvidSession() as session:
+            return await f(server, *args, **kwargs, session=session)
+
+    return wrapper
+
+
+async def gather_bounded(aws, max_concurrency=DEFAULT_MAX_CONCURRENCY, return_exceptions=False):
+    """
+    Like asyncio.gather(), but at most max_concurrency of the given
+    awaitables (e.g. coroutines) are awaited at any given time.
+
+    The awaitables are pulled from the given iterable by a fixed pool of
+    max_concurrency workers, so if it's a generator, the coroutines
+    are only created as they are needed.
+
+    Returns:
+        list of results, in the same order as the given awaitables.
+    """
+    aws = enumerate(aws)
+    results = {}
+
+    async def worker():
+        for i, aw in aws:
+            try:
+                results[i] = await aw
+            except Exception as ex:
+                if not return_exceptions:
+                    raise
+                results[i] = ex
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max_concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # If one of the workers failed, stop the others.
+        for w in workers:
+            w.cancel()
+
+    return [results[i] for i in range(len(results))]
+
+
+def _labels_params(supervoxels, scale):
+    params = {}
+    if supervoxels:
+        params['supervoxels'] = str(bool(supervoxels)).lower()
+    if scale != 0:
+        params['scale'] = str(scale)
+    return params
+
+
+##
+## labelmap
+##
+
+@async_dvid_api_wrapper
+async def fetch_supervoxels(server, uuid, instance, body_id, *, session=None):
+    """
+    Fetch the list of supervoxel IDs that are associated with the given body.
+    See neuclease.dvid.fetch_supervoxels()
+    """
+    url = f'{server}/api/node/{uuid}/{instance}/supervoxels/{body_id}'
+    supervoxels = np.array(await session.get_json(url), np.uint64)
+    supervoxels.sort()
+    return supervoxels
+
+
+@async_dvid_api_wrapper
+async def fetch_supervoxels_for_bodies(server, uuid, instance, bodies, *,
+                                       max_concurrency=DEFAULT_MAX_CONCURRENCY, session=None):
+    """
+    Fetch the supervoxels for all of the bodies in the given list,
+    with many requests in flight at once.
+    See neuclease.dvid.fetch_supervoxels_for_bodies()
+
+    Returns:
+        DataFrame with columns ['sv', 'body']
+    """
+    async def fetch_body_svs(body):
+        try:
+            return await fetch_supervoxels(server, uuid, instance, body, session=session)
+        except aiohttp.ClientResponseError as ex:
+            if ex.status == 404:
+                return None
+            raise
+
+    bodies = pd.unique(np.asarray(bodies, np.uint64))
+    all_svs = await gather_bounded(map(fetch_body_svs, bodies), max_concurrency)
+
+    bad_bodies = [body for body, svs in zip(bodies, all_svs) if svs is None]
+    if bad_bodies:
+        if len(bad_bodies) < 100:
+            msg = f"Could not obtain supervoxel list for {len(bad_bodies)} bodies: {bad_bodies}"
+        else:
+            msg = f"Could not obtain supervoxel list for {len(bad_bodies)} labels."
+        logger.error(msg)
+
+    counts = [0 if svs is None else len(svs) for svs in all_svs]
+    all_svs = [svs for svs in all_svs if svs is not None]
+    return pd.DataFrame({"sv": np.concatenate([np.zeros(0, np.uint64), *all_svs]),
+                         "body": np.repeat(bodies, counts)}, dtype=np.uint64)
+
+
+@async_dvid_api_wrapper
+async def fetch_size(server, uuid, instance, label_id, supervoxels=False, *, session=None):
+    """
+    Returns the size (voxel count) of a single body (or supervoxel).
+    See neuclease.dvid.fetch_size()
+    """
+    supervoxels = str(bool(supervoxels)).lower()
+    url = f'{server}/api/node/{uuid}/{instance}/size/{label_id}'
+    response = await session.get_json(url, params={'supervoxels': supervoxels})
+    return response['voxels']
+
+
+@async_dvid_api_wrapper
+async def fetch_sizes(server, uuid, instance, label_ids, supervoxels=False, *, session=None):
+    """
+    Returns the sizes of the given bodies (or supervoxels), via a single request.
+    See neuclease.dvid.fetch_sizes()
+
+    Returns:
+        pd.Series, indexed by label ID
+    """
+    label_ids = np.asarray(label_ids, np.uint64)
+    sv_param = str(bool(supervoxels)).lower()
+    url = f'{server}/api/node/{uuid}/{instance}/sizes'
+    sizes = await session.get_json(url, params={'supervoxels': sv_param}, json=label_ids.tolist())
+    return _sizes_series(sizes, label_ids, supervoxels)
+
+
+@async_dvid_api_wrapper
+async def fetch_sizes_batched(server, uuid, instance, label_ids, supervoxels=False, *, batch_size=1000,
+                              max_concurrency=DEFAULT_MAX_CONCURRENCY, session=None):
+    """
+    Like fetch_sizes(), but split into batches, with many batches in flight at once.
+    """
+    orig_label_ids = np.asarray(label_ids, np.uint64)
+    batches = iter_batches(pd.unique(orig_label_ids), batch_size)
+    batch_sizes = await gather_bounded((fetch_sizes(server, uuid, instance, batch, supervoxels, session=session)
+                                        for batch in batches), max_concurrency)
+
+    if len(batch_sizes) == 0:
+        return _sizes_series([], orig_label_ids, supervoxels)
+
+    sizes = pd.concat(batch_sizes).reindex(orig_label_ids)
+    sizes.index.name = 'sv' if supervoxels else 'body'
+    return sizes
+
+
+@async_dvid_api_wrapper
+async def fetch_label(server, uuid, instance, coordinate_zyx, supervoxels=False, scale=0, *, session=None):
+    """
+    Fetch the label at a single coordinate.
+    See neuclease.dvid.fetch_label()
+    """
+    coord_xyz = np.array(coordinate_zyx)[::-1]
+    coord_str = '_'.join(map(str, coord_xyz))
+
+    url = f'{server}/api/node/{uuid}/{instance}/label/{coord_str}'
+    response = await session.get_json(url, params=_labels_params(supervoxels, scale))
+    return np.uint64(response["Label"])
+
+
+@async_dvid_api_wrapper
+async def fetch_labels(server, uuid, instance, coordinates_zyx, scale=0, supervoxels=False, *, session=None):
+    """
+    Fetch the labels at a list of coordinates, via a single request.
+    See neuclease.dvid.fetch_labels()
+    """
+    coordinates_zyx = np.asarray(coordinates_zyx, np.int32)
+    assert coordinates_zyx.ndim == 2 and coordinates_zyx.shape[1] == 3
+
+    coords_xyz = coordinates_zyx[:, ::-1].tolist()
+    url = f'{server}/api/node/{uuid}/{instance}/labels'
+    labels = await session.get_json(url, params=_labels_params(supervoxels, scale), json=coords_xyz)
+    return np.array(labels, np.uint64)
+
+
+@async_dvid_api_wrapper
+async def fetch_labels_batched(server, uuid, instance, coordinates_zyx, supervoxels=False, scale=0, *,
+                               batch_size=10_000, max_concurrency=DEFAULT_MAX_CONCURRENCY, session=None):
+    """
+    Like fetch_labels(), but split into batches, with many batches in flight at once.
+    Unlike neuclease.dvid.fetch_labels_batched(), the coordinates are not presorted.
+    """
+    coordinates_zyx = np.asarray(coordinates_zyx, np.int32)
+    if len(coordinates_zyx) == 0:
+        return np.zeros(0, np.uint64)
+
+    batches = iter_batches(coordinates_zyx, batch_size)
+    batch_labels = await gather_bounded((fetch_labels(server, uuid, instance, batch, scale, supervoxels, session=session)
+                                         for batch in batches), max_concurrency)
+    return np.concatenate(batch_labels)
+
+
+@async_dvid_api_wrapper
+async def fetch_mapping(server, uuid, instance, supervoxel_ids, *, as_series=False, session=None):
+    """
+    For each of the given supervoxels, ask DVID what body they belong to.
+    See neuclease.dvid.fetch_mapping()
+    """
+    supervoxel_ids = list(map(int, supervoxel_ids))
+    url = f'{server}/api/node/{uuid}/{instance}/mapping'
+    body_ids = await session.get_json(url, json=supervoxel_ids)
+    return _mapping_result(supervoxel_ids, body_ids, as_series)
+
+
+##
+## labelindex
+##
+
+@async_dvid_api_wrapper
+async def fetch_labelindex(server, uuid, instance, label, format='protobuf', *, session=None): # @ReservedAssignment
+    """
+    Fetch the LabelIndex for the given label ID.
+    See neuclease.dvid.fetch_labelindex()
+    """
+    assert format in ('protobuf', 'pandas', 'raw')
+    content = await session.get(f'{server}/api/node/{uuid}/{instance}/index/{label}')
+    if format == 'raw':
+        return content
+    return _parse_labelindex(content, format)
+
+
+@async_dvid_api_wrapper
+async def fetch_labelindices(server, uuid, instance, labels, *, format='protobuf', session=None): # @ReservedAssignment
+    """
+    Fetch a batch of label indexes via a single request.
+    See neuclease.dvid.fetch_labelindices()
+    """
+    assert format in ('protobuf', 'list-of-protobuf', 'pandas', 'single-dataframe')
+    labels = np.asarray(labels, np.uint64).tolist()
+    content = await session.get(f'{server}/api/node/{uuid}/{instance}/indices', json=labels)
+    return _parse_labelindices(content, format)
+
+
+##
+## keyvalue
+##
+
+@async_dvid_api_wrapper
+async def fetch_key(server, uuid, instance, key, as_json=False, *, session=None):
+    """
+    Fetch a single value from a keyvalue instance.
+    See neuclease.dvid.fetch_key()
+    """
+    content = await session.get(f'{server}/api/node/{uuid}/{instance}/key/{key}')
+    if as_json:
+        return ujson.loads(content)
+    return content
+
+
+@async_dvid_api_wrapper
+async def fetch_keyvalues(server, uuid, instance, keys, as_json=False, *, batch_size=None,
+                          max_concurrency=DEFAULT_MAX_CONCURRENCY, session=None):
+    """
+    Fetch a list of values from a keyvalue instance, optionally split
+    into batches (with many batches in flight at once).
+    See neuclease.dvid.fetch_keyvalues()
+
+    Returns:
+        dict of ``{ key: value }``
+    """
+    async def fetch_batch(batch_keys):
+        url = f'{server}/api/node/{uuid}/{instance}/keyvalues'
+        content = await session.get(url, data=_encode_keys(batch_keys))
+        return _parse_keyvalues(content, as_json)
+
+    keys = list(keys)
+    batch_size = batch_size or max(1, len(keys))
+    batch_kvs = await gather_bounded((fetch_batch(batch) for batch in iter_batches(keys, batch_size)), max_concurrency)
+
+    keyvalues = {}
+    for kvs in batch_kvs:
+        keyvalues.update(kvs)
+    return keyvalues
+
+
+##
+## annotation
+##
+
+@async_dvid_api_wrapper
+async def fetch_annotation_label(server, uuid, instance, label, relationships=False, *, format='json', session=None):
+    """
+    Returns all point annotations within the given label.
+    See neuclease.dvid.fetch_annotation_label()
+    """
+    assert format in ('json', 'pandas')
+    params = { 'relationships': str(bool(relationships)).lower() }
+    elements = await session.get_json(f'{server}/api/node/{uuid}/{instance}/label/{label}', params=params)
+    if format == 'json':
+        return elements
+    return load_elements_as_dataframe(elements)
+
+
+@async_dvid_api_wrapper
+async def fetch_elements(server, uuid, instance, box_zyx, *, format='json', session=None):  #@ReservedAssignment
+    """
+    Returns all point annotations within the given box.
+    See neuclease.dvid.fetch_elements()
+    """
+    assert format in ('json', 'pandas')
+    box_zyx = np.asarray(box_zyx)
+    shape = box_zyx[1] - box_zyx[0]
+
+    shape_str = '_'.join(map(str, shape[::-1]))
+    offset_str = '_'.join(map(str, box_zyx[0, ::-1]))
+
+    url = f'{server}/api/node/{uuid}/{instance}/elements/{shape_str}/{offset_str}'
+
+    # The endpoint returns 'null' instead of an empty list, on old servers at least.
+    elements = (await session.get_json(url)) or []
+    if format == 'pandas':
+        return load_elements_as_dataframe(elements)
+    return elements
+
+
+@async_dvid_api_wrapper
+async def fetch_synapses_in_boxes(server, uuid, synapses_instance, boxes_zyx, *, format='pandas',
+                                  max_concurrency=DEFAULT_MAX_CONCURRENCY, session=None):
+    """
+    Fetch the synapses in the given boxes (via the /elements endpoint),
+    with many requests in flight at once.
+
+    To fetch all synapses in a large region, divide it into boxes first,
+    e.g. via neuclease.util.boxes_from_grid().
+
+    Returns:
+        If format='json', a list of all elements.
+        If format='pandas', (point_df, partner_df), as returned by load_synapses_as_dataframes().
+    """
+    assert format in ('json', 'pandas')
+    box_elements = await gather_bounded((fetch_elements(server, uuid, synapses_instance, box, session=session)
+                                         for box in boxes_zyx), max_concurrency)
+    elements = list(chain(*box_elements))
+    if format == 'json':
+        return elements
+    return load_synapses_as_dataframes(elements)
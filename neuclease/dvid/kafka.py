@@ -249,6 +249,114 @@ def _read_complete_kafka_log(topic_name, kafka_servers, group_id=None, timeout_s
     return records
 
 
+def read_kafka_latest_offset(server, uuid, instance, kafka_servers=None, topic_prefix=None):
+    """
+    Return the offset that the next message written to the
+    kafka topic for the given DVID instance will have.
+
+    Useful for recording a position in the log before some long-running
+    operation (such as fetching the complete mapping), so that any messages
+    written during that operation can be read afterwards via tail_kafka_messages().
+    """
+    from pykafka import KafkaClient
+    kafka_servers, topic_name, _dag = kafka_info_for_dvid_instance(server, uuid, instance, kafka_servers, topic_prefix)
+    client = KafkaClient(hosts=','.join(kafka_servers))
+    topic = client.topics[topic_name.encode('utf-8')]
+
+    end_offset = 0
+    for val in topic.latest_available_offsets().values():
+        end_offset = max(val.offset[0], end_offset)
+    return end_offset
+
+
+def tail_kafka_messages(server, uuid, instance, start_offset=None, dag_filter='leaf-and-parents', poll_timeout=1.0,
+                        max_batch_size=1000, stop_event=None, stop_offset=None, kafka_servers=None, topic_prefix=None):
+    """
+    Generator.
+    Follow the kafka log for the given DVID instance indefinitely,
+    and yield new messages (in batches) as they are written.
+
+    A batch is yielded after every poll, even if it's empty,
+    so the caller has a chance to do periodic work (or stop iterating).
+
+    Args:
+        server, uuid, instance:
+            dvid instance details, which will be used to determine the kafka topic name.
+
+        start_offset:
+            The offset of the first message to yield.
+            If None, only messages written after this generator starts are yielded.
+            See read_kafka_latest_offset().
+
+        dag_filter:
+            How to filter out messages based on the UUID.
+            See read_kafka_messages()
+
+        poll_timeout:
+            How long to wait for new messages before yielding an empty batch.
+
+        max_batch_size:
+            Maximum number of messages per batch.
+
+        stop_event:
+            Optional threading.Event.  If set, the generator exits after the current poll.
+
+        stop_offset:
+            Optional.  If given, the generator exits once all messages before
+            this offset have been yielded, e.g. to "catch up" with the log
+            up to an offset obtained via read_kafka_latest_offset().
+
+    Yields:
+        Lists of (offset, msg) tuples, where msg is the parsed JSON value of each message.
+    """
+    from pykafka import KafkaClient
+    from pykafka.common import OffsetType
+
+    assert dag_filter in ('leaf-only', 'leaf-and-parents', None)
+    if stop_offset is not None and start_offset is not None and start_offset >= stop_offset:
+        return
+
+    uuid = resolve_ref(server, uuid)
+    kafka_servers, topic_name, dag = kafka_info_for_dvid_instance(server, uuid, instance, kafka_servers, topic_prefix)
+
+    logger.info(f"Following kafka topic {topic_name} from offset {start_offset}")
+    client = KafkaClient(hosts=','.join(kafka_servers))
+    topic = client.topics[topic_name.encode('utf-8')]
+    consumer = topic.get_simple_consumer( consumer_timeout_ms=int(1000*poll_timeout),
+                                          auto_commit_enable=False,
+                                          auto_offset_reset=OffsetType.LATEST,
+                                          reset_offset_on_start=True )
+
+    if start_offset is not None:
+        # pykafka's offsets refer to the last *consumed* message.
+        # (Any earlier messages that slip through are filtered out below.)
+        consumer.reset_offsets([(p, start_offset-1) for p in consumer.partitions.values()])
+
+    try:
+        finished = False
+        while not finished and (stop_event is None or not stop_event.is_set()):
+            records = []
+            record = consumer.consume(block=True)
+            while record is not None:
+                if start_offset is None or record.offset >= start_offset:
+                    records.append(record)
+                if stop_offset is not None and record.offset >= stop_offset-1:
+                    finished = True
+                    break
+                if len(records) >= max_batch_size:
+                    break
+                record = consumer.consume(block=False)
+
+            values = [ujson.loads(rec.value) for rec in records]
+            records_and_values = _filter_records_for_dag(zip(records, values), dag_filter, dag, uuid)
+            yield [(record.offset, value) for (record, value) in records_and_values]
+    finally:
+        # Avoid ReferenceError in pykafka.
+        # See comment in https://github.com/Parsely/pykafka/pull/827
+        consumer.stop()
+        time.sleep(0.1)
+
+
 def _filter_records_for_dag(records_and_values, dag_filter, dag, uuid):
     """
     Helper function.
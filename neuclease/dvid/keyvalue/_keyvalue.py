@@ -229,17 +229,31 @@ def fetch_keyvalues(server, uuid, instance, keys, as_json=False, batch_size=None
 
 @dvid_api_wrapper
 def _fetch_keyvalues_via_protobuf(server, uuid, instance, keys, as_json=False, *, use_jsontar=False, session=None):
+    r = session.get(f'{server}/api/node/{uuid}/{instance}/keyvalues', data=_encode_keys(keys))
+    r.raise_for_status()
+    return _parse_keyvalues(r.content, as_json)
+
+
+def _encode_keys(keys):
+    """
+    Encode the given keys as the protobuf request body for the /keyvalues endpoint.
+    (Also used by neuclease.dvid.aio)
+    """
     assert not isinstance(keys, str), "keys should be a list (or array) of strings"
 
     proto_keys = Keys()
     for key in keys:
         proto_keys.keys.append(key)
-    
-    r = session.get(f'{server}/api/node/{uuid}/{instance}/keyvalues', data=proto_keys.SerializeToString())
-    r.raise_for_status()
+    return proto_keys.SerializeToString()
+
 
+def _parse_keyvalues(content, as_json=False):
+    """
+    Parse the protobuf response from the /keyvalues endpoint into a dict.
+    (Also used by neuclease.dvid.aio)
+    """
     proto_keyvalues = KeyValues()
-    proto_keyvalues.ParseFromString(r.content)
+    proto_keyvalues.ParseFromString(content)
     
     try:
         keyvalues = {}
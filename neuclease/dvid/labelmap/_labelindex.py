@@ -54,8 +54,16 @@ def fetch_labelindex(server, uuid, instance, label, format='protobuf', *, sessio
     if format == 'raw':
         return r.content
 
+    return _parse_labelindex(r.content, format)
+
+
+def _parse_labelindex(content, format='protobuf'): # @ReservedAssignment
+    """
+    Parse the response from DVID's /index endpoint.
+    (Also used by neuclease.dvid.aio)
+    """
     labelindex = LabelIndex()
-    labelindex.ParseFromString(r.content)
+    labelindex.ParseFromString(content)
 
     if format == 'protobuf':
         return labelindex
@@ -90,9 +98,16 @@ def fetch_labelindices(server, uuid, instance, labels, *, format='protobuf', ses
     endpoint = f'{server}/api/node/{uuid}/{instance}/indices'
     r = session.get(endpoint, json=labels)
     r.raise_for_status()
+    return _parse_labelindices(r.content, format)
 
+
+def _parse_labelindices(content, format='protobuf'): # @ReservedAssignment
+    """
+    Parse the response from DVID's /indices endpoint.
+    (Also used by neuclease.dvid.aio)
+    """
     labelindices = LabelIndices()
-    labelindices.ParseFromString(r.content)
+    labelindices.ParseFromString(content)
     if format == 'protobuf':
         return labelindices
     if format == 'list-of-protobuf':
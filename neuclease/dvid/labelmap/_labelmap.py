@@ -372,7 +372,14 @@ def _fetch_sizes(server, uuid, instance, label_ids, supervoxels, session=None):
     sv_param = str(bool(supervoxels)).lower()
     url = f'{server}/api/node/{uuid}/{instance}/sizes?supervoxels={sv_param}'
     sizes = fetch_generic_json(url, label_ids.tolist(), session=session)
+    return _sizes_series(sizes, label_ids, supervoxels)
 
+
+def _sizes_series(sizes, label_ids, supervoxels):
+    """
+    Convert the response from DVID's /sizes endpoint into a Series.
+    (Also used by neuclease.dvid.aio)
+    """
     sizes = pd.Series(sizes, index=label_ids, name='size')
     if supervoxels:
         sizes.index.name = 'sv'
@@ -733,6 +740,14 @@ def fetch_mapping(server, uuid, instance, supervoxel_ids, *, session=None, as_se
     """
     supervoxel_ids = list(map(int, supervoxel_ids))
     body_ids = fetch_generic_json(f'{server}/api/node/{uuid}/{instance}/mapping', json=supervoxel_ids, session=session)
+    return _mapping_result(supervoxel_ids, body_ids, as_series)
+
+
+def _mapping_result(supervoxel_ids, body_ids, as_series):
+    """
+    Convert the response from DVID's /mapping endpoint into the result for fetch_mapping().
+    (Also used by neuclease.dvid.aio)
+    """
     mapping = pd.Series(body_ids, index=np.asarray(supervoxel_ids, np.uint64), dtype=np.uint64, name='body')
     mapping.index.name = 'sv'
 
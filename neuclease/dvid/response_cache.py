@@ -0,0 +1,329 @@
+"""
+Size-capped LRU cache (on local disk) for DVID GET responses from locked nodes.
+
+Data in a locked DVID node can never change, so there's no need to fetch it
+twice.  When the cache is enabled (see enable_dvid_response_cache()), every
+function decorated with dvid_api_wrapper checks the cache before sending
+a GET request for data in a locked node, and stores the response afterwards.
+
+Only requests for instance data are cached, i.e. URLs of the form
+``<server>/api/node/<uuid>/<instance>/...``, and only if the request succeeds.
+Streaming requests (stream=True) are not cached.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESPONSE_CACHE_BYTES = 10 * 2**30
+
+# How many entries to evict per transaction
+_EVICTION_BATCH_SIZE = 100
+
+# Query string parameters which identify the client, not the data.
+_IGNORED_PARAMS = ('u', 'app', 'admintoken')
+
+# Headers worth preserving in cached responses.
+_CACHED_HEADERS = ('Content-Type', 'Content-Encoding')
+
+
+class DvidResponseCache:
+    """
+    On-disk LRU cache of HTTP response bodies, limited to ``max_bytes`` in total.
+
+    Each response body is stored in its own file, named after the hash of its key.
+    An sqlite database in the same directory keeps track of the entries' sizes
+    and access times (and their total size), so the cache can be shared by
+    multiple threads and processes (and reused in subsequent runs).
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_RESPONSE_CACHE_BYTES):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._local = threading.local()
+        with self._db() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS entries "
+                       "(digest TEXT PRIMARY KEY, nbytes INTEGER, headers TEXT, last_access REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_by_access ON entries (last_access)")
+
+            # The total size of all entries, kept up-to-date by put() and _evict().
+            db.execute("CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), nbytes INTEGER)")
+            db.execute("INSERT OR IGNORE INTO total VALUES (0, (SELECT COALESCE(SUM(nbytes), 0) FROM entries))")
+
+        # For locked_uuid()
+        self._lock_status = {}
+        self._lock_status_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def _db(self):
+        # sqlite connections can't be shared between threads.
+        try:
+            return self._local.db
+        except AttributeError:
+            db = sqlite3.connect(f'{self.directory}/index.sqlite', timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+            return db
+
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        else:
+            db.execute("COMMIT")
+
+
+    def _path(self, digest):
+        return f'{self.directory}/{digest[:2]}/{digest}'
+
+
+    @classmethod
+    def digest(cls, key):
+        """
+        Return the hex digest of the given key (a tuple of str and/or bytes).
+        """
+        h = hashlib.sha256()
+        for part in key:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            h.update(len(part).to_bytes(8, 'little'))
+            h.update(part)
+        return h.hexdigest()
+
+
+    def get(self, key):
+        """
+        Return (content, headers) for the given key, or None if it isn't cached.
+        """
+        digest = self.digest(key)
+        db = self._db()
+        row = db.execute("SELECT headers FROM entries WHERE digest=?", (digest,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        try:
+            with open(self._path(digest), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            # Evicted by another process in the meantime.
+            self.misses += 1
+            return None
+
+        db.execute("UPDATE entries SET last_access=? WHERE digest=?", (time.time(), digest))
+        self.hits += 1
+        return content, json.loads(row[0])
+
+
+    def put(self, key, content, headers=None):
+        """
+        Store the given response body (and headers) under the given key,
+        and evict old entries if necessary.
+        """
+        if len(content) > self.max_bytes:
+            return
+
+        digest = self.digest(key)
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write atomically, in case another process is reading the same entry.
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        with self._transaction() as db:
+            row = db.execute("SELECT nbytes FROM entries WHERE digest=?", (digest,)).fetchone()
+            old_nbytes = row[0] if row else 0
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                       (digest, len(content), json.dumps(headers or {}), time.time()))
+            db.execute("UPDATE total SET nbytes = nbytes + ?", (len(content) - old_nbytes,))
+            total_bytes = db.execute("SELECT nbytes FROM total").fetchone()[0]
+
+        if total_bytes > self.max_bytes:
+            self._evict()
+
+
+    def _evict(self):
+        """
+        Delete the least-recently used entries until
+        the total size is no more than max_bytes.
+        """
+        while True:
+            with self._transaction() as db:
+                total_bytes = db.execute("SELECT nbytes FROM total").fetchone()[0]
+                if total_bytes <= self.max_bytes:
+                    return
+
+                rows = db.execute("SELECT digest, nbytes FROM entries ORDER BY last_access LIMIT ?",
+                                  (_EVICTION_BATCH_SIZE,)).fetchall()
+                if not rows:
+                    return
+
+                evicted_bytes = 0
+                for digest, nbytes in rows:
+                    db.execute("DELETE FROM entries WHERE digest=?", (digest,))
+                    try:
+                        os.unlink(self._path(digest))
+                    except FileNotFoundError:
+                        pass
+
+                    evicted_bytes += nbytes
+                    if total_bytes - evicted_bytes <= self.max_bytes:
+                        break
+
+                db.execute("UPDATE total SET nbytes = nbytes - ?", (evicted_bytes,))
+
+
+    @property
+    def total_bytes(self):
+        return self._db().execute("SELECT nbytes FROM total").fetchone()[0]
+
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+    def clear(self):
+        with self._transaction() as db:
+            for (digest,) in db.execute("SELECT digest FROM entries").fetchall():
+                try:
+                    os.unlink(self._path(digest))
+                except FileNotFoundError:
+                    pass
+            db.execute("DELETE FROM entries")
+            db.execute("UPDATE total SET nbytes = 0")
+
+
+    def locked_uuid(self, server, uuid):
+        """
+        If the given node is locked, return its full UUID.
+        Otherwise (or if the UUID can't be resolved), return None.
+
+        Locked nodes stay locked, so that answer is remembered indefinitely,
+        but unlocked nodes are checked again (at most once per minute).
+        """
+        with self._lock_status_lock:
+            full_uuid, checked = self._lock_status.get((server, uuid), (None, 0.0))
+        if full_uuid or time.time() - checked < 60.0:
+            return full_uuid
+
+        from .repo import fetch_repo_info, expand_uuid
+        try:
+            repo_info = fetch_repo_info(server, uuid)
+            full_uuid = expand_uuid(server, uuid, repo_info=repo_info)
+            if not repo_info['DAG']['Nodes'][full_uuid]['Locked']:
+                full_uuid = None
+        except (RuntimeError, KeyError, requests.HTTPError) as ex:
+            # E.g. an ambiguous UUID prefix or a branch name.
+            # The request itself may still succeed; it just won't be cached.
+            logger.debug(f"Can't determine whether node '{uuid}' is locked: {ex}")
+            full_uuid = None
+
+        with self._lock_status_lock:
+            self._lock_status[(server, uuid)] = (full_uuid, time.time())
+        return full_uuid
+
+
+    def request_key(self, url, params=None, json_body=None, data=None):
+        """
+        Return the cache key for the given GET request,
+        or None if the request shouldn't be cached,
+        i.e. if it isn't for instance data in a locked node.
+        """
+        parts = urlsplit(url)
+        path = parts.path.split('/')
+
+        # ['', 'api', 'node', uuid, instance, endpoint, ...]
+        if len(path) < 6 or path[1:3] != ['api', 'node']:
+            return None
+
+        if not isinstance(data, (type(None), bytes, str)):
+            return None
+
+        server = f'{parts.scheme}://{parts.netloc}'
+        full_uuid = self.locked_uuid(server, path[3])
+        if full_uuid is None:
+            return None
+
+        all_params = parse_qsl(parts.query)
+        if isinstance(params, dict):
+            all_params += [(k, v) for k, v in params.items() if v is not None]
+        elif params:
+            all_params += list(params)
+
+        all_params = sorted((str(k), str(v)) for k,v in all_params if k not in _IGNORED_PARAMS)
+
+        body = data or b''
+        if json_body is not None:
+            body = json.dumps(json_body, sort_keys=True)
+
+        return (server, full_uuid, '/'.join(path[4:]), json.dumps(all_params), body)
+
+
+class CachingSession:
+    """
+    Wraps a requests.Session, and serves GET requests from the given
+    DvidResponseCache (or stores their responses) whenever possible.
+    All other attributes and methods are passed through to the wrapped session.
+    """
+
+    def __init__(self, session, cache):
+        self.session = session
+        self.cache = cache
+
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+    def get(self, url, params=None, **kwargs):
+        key = None
+        if not kwargs.get('stream', False):
+            key = self.cache.request_key(url, params, kwargs.get('json'), kwargs.get('data'))
+
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                content, headers = cached
+                return _cached_response(url, content, headers)
+
+        r = self.session.get(url, params=params, **kwargs)
+        if key is not None and r.status_code == 200:
+            headers = {k: r.headers[k] for k in _CACHED_HEADERS if k in r.headers}
+            self.cache.put(key, r.content, headers)
+        return r
+
+
+def _cached_response(url, content, headers):
+    r = requests.Response()
+    r.status_code = 200
+    r.reason = 'OK'
+    r.url = url
+    r.headers = CaseInsensitiveDict(headers)
+    r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+    r._content = content
+    r._content_consumed = True
+    return r
@@ -0,0 +1,222 @@
+"""
+In-process telemetry for the HTTP requests sent to DVID.
+
+When telemetry is enabled (see enable_dvid_telemetry() and dvid_telemetry()),
+every function decorated with dvid_api_wrapper records each request it sends:
+the calling function, the HTTP method, the endpoint (with the UUID, instance
+name, and other variable parts of the URL replaced by placeholders),
+the response status, the latency, and the request and response sizes.
+
+Example:
+
+    >>> with dvid_telemetry('my-job-requests.csv') as telemetry:
+    ...     do_work()
+    >>> print(telemetry.summary(top=10))
+"""
+import re
+import time
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_MAX_TELEMETRY_RECORDS = 1_000_000
+
+TELEMETRY_COLUMNS = ['timestamp', 'function', 'method', 'endpoint', 'status',
+                     'seconds', 'request_bytes', 'response_bytes']
+
+SUMMARY_COLUMNS = ['method', 'endpoint', 'count', 'errors', 'total_seconds',
+                   'p50_seconds', 'p95_seconds', 'p99_seconds', 'request_bytes', 'response_bytes']
+
+# URL path segments like '123' or '0_64_128'
+_ID_PATTERN = re.compile(r'^-?\d+$')
+_COORD_PATTERN = re.compile(r'^-?\d+(_-?\d+)+$')
+
+# Endpoints whose arguments are arbitrary (user-defined) strings.
+_KEY_ENDPOINTS = ('key', 'keyrange', 'tag')
+
+
+class DvidTelemetry:
+    """
+    Thread-safe registry of DVID request records.
+
+    Only the most recent ``max_records`` records are kept,
+    so it's safe to leave telemetry enabled in long-running processes.
+    """
+
+    def __init__(self, max_records=DEFAULT_MAX_TELEMETRY_RECORDS):
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+
+    def record(self, function, method, endpoint, status, seconds, request_bytes, response_bytes):
+        """
+        Add a record.  The status should be 0 if no response was received.
+        """
+        with self._lock:
+            self._records.append((time.time(), function, method, endpoint, status,
+                                  seconds, request_bytes, response_bytes))
+
+
+    def __len__(self):
+        return len(self._records)
+
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+    def to_dataframe(self):
+        """
+        Return all records as a DataFrame, with columns TELEMETRY_COLUMNS.
+        """
+        with self._lock:
+            records = list(self._records)
+        df = pd.DataFrame(records, columns=TELEMETRY_COLUMNS)
+        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+        return df
+
+
+    def summary(self, top=None):
+        """
+        Summarize the records for each endpoint, sorted by the total time spent.
+
+        Args:
+            top:
+                If given, return only this many endpoints.
+
+        Returns:
+            DataFrame with columns SUMMARY_COLUMNS.
+            Errors include responses with status >= 400 and failed connections (status 0).
+        """
+        df = self.to_dataframe()
+
+        rows = []
+        for (method, endpoint), group_df in df.groupby(['method', 'endpoint'], sort=False):
+            seconds = group_df['seconds'].values
+            p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+            errors = ((group_df['status'] == 0) | (group_df['status'] >= 400)).sum()
+            rows.append((method, endpoint, len(group_df), errors, seconds.sum(), p50, p95, p99,
+                         group_df['request_bytes'].sum(), group_df['response_bytes'].sum()))
+
+        summary_df = pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+        summary_df = summary_df.sort_values('total_seconds', ascending=False, ignore_index=True)
+        if top is not None:
+            summary_df = summary_df.iloc[:top]
+        return summary_df
+
+
+    def to_csv(self, path, summary=False):
+        """
+        Write all records (or the summary) to a CSV file.
+        """
+        if summary:
+            df = self.summary()
+        else:
+            df = self.to_dataframe()
+        df.to_csv(path, index=False, header=True)
+
+
+def endpoint_template(url):
+    """
+    Return the path of the given URL, with the variable parts replaced by placeholders,
+    so that requests for the same endpoint can be grouped together.
+
+    Example:
+
+        >>> endpoint_template('http://emdata:8000/api/node/abc123/segmentation/sparsevol/123?format=rles')
+        '/api/node/{uuid}/{instance}/sparsevol/{id}'
+    """
+    path = urlsplit(url).path.split('/')
+
+    # ['', 'api', 'node', uuid, instance, endpoint, ...]
+    start = 1
+    if path[1:3] in (['api', 'node'], ['api', 'repo']) and len(path) > 3:
+        path[3] = '{uuid}'
+        start = 4
+        if path[2] == 'node' and len(path) > 4:
+            path[4] = '{instance}'
+            start = 5
+
+    for i in range(start, len(path)):
+        if i == start+1 and path[start] in _KEY_ENDPOINTS:
+            path[i] = '{key}'
+        elif _ID_PATTERN.match(path[i]):
+            path[i] = '{id}'
+        elif _COORD_PATTERN.match(path[i]):
+            path[i] = '{coord}'
+
+    return '/'.join(path)
+
+
+class TelemetrySession:
+    """
+    Wraps a requests.Session, and records every request it sends
+    to the given DvidTelemetry registries.
+    All other attributes and methods are passed through to the wrapped session.
+    """
+
+    # Indicates that a session (or a session which wraps it) already records telemetry.
+    records_dvid_telemetry = True
+
+    def __init__(self, session, registries, function):
+        self.session = session
+        self.registries = registries
+        self.function = function
+
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+    def get(self, url, *args, **kwargs):
+        return self._send('GET', self.session.get, url, *args, **kwargs)
+
+
+    def head(self, url, *args, **kwargs):
+        return self._send('HEAD', self.session.head, url, *args, **kwargs)
+
+
+    def post(self, url, *args, **kwargs):
+        return self._send('POST', self.session.post, url, *args, **kwargs)
+
+
+    def put(self, url, *args, **kwargs):
+        return self._send('PUT', self.session.put, url, *args, **kwargs)
+
+
+    def delete(self, url, *args, **kwargs):
+        return self._send('DELETE', self.session.delete, url, *args, **kwargs)
+
+
+    def _send(self, method, send, url, *args, **kwargs):
+        r = None
+        start = time.perf_counter()
+        try:
+            r = send(url, *args, **kwargs)
+            return r
+        finally:
+            seconds = time.perf_counter() - start
+            status, request_bytes, response_bytes = 0, 0, 0
+            if r is not None:
+                status = r.status_code
+                request_bytes = _body_size(getattr(r.request, 'body', None))
+                if kwargs.get('stream', False):
+                    response_bytes = int(r.headers.get('Content-Length', 0))
+                else:
+                    response_bytes = len(r.content or b'')
+
+            endpoint = endpoint_template(url)
+            for registry in self.registries:
+                registry.record(self.function, method, endpoint, status, seconds, request_bytes, response_bytes)
+
+
+def _body_size(body):
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return len(body)
+    return 0
@@ -0,0 +1,192 @@
+"""
+Memory-budgeted LRU cache for the per-body edges extracted by LabelmapMergeGraph.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+DEFAULT_EDGE_CACHE_BYTES = 4 * 2**30
+
+
+class EdgeCache:
+    """
+    LRU cache of per-body edge tables.
+
+    Keys are tuples whose last element is a body ID, e.g. (server, uuid, instance, body_id).
+    Values are tuples whose first element is the body's mutation ID, e.g. (mutid, supervoxels, edges, scores, cleave_graph).
+
+    Entries are evicted (least-recently-used first) when the total size of
+    their arrays exceeds ``max_bytes``, rather than after a fixed number of
+    entries, since a single large body can account for millions of edges.
+
+    The cache also provides a per-key lock (see key_lock()), which is discarded
+    as soon as no thread holds it (or is waiting for it).
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_EDGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict() # key -> (nbytes, value)
+        self._key_locks = {}          # key -> [lock, num_users]
+
+        # Protects all of the above (and below)
+        self._lock = threading.Lock()
+
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    @contextmanager
+    def key_lock(self, key):
+        """
+        Context manager.
+        Hold a lock which is unique to the given key.
+        """
+        with self._lock:
+            lock_and_users = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            lock_and_users[1] += 1
+        try:
+            with lock_and_users[0]:
+                yield
+        finally:
+            with self._lock:
+                lock_and_users[1] -= 1
+                if lock_and_users[1] == 0:
+                    del self._key_locks[key]
+
+
+    def get(self, key, mutid=None, count=True):
+        """
+        Return the cached value for the given key, or None if it isn't cached.
+        If a mutation ID is given, a cached value with a different mutation
+        ID is considered stale: it is dropped and None is returned.
+        If count=False, the lookup isn't counted in the hits/misses stats
+        (e.g. for lookups made on behalf of the background prefetcher).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and mutid is not None and entry[1][0] != mutid:
+                self._drop(key)
+                entry = None
+
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+
+    def put(self, key, value):
+        """
+        Cache the given value, evicting the least-recently-used entries as
+        needed to stay within the budget.  Values which are larger than the
+        entire budget are not cached.
+        """
+        nbytes = _value_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+
+            if nbytes > self.max_bytes:
+                return
+
+            self._entries[key] = (nbytes, value)
+            self.total_bytes += nbytes
+
+            while self.total_bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+
+    def invalidate_bodies(self, bodies, mutid=None):
+        """
+        Drop the cached entries for the given bodies (for any server/uuid/instance).
+        If a mutation ID is given, only entries for older mutations are dropped.
+
+        Returns:
+            The number of dropped entries.
+        """
+        bodies = set(map(int, bodies))
+        with self._lock:
+            stale_keys = [key for key, (_nbytes, value) in self._entries.items()
+                          if int(key[-1]) in bodies and (mutid is None or value[0] < mutid)]
+            for key in stale_keys:
+                self._drop(key)
+            self.invalidations += len(stale_keys)
+        return len(stale_keys)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+
+    def stats(self):
+        """
+        Return a dict of cache statistics, to help with choosing ``max_bytes``.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max-bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'key-locks': len(self._key_locks)
+            }
+
+
+    def _drop(self, key):
+        nbytes, _value = self._entries.pop(key)
+        self.total_bytes -= nbytes
+
+
+def _value_nbytes(value, _counted=None):
+    """
+    Total size of the arrays in the given tuple (including nested tuples).
+
+    Arrays which share memory with an array that was already counted
+    (i.e. the same array, or another view of the same base array)
+    are not counted again.  For example, the cleave graph shares some
+    of its arrays with the edges and supervoxels in the same entry.
+    A view is counted as the size of its base array, which it keeps alive.
+    """
+    if _counted is None:
+        _counted = set()
+
+    if isinstance(value, tuple):
+        return sum(_value_nbytes(v, _counted) for v in value)
+
+    if not isinstance(value, np.ndarray):
+        return np.asarray(value).nbytes
+
+    owner = value if value.base is None else value.base
+    if id(owner) in _counted:
+        return 0
+    _counted.add(id(owner))
+
+    if isinstance(owner, np.ndarray):
+        return owner.nbytes
+    return value.nbytes
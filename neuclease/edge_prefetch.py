@@ -0,0 +1,184 @@
+"""
+Background prefetching of body edges, to warm a LabelmapMergeGraph's edge cache.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from requests import HTTPError
+
+logger = logging.getLogger(__name__)
+
+
+class EdgePrefetcher:
+    """
+    Background threads which call LabelmapMergeGraph.extract_edges() for
+    bodies that proofreaders are likely to cleave soon, so that their first
+    cleave request is (usually) a cache hit.
+
+    Candidate bodies are supplied via enqueue(), e.g. by
+    LabelmapMergeGraph.apply_kafka_msgs() for recently edited bodies.
+    The most recently enqueued bodies are prefetched first, and only the
+    ``max_pending`` most recent candidates are kept.
+
+    The edges are fetched from the same dvid server/uuid/instance that clients
+    most recently requested (see note_request()), so the cache keys match.
+    Until the first request arrives, nothing is prefetched.
+    The ``max_pending`` most recently requested bodies are remembered, too.
+    When clients switch to a different server/uuid/instance, their cached edges
+    no longer match, so those bodies are enqueued to be prefetched again.
+
+    Prefetching is recorded separately from client requests:
+    it doesn't count toward the edge cache's hit/miss stats, and its timings
+    are recorded in PREFETCH_STAGE_SECONDS (see LabelmapMergeGraph.extract_edges()).
+
+    To limit the load on this server (and on DVID), at most ``num_threads`` bodies
+    are prefetched at once, and each thread waits ``min_interval`` seconds between bodies.
+    """
+
+    def __init__(self, merge_graph, num_threads=1, min_interval=1.0, max_pending=100, find_missing=True):
+        self.merge_graph = merge_graph
+        self.num_threads = num_threads
+        self.min_interval = min_interval
+        self.max_pending = max_pending
+        self.find_missing = find_missing
+
+        self._instance_info = None
+        self._pending = OrderedDict()
+        self._recent_requests = OrderedDict()
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._threads = []
+
+        self.prefetched = 0
+        self.skipped = 0
+        self.failed = 0
+        self.dropped = 0
+
+
+    def note_request(self, server, uuid, instance, body_id):
+        """
+        Record the dvid instance that clients are currently requesting edges from,
+        and the body they requested.
+        """
+        body_id = int(body_id)
+        instance_info = (server, uuid, instance)
+        with self._condition:
+            if self._instance_info is not None and instance_info != self._instance_info:
+                # The recently requested bodies were cached under the old
+                # instance info, so they'll be cache misses from now on.
+                self._enqueue(self._recent_requests.keys())
+            self._instance_info = instance_info
+
+            self._recent_requests.pop(body_id, None)
+            self._recent_requests[body_id] = True
+            while len(self._recent_requests) > self.max_pending:
+                self._recent_requests.popitem(last=False)
+
+            # No need to prefetch a body that was just requested.
+            self._pending.pop(body_id, None)
+            self._condition.notify_all()
+
+
+    def enqueue(self, bodies):
+        """
+        Add the given bodies to the front of the prefetch queue.
+        """
+        with self._condition:
+            self._enqueue(bodies)
+            self._condition.notify_all()
+
+
+    def _enqueue(self, bodies):
+        """
+        Helper for enqueue() and note_request().
+        The caller must hold the lock.
+        """
+        for body in bodies:
+            body = int(body)
+            if body == 0:
+                continue
+            self._pending.pop(body, None)
+            self._pending[body] = True
+
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+
+
+    def start(self):
+        assert not self._threads, "Already started"
+        self._stop_event.clear()
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._run, name=f'edge-prefetch-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    def stop(self):
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+    def stats(self):
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'prefetched': self.prefetched,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'dropped': self.dropped
+            }
+
+
+    def _next_body(self):
+        """
+        Wait for a body to prefetch.
+
+        Returns:
+            (body, instance_info), or (None, None) if the prefetcher has been stopped.
+        """
+        with self._condition:
+            while not self._stop_event.is_set():
+                if self._pending and self._instance_info is not None:
+                    body, _ = self._pending.popitem(last=True)
+                    return body, self._instance_info
+                self._condition.wait(1.0)
+        return None, None
+
+
+    def _count(self, name):
+        with self._condition:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+    def _run(self):
+        while True:
+            body, instance_info = self._next_body()
+            if body is None:
+                return
+
+            key = (*instance_info, np.uint64(body))
+            if key in self.merge_graph._edge_cache:
+                # Already cached. (If it had been made stale by a mutation,
+                # apply_kafka_msgs() would have dropped it.)
+                self._count('skipped')
+                continue
+
+            try:
+                self.merge_graph.extract_edges(*key, find_missing=self.find_missing, prefetch=True)
+                self._count('prefetched')
+            except HTTPError as ex:
+                # Most likely, the body no longer exists.
+                logger.debug(f"Failed to prefetch edges for body {body}: {ex}")
+                self._count('failed')
+            except Exception:
+                logger.error(f"Failed to prefetch edges for body {body}", exc_info=True)
+                self._count('failed')
+
+            self._stop_event.wait(self.min_interval)
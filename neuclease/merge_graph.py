@@ -1,20 +1,31 @@
 import os
+import json
 import logging
 import threading
-from collections import defaultdict
+from datetime import datetime
 from contextlib import contextmanager
 
 import numpy as np
 import pandas as pd
 
-from .util import Timer
-from .dvid import fetch_repo_info, fetch_supervoxels, fetch_labels, fetch_complete_mappings, fetch_mutation_id, fetch_supervoxel_splits, fetch_supervoxel_splits_from_kafka
+from requests import HTTPError
+
+from .util import Timer, SortedRowIndex, ArrayOverlay, dump_json
+from .rwlock import ReadWriteLock
+from .edge_cache import EdgeCache, DEFAULT_EDGE_CACHE_BYTES
+from .metrics import CLEAVE_STAGE_SECONDS, PREFETCH_STAGE_SECONDS
+from .dvid import (fetch_repo_info, fetch_supervoxels, fetch_labels, fetch_labels_batched, fetch_complete_mappings, fetch_mutation_id,
+                   fetch_supervoxel_splits, fetch_supervoxel_splits_from_kafka, labelmap_kafka_msgs_to_df,
+                   read_kafka_latest_offset, tail_kafka_messages)
 from .merge_table import MERGE_TABLE_DTYPE, load_mapping, load_merge_table, normalize_merge_table, apply_mapping_to_mergetable
 from .focused.ingest import fetch_focused_decisions
 from .adjacency import find_missing_adjacencies
+from .cleave import prepare_cleave_graph
 
 _logger = logging.getLogger(__name__)
 
+DEFAULT_COMPACTION_THRESHOLD = 1_000_000
+
 
 @contextmanager
 def dummy_lock():
@@ -33,7 +44,7 @@ class LabelmapMergeGraph:
     dynamically-queried supervoxel members.
     """
         
-    def __init__(self, table=None, primary_uuid=None, debug_export_dir=None, no_kafka=False):
+    def __init__(self, table=None, primary_uuid=None, debug_export_dir=None, no_kafka=False, edge_cache_bytes=DEFAULT_EDGE_CACHE_BYTES):
         """
         Constructor.
         
@@ -55,6 +66,9 @@ class LabelmapMergeGraph:
             no_kafka:
                 Only used for unit-testing purposes, when no kafka server is available.
                 Disables fetching of split supervoxel information entirely!
+
+            edge_cache_bytes:
+                Memory budget for the cache of extracted edges (see extract_edges()).
         """
         self.primary_uuid = None
         self.set_primary_uuid(primary_uuid)
@@ -81,17 +95,52 @@ class LabelmapMergeGraph:
         assert list(self.merge_table_df.columns)[:9] == list(dict(MERGE_TABLE_DTYPE).keys())[:9]
         
         self._mapping_versions = {}
+
+        # CSR-style indexes for fast per-body lookups, so we don't have to scan
+        # the whole merge table (or mapping) for each request.
+        # Built in apply_mapping() and updated (via their deltas) when edges are appended
+        # or the mapping changes.  See compact().
+        self._body_index = None     # merge table rows, by body
+        self._mapping_index = None  # mapping entries, by body
+        self._sv_index = None       # merge table rows, by id_a (see extract_rows_by_sv())
+
+        # Supervoxels which were added to the mapping (by supervoxel splits) since it was loaded.
+        # Inserting them into the (sorted) mapping would require copying it, so they're
+        # kept here instead (in the order they were added) until the next compact().
+        # In the mapping index, they're listed as rows len(mapping), len(mapping)+1, etc.
+        self._extra_mapping_svs = np.zeros(0, np.uint64)
+        self._extra_mapping_bodies = np.zeros(0, np.uint64)
+        self._extra_mapping_sorter = np.zeros(0, np.int64)
+
+        # If the 'body' column and the mapping are shared with other processes
+        # (see load_snapshot(shared=True)), they aren't modified.  Changes are
+        # recorded in these overlays instead.  Otherwise, they're modified in-place.
+        self._body_overlay = None
+        self._mapping_overlay = None
+
+        # When the indexes' deltas (and the extra mapping entries) grow larger than this,
+        # apply_kafka_msgs() folds them into new arrays via compact().
+        # If None, they're never compacted automatically.
+        self.compaction_threshold = DEFAULT_COMPACTION_THRESHOLD
+        self._update_count = 0
+
+        # Protects the merge table 'body' column, the mapping, and the above
+        # indexes while they are being updated from the kafka log.
+        # (See apply_kafka_msgs() and start_kafka_updates())
+        self._rwlock = ReadWriteLock()
+        self._kafka_thread = None
+        self._kafka_stop_event = None
+        self.kafka_offset = None
+        self.last_mutid = None
         
-        self._edge_cache = {}
-        
-        # This lock protects the above cache
-        self._edge_cache_main_lock = threading.Lock()
-        
-        # This dict holds a lock for each body, to avoid requesting edges for the same body in parallel,
+        # Extracted edges for recently requested bodies.
+        # Also provides a lock for each body, to avoid requesting edges for the same body in parallel,
         # (but requesting edges for different bodies in parallel is OK).
-        self._edge_cache_key_locks = defaultdict(lambda: threading.Lock())
-        
-        self.max_cache_len = 1000
+        self._edge_cache = EdgeCache(edge_cache_bytes)
+
+        # Optional neuclease.edge_prefetch.EdgePrefetcher, which is notified
+        # of bodies that were edited (see apply_kafka_msgs())
+        self.prefetcher = None
 
 
     def set_primary_uuid(self, primary_uuid):
@@ -102,8 +151,194 @@ class LabelmapMergeGraph:
     def apply_mapping(self, mapping):
         if isinstance(mapping, str):
             mapping = load_mapping(mapping)
-        apply_mapping_to_mergetable(self.merge_table_df, mapping)
-        self.mapping = mapping
+
+        # We keep the mapping sorted by supervoxel, so supervoxels
+        # can be located via searchsorted() (see _lookup_bodies()).
+        if not mapping.index.is_monotonic_increasing:
+            mapping = mapping.sort_index()
+
+        with self._rwlock.context(write=True):
+            apply_mapping_to_mergetable(self.merge_table_df, mapping)
+            self.mapping = mapping
+            self._clear_overlays()
+            self._rebuild_indexes()
+
+
+    def _rebuild_indexes(self):
+        with Timer("Indexing merge table and mapping by body", _logger):
+            self._body_index = SortedRowIndex(self.merge_table_df['body'].values)
+            self._mapping_index = SortedRowIndex(self.mapping.values)
+
+        # The edges themselves don't depend on the mapping,
+        # so this index is only built once (and then kept up-to-date).
+        if self._sv_index is None:
+            self._build_sv_index()
+
+
+    def _build_sv_index(self):
+        with Timer("Indexing merge table by supervoxel", _logger):
+            self._sv_index = SortedRowIndex(self.merge_table_df['id_a'].values)
+
+
+    def _clear_overlays(self):
+        self._extra_mapping_svs = np.zeros(0, np.uint64)
+        self._extra_mapping_bodies = np.zeros(0, np.uint64)
+        self._extra_mapping_sorter = np.zeros(0, np.int64)
+        self._body_overlay = None
+        self._mapping_overlay = None
+
+
+    SNAPSHOT_FORMAT_VERSION = 1
+
+    def save_snapshot(self, snapshot_dir):
+        """
+        Save the merge table, mapping, and indexes of this (fully initialized)
+        merge graph to a directory of .npy files (one per column), plus a
+        'snapshot-info.json' file with the metadata needed to bring a restored
+        merge graph up-to-date (see load_snapshot() and replay_kafka_updates()):
+
+            - uuid: The primary UUID
+            - kafka-offset: The kafka offset of the first mutation which
+                            is not reflected in the mapping (if known)
+            - last-mutid: The most recent mutation ID applied to the mapping (if known)
+
+        Note:
+            To ensure that no mutations are missed when the snapshot is restored,
+            set ``self.kafka_offset`` before the mapping is fetched.
+            See read_kafka_latest_offset().
+        """
+        assert self._body_index is not None, \
+            "Can't save a snapshot of a merge graph whose mapping hasn't been applied yet."
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+        with Timer(f"Saving merge graph snapshot to {snapshot_dir}", _logger), \
+             self._rwlock.context(write=False):
+
+            mapping, body_column, *indexes = self._compacted_state()
+
+            for col in self.merge_table_df.columns:
+                values = (body_column if col == 'body' else self.merge_table_df[col].values)
+                np.save(f'{snapshot_dir}/merge-table-{col}.npy', values)
+
+            np.save(f'{snapshot_dir}/mapping-sv.npy', mapping.index.values)
+            np.save(f'{snapshot_dir}/mapping-body.npy', mapping.values)
+
+            for name, index in zip(('body', 'mapping', 'sv'), indexes):
+                np.save(f'{snapshot_dir}/index-{name}-order.npy', index.order)
+                np.save(f'{snapshot_dir}/index-{name}-keys.npy', index.keys)
+                np.save(f'{snapshot_dir}/index-{name}-offsets.npy', index.offsets)
+
+            info = {
+                'format-version': self.SNAPSHOT_FORMAT_VERSION,
+                'timestamp': str(datetime.now()),
+                'uuid': self.primary_uuid,
+                'kafka-offset': self.kafka_offset,
+                'last-mutid': self.last_mutid,
+                'merge-table-columns': list(self.merge_table_df.columns),
+                'merge-table-rows': len(self.merge_table_df),
+                'mapping-size': len(mapping)
+            }
+
+            # Written last, so a directory without it is clearly incomplete.
+            dump_json(info, f'{snapshot_dir}/snapshot-info.json')
+
+
+    @classmethod
+    def load_snapshot(cls, snapshot_dir, debug_export_dir=None, no_kafka=False, edge_cache_bytes=DEFAULT_EDGE_CACHE_BYTES,
+                      shared=False):
+        """
+        Restore a merge graph that was saved via save_snapshot().
+
+        The merge table columns (other than 'body') and the indexes are never modified,
+        so they are memory-mapped rather than read.  Hence, restoring
+        takes roughly as long as reading the mapping from disk.
+
+        If shared=True, the 'body' column and the mapping are memory-mapped (read-only), too.
+        Subsequent updates (e.g. via apply_kafka_msgs()) are recorded in small overlays
+        instead, and are never compacted.  That way, processes which are forked from this
+        one can share a single copy of the merge graph, and each process only needs
+        private memory for the updates it applies itself.
+
+        The restored merge graph reflects the state of the mapping when
+        the snapshot was saved. Use replay_kafka_updates() to bring it up-to-date.
+        """
+        with Timer(f"Loading merge graph snapshot from {snapshot_dir}", _logger):
+            with open(f'{snapshot_dir}/snapshot-info.json', 'r') as f:
+                info = json.load(f)
+
+            assert info['format-version'] == cls.SNAPSHOT_FORMAT_VERSION, \
+                f"Unsupported snapshot format version: {info['format-version']}"
+
+            # Writable (private) copies of the 'body' column and the mapping, unless they're shared.
+            mutable_mmap_mode = ('r' if shared else None)
+
+            columns = {}
+            for col in info['merge-table-columns']:
+                mmap_mode = (mutable_mmap_mode if col == 'body' else 'r')
+                columns[col] = np.load(f'{snapshot_dir}/merge-table-{col}.npy', mmap_mode=mmap_mode)
+            merge_table_df = pd.DataFrame(columns, copy=False)
+            assert len(merge_table_df) == info['merge-table-rows']
+
+            merge_graph = cls(merge_table_df, info['uuid'], debug_export_dir, no_kafka, edge_cache_bytes)
+
+            mapping_svs = np.load(f'{snapshot_dir}/mapping-sv.npy', mmap_mode=mutable_mmap_mode)
+            mapping = pd.Series(np.load(f'{snapshot_dir}/mapping-body.npy', mmap_mode=mutable_mmap_mode),
+                                index=pd.Index(mapping_svs, name='sv', copy=False),
+                                name='body', copy=False)
+            assert len(mapping) == info['mapping-size']
+            merge_graph.mapping = mapping
+
+            indexes = []
+            for name in ('body', 'mapping', 'sv'):
+                indexes.append(SortedRowIndex.from_arrays(
+                    np.load(f'{snapshot_dir}/index-{name}-order.npy', mmap_mode='r'),
+                    np.load(f'{snapshot_dir}/index-{name}-keys.npy', mmap_mode='r'),
+                    np.load(f'{snapshot_dir}/index-{name}-offsets.npy', mmap_mode='r')))
+            merge_graph._body_index, merge_graph._mapping_index, merge_graph._sv_index = indexes
+
+            if shared:
+                merge_graph._body_overlay = ArrayOverlay(np.uint64)
+                merge_graph._mapping_overlay = ArrayOverlay(np.uint64)
+                merge_graph.compaction_threshold = None
+
+            merge_graph.kafka_offset = info['kafka-offset']
+            merge_graph.last_mutid = info['last-mutid']
+
+        _logger.info(f"Restored merge graph snapshot from {info['timestamp']} "
+                     f"(uuid: {info['uuid']}, kafka offset: {info['kafka-offset']}, mutation ID: {info['last-mutid']})")
+        return merge_graph
+
+
+    def replay_kafka_updates(self, server, uuid, instance, start_offset=None):
+        """
+        Apply all mutations in the kafka log from the given offset up to the
+        current end of the log, e.g. to bring a restored snapshot up-to-date.
+        Unlike start_kafka_updates(), this function blocks until it's finished.
+
+        Args:
+            server, uuid, instance:
+                The labelmap instance whose mutations should be applied.
+
+            start_offset:
+                The kafka offset to start from.
+                If not provided, self.kafka_offset is used.
+
+        Returns:
+            The number of mutations applied.
+        """
+        start_offset = start_offset if start_offset is not None else self.kafka_offset
+        assert start_offset is not None, "Don't know where to start replaying the kafka log from."
+
+        stop_offset = read_kafka_latest_offset(server, uuid, instance)
+        num_applied = 0
+        with Timer(f"Replaying kafka log from offset {start_offset} to {stop_offset}", _logger):
+            for batch in tail_kafka_messages(server, uuid, instance, start_offset, stop_offset=stop_offset):
+                if batch:
+                    num_applied += self.apply_kafka_msgs([msg for (_offset, msg) in batch], server, instance)
+
+        self.kafka_offset = max(start_offset, stop_offset)
+        _logger.info(f"Applied {num_applied} mutations from the kafka log")
+        return num_applied
 
 
     def fetch_and_apply_mapping(self, server, uuid, instance, kafka_msgs=None):
@@ -114,7 +349,30 @@ class LabelmapMergeGraph:
         self.apply_mapping(mapping)
 
 
-    def append_edges_for_focused_merges(self, server, uuid, focused_decisions_instance):
+    @staticmethod
+    def fetch_focused_merges(server, uuid, focused_decisions_instance):
+        """
+        Read the proofreading focused merge decisions from a keyvalue
+        instance (stored as individual JSON values), and return
+        the merges as a DataFrame with columns id_a, id_b, xa, ya, za, xb, yb, zb.
+        If the instance doesn't exist, None is returned.
+
+        Args:
+            server, uuid, instance:
+                For example, ('emdata3:8900', 'cc4c', 'segmentation_merged')
+        """
+        repo_info = fetch_repo_info(server, uuid)
+        if focused_decisions_instance not in repo_info["DataInstances"]:
+            return None
+
+        focused_decisions = fetch_focused_decisions(server, uuid, focused_decisions_instance)
+        focused_merges = focused_decisions.query('result == "merge" or result == "mergeLater"')
+        focused_merges = focused_merges[["sv_a", "sv_b", "xa", "ya", "za", "xb", "yb", "zb"]]
+        focused_merges = focused_merges.rename(columns={'sv_a': 'id_a', 'sv_b': 'id_b'})
+        return focused_merges
+
+
+    def append_edges_for_focused_merges(self, server, uuid, focused_decisions_instance, focused_merges=None):
         """
         Read the proofreading focused merge decisions from a keyvalue
         instance (stored as individual JSON values),
@@ -123,21 +381,25 @@ class LabelmapMergeGraph:
         Args:
             server, uuid, instance:
                 For example, ('emdata3:8900', 'cc4c', 'segmentation_merged')
+
+            focused_merges:
+                Optional. The result of fetch_focused_merges(), if you already fetched it.
         
         Returns:
             The count of appended edges
         """
-        repo_info = fetch_repo_info(server, uuid)
-        if focused_decisions_instance not in repo_info["DataInstances"]:
-            return 0
-        
-        focused_decisions = fetch_focused_decisions(server, uuid, focused_decisions_instance)
-        focused_merges = focused_decisions.query('result == "merge" or result == "mergeLater"')
-        focused_merges = focused_merges[["sv_a", "sv_b", "xa", "ya", "za", "xb", "yb", "zb"]]
-        focused_merges.rename(inplace=True, columns={'sv_a': 'id_a', 'sv_b': 'id_b'})
+        if focused_merges is None:
+            focused_merges = self.fetch_focused_merges(server, uuid, focused_decisions_instance)
+            if focused_merges is None:
+                return 0
+
+        focused_merges = focused_merges.copy()
 
         # These are manual merges: Give a great score.
         focused_merges['score'] = np.float32(0.01)
+
+        # Not mapped to any body until the next call to apply_mapping()
+        focused_merges['body'] = np.uint64(0)
         
         # Ensure correct dtypes for concatenation
         for col, dtype in MERGE_TABLE_DTYPE:
@@ -145,10 +407,15 @@ class LabelmapMergeGraph:
         
         focused_merges = focused_merges.loc[:, list(self.merge_table_df.columns)]
         self.merge_table_df = pd.concat((self.merge_table_df, focused_merges), ignore_index=True, copy=False)
+        if self._body_index is not None:
+            self._body_index.append(focused_merges['body'].values)
+        if self._sv_index is not None:
+            self._sv_index.append(focused_merges['id_a'].values)
         return len(focused_merges)
 
 
-    def append_edges_for_split_supervoxels(self, instance_info, parent_sv_handling='unmap', read_from='kafka', kafka_msgs=None):
+    def append_edges_for_split_supervoxels(self, instance_info, parent_sv_handling='unmap', read_from='kafka', kafka_msgs=None,
+                                           batch_size=None, threads=0, split_events=None):
         """
         Append edges to the merge table for the given split supervoxels (do not remove edges for their parents).
         
@@ -169,6 +436,15 @@ class LabelmapMergeGraph:
                 but some of our older DVID servers have not recorded all of their splits
                 to the internal mutation log, and so only kafka is a reliable source of split
                 information in such cases.
+
+            batch_size, threads:
+                If either is given, the supervoxels at the edge coordinates are fetched
+                in batches (in parallel, if threads > 1) via fetch_labels_batched().
+
+            split_events:
+                Optional. The split events for the instance, as returned by
+                fetch_supervoxel_splits(..., format='dict'), if you already fetched them.
+                (In which case read_from and kafka_msgs are ignored.)
             
         Returns:
             If any edges could not be preserved because the queried point in DVID does not seem to be a split child,
@@ -177,7 +453,9 @@ class LabelmapMergeGraph:
         assert parent_sv_handling in ('keep', 'drop', 'unmap')
         assert read_from in ('dvid', 'kafka')
         
-        if read_from == 'kafka':
+        if split_events is not None:
+            pass
+        elif read_from == 'kafka':
             split_events = fetch_supervoxel_splits_from_kafka(*instance_info, kafka_msgs=kafka_msgs)
         else:
             split_events = fetch_supervoxel_splits(*instance_info, 'dvid')
@@ -205,46 +483,64 @@ class LabelmapMergeGraph:
 
         # First extract relevant rows for faster queries below
         _parents = set(old_ids)
-        children = set(remain_ids) | set(split_ids)
         parent_rows_df = self.merge_table_df.query('id_a in @_parents or id_b in @_parents').copy()
         assert parent_rows_df.columns[:2].tolist() == ['id_a', 'id_b']
+        parent_positions = self.merge_table_df.index.get_indexer(parent_rows_df.index)
         
+        parent_bodies = self._row_bodies(parent_positions)
         if parent_sv_handling == 'drop':
+            # Dropping rows renumbers the others, so it can't be recorded in an overlay.
+            assert self._body_overlay is None, "Can't drop rows while the 'body' column has an overlay"
             self.merge_table_df = self.merge_table_df.drop(parent_rows_df.index)
+            if self._body_index is not None:
+                self._body_index.delete_rows(parent_positions, parent_bodies)
+            if self._sv_index is not None:
+                self._sv_index.delete_rows(parent_positions, parent_rows_df['id_a'].values)
         elif parent_sv_handling == 'unmap':
-            self.merge_table_df.loc[parent_rows_df.index, 'body'] = np.uint64(0)
+            self._set_row_bodies(parent_positions, np.uint64(0))
+            if self._body_index is not None:
+                self._body_index.update(parent_positions, parent_bodies, np.uint64(0))
 
         with Timer(f"Appending {len(parent_rows_df)} edges with split supervoxel IDs", _logger):
-            bad_edges = []
-            update_rows = [parent_rows_df.iloc[:0]] # Init with empty df in case there are no updates
-
             with Timer("Fetching supervoxels from split edge coordinates", _logger):
-                svs_a = fetch_labels(*instance_info, parent_rows_df[['za', 'ya', 'xa']].values, supervoxels=True)
-                svs_b = fetch_labels(*instance_info, parent_rows_df[['zb', 'yb', 'xb']].values, supervoxels=True)
-            
-            for i in range(len(parent_rows_df)):
-                sv_a = svs_a[i]
-                sv_b = svs_b[i]
-
-                # If either coordinate returns a non-sensical point, then
-                # the provided split mapping does not match the currently stored labels.
-                if sv_a not in children and sv_b not in children:
-                    if sv_a not in children and sv_a != parent_rows_df.iloc[i, 0]:
-                        bad_edges.append(('a', sv_a) + tuple(parent_rows_df.iloc[i]))
-                    if sv_b not in children and sv_b != parent_rows_df.iloc[i, 1]:
-                        bad_edges.append(('b', sv_b) + tuple(parent_rows_df.iloc[i]))
+                coords = np.concatenate((parent_rows_df[['za', 'ya', 'xa']].values,
+                                         parent_rows_df[['zb', 'yb', 'xb']].values))
+                if batch_size or threads:
+                    svs = fetch_labels_batched(*instance_info, coords, supervoxels=True,
+                                               batch_size=(batch_size or 10_000), threads=threads)
                 else:
-                    parent_rows_df.iloc[i, 0] = sv_a # id_a
-                    parent_rows_df.iloc[i, 1] = sv_b # id_b
-                    update_rows.append(parent_rows_df[i:i+1])
+                    svs = fetch_labels(*instance_info, coords, supervoxels=True)
+                svs = np.asarray(svs, np.uint64)
+                svs_a = svs[:len(parent_rows_df)]
+                svs_b = svs[len(parent_rows_df):]
+
+            children = np.union1d(remain_ids, split_ids)
+            is_update = np.isin(svs_a, children) | np.isin(svs_b, children)
+
+            # If neither coordinate returns a split child, then the provided split
+            # mapping does not match the currently stored labels.
+            # (Unless the coordinate still returns the edge's original supervoxel.)
+            bad_a = ~is_update & (svs_a != parent_rows_df['id_a'].values)
+            bad_b = ~is_update & (svs_b != parent_rows_df['id_b'].values)
+
+            update_table_df = parent_rows_df.iloc[is_update].reset_index(drop=True)
+            update_table_df['id_a'] = svs_a[is_update]
+            update_table_df['id_b'] = svs_b[is_update]
 
-        update_table_df = pd.concat(update_rows, ignore_index=True)
         assert (update_table_df.columns == self.merge_table_df.columns).all()
 
-        if bad_edges:
-            bad_edges = pd.DataFrame(bad_edges, columns=['end', 'found_sv'] + list(update_table_df.columns))
-        else:
-            bad_edges = update_table_df.iloc[:0] # No bad edges: Empty DataFrame
+        bad_edge_dfs = []
+        for end, bad, found_svs in [('a', bad_a, svs_a), ('b', bad_b, svs_b)]:
+            bad_df = parent_rows_df.iloc[bad].reset_index(drop=True)
+            bad_df.insert(0, 'found_sv', found_svs[bad])
+            bad_df.insert(0, 'end', end)
+            bad_df['parent_row'] = np.flatnonzero(bad)
+            bad_edge_dfs.append(bad_df)
+
+        # List each edge's bad ends together (a before b)
+        bad_edges = pd.concat(bad_edge_dfs, ignore_index=True)
+        bad_edges = bad_edges.sort_values('parent_row', kind='stable', ignore_index=True)
+        del bad_edges['parent_row']
 
         # Normalize the updates
         update_table_array = update_table_df.to_records(index=False)
@@ -254,56 +550,105 @@ class LabelmapMergeGraph:
         # Append the updates
         assert (normalized_update_df.columns == self.merge_table_df.columns).all()
         self.merge_table_df = pd.concat((self.merge_table_df, normalized_update_df), ignore_index=True, copy=False)
+        if self._body_index is not None:
+            self._body_index.append(normalized_update_df['body'].values)
+        if self._sv_index is not None:
+            self._sv_index.append(normalized_update_df['id_a'].values)
 
         return bad_edges
 
 
-    def extract_edges(self, server, uuid, instance, body_id, find_missing=True, *, session=None, logger=None):
+    def extract_edges(self, server, uuid, instance, body_id, find_missing=True, *,
+                      session=None, logger=None, mutid=None, prefetch=False):
+        """
+        Return the edges of the given body, from the cache if possible.
+        If the caller has already fetched the body's mutation ID,
+        it can be provided to avoid fetching it again.
+
+        If prefetch=True, the call is on behalf of the background prefetcher
+        rather than a client, so it isn't counted in the edge cache hit/miss stats,
+        and its timings are recorded in PREFETCH_STAGE_SECONDS instead of CLEAVE_STAGE_SECONDS.
+
+        Returns:
+            (mutid, supervoxels, edges, scores)
+        """
+        return self._extract_body_graph(server, uuid, instance, body_id, find_missing,
+                                        session=session, logger=logger, mutid=mutid, prefetch=prefetch)[:4]
+
+
+    def extract_cleave_graph(self, server, uuid, instance, body_id, find_missing=True, *, session=None, logger=None, mutid=None):
+        """
+        Like extract_edges(), but return the body's graph in the form
+        needed by cleave_prepared(), which is cached along with the edges.
+        When a user re-cleaves the same body with different seeds,
+        the graph needn't be cleaned and relabeled (and sorted) again.
+
+        Returns:
+            (mutid, supervoxels, CleaveGraph)
+        """
+        mutid, supervoxels, _edges, _scores, cleave_graph = \
+            self._extract_body_graph(server, uuid, instance, body_id, find_missing,
+                                     session=session, logger=logger, mutid=mutid)
+        return mutid, supervoxels, cleave_graph
+
+
+    def _extract_body_graph(self, server, uuid, instance, body_id, find_missing=True, *,
+                            session=None, logger=None, mutid=None, prefetch=False):
+        """
+        Helper for extract_edges() and extract_cleave_graph().
+
+        Returns:
+            (mutid, supervoxels, edges, scores, cleave_graph)
+        """
         body_id = np.uint64(body_id)
         if logger is None:
             logger = _logger
 
-        mutid = fetch_mutation_id(server, uuid, instance, body_id)
+        stage_seconds = PREFETCH_STAGE_SECONDS if prefetch else CLEAVE_STAGE_SECONDS
+        if mutid is None:
+            with stage_seconds.time(stage='fetch_mutation_id'):
+                mutid = fetch_mutation_id(server, uuid, instance, body_id)
         key = (server, uuid, instance, body_id)
-        key_lock = self.get_key_lock(*key)
 
         # Use a lock to avoid requesting the supervoxels from DVID in-parallel,
         # in case the user sends several requests at once for the same body,
         # which can happen if they click faster than dvid can respond.
-        with key_lock:
-            if key in self._edge_cache:
-                cached_mutid, supervoxels, edges, scores = self._edge_cache[key]
-                if cached_mutid == mutid:
-                    logger.info("Returning cached edges")
-                    return (mutid, supervoxels, edges, scores)
+        with self._edge_cache.key_lock(key):
+            cached = self._edge_cache.get(key, mutid, count=not prefetch)
+            if cached is not None:
+                logger.info("Returning cached edges")
+                return cached
 
             logger.info("Edges not found in cache.  Extracting from merge graph.")
-            dvid_supervoxels = fetch_supervoxels(server, uuid, instance, body_id, session=session)
+            with stage_seconds.time(stage='fetch_supervoxels'):
+                dvid_supervoxels = fetch_supervoxels(server, uuid, instance, body_id, session=session)
 
-            # It's very fast to select rows based on the body_id,
-            # so we prefer that if the mapping is already in sync with DVID.
-            svs_from_mapping = self.mapping[self.mapping == body_id].index
-            mapping_is_in_sync = (set(svs_from_mapping) == set(dvid_supervoxels))
+            with stage_seconds.time(stage='extract_edges'), self._rwlock.context(write=False):
+                # It's very fast to select rows based on the body_id,
+                # so we prefer that if the mapping is already in sync with DVID.
+                svs_from_mapping = self._mapping_svs(self._mapping_index.rows(body_id))
+                mapping_is_in_sync = np.array_equal(np.sort(svs_from_mapping), dvid_supervoxels)
 
-            if mapping_is_in_sync:
-                subset_df = self.extract_premapped_rows(body_id)
-            else:
-                subset_df = self.extract_rows_by_sv(dvid_supervoxels)
+                if mapping_is_in_sync:
+                    subset_df = self.extract_premapped_rows(body_id)
+                else:
+                    subset_df = self.extract_rows_by_sv(dvid_supervoxels)
 
             orig_num_cc = 0
             extra_edges = extra_scores = []
             if find_missing:
-                with Timer() as timer:
+                with Timer() as timer, stage_seconds.time(stage='find_missing_adjacencies'):
                     known_edges = subset_df[['id_a', 'id_b']].values
-                    extra_edges, orig_num_cc, final_num_cc, block_table = \
+                    extra_edges, orig_num_cc, final_num_cc, _block_table = \
                         find_missing_adjacencies(server, uuid, instance, body_id, known_edges,
-                                                 svs=dvid_supervoxels, search_distance=10, connect_non_adjacent=True)
+                                                 svs=dvid_supervoxels, search_distance=10, connect_non_adjacent=True,
+                                                 halo=True)
                     extra_scores = np.zeros(len(extra_edges), np.float32)
 
             if orig_num_cc == 1:
                 logger.info("Graph is contiguous")
             elif find_missing:
-                logger.info(f"Searched {len(block_table)} blocks for missing adjacencies.")
+                logger.info(f"Found {len(extra_edges)} missing adjacencies.")
                 if final_num_cc == 1:
                     logger.info(f"Finding missing adjacencies between {orig_num_cc} disjoint components took {timer.timedelta}")
                 else:
@@ -319,37 +664,446 @@ class LabelmapMergeGraph:
                 edges = np.concatenate((edges, extra_edges))
                 scores = np.concatenate((scores, extra_scores))
 
+            with stage_seconds.time(stage='prepare_cleave_graph'):
+                cleave_graph = prepare_cleave_graph(edges, scores, dvid_supervoxels)
+
             # Cache before returning
-            with self._edge_cache_main_lock:
-                if key in self._edge_cache:
-                    del self._edge_cache[key]
-                if len(self._edge_cache) == self.max_cache_len:
-                    first_key = next(iter(self._edge_cache.keys()))
-                    del self._edge_cache[first_key]
-                self._edge_cache[key] = (mutid, dvid_supervoxels, edges, scores)
+            self._edge_cache.put(key, (mutid, dvid_supervoxels, edges, scores, cleave_graph))
         
-        return (mutid, dvid_supervoxels, edges, scores)
+        return (mutid, dvid_supervoxels, edges, scores, cleave_graph)
 
 
     def extract_premapped_rows(self, body_id):
-        body_positions_orig = (self.merge_table_df['body'] == body_id).values.nonzero()[0]
-        subset_df = self.merge_table_df.iloc[body_positions_orig]
-        return subset_df.copy()
+        body_positions = self._body_index.rows(body_id)
+        return self._extract_rows(body_positions)
     
 
     def extract_rows_by_sv(self, supervoxels):
-        _sv_set = set(supervoxels)
-        subset_df = self.merge_table_df.query('id_a in @_sv_set and id_b in @_sv_set')
-        return subset_df.copy()
+        """
+        Extract the rows of the merge table whose supervoxels (both id_a and id_b)
+        are in the given list, i.e. the induced subgraph of the given supervoxels.
+
+        Every such edge is found via its id_a, so it suffices to look up the rows
+        for each supervoxel in the id_a index and then filter them by id_b.
+        That takes time proportional to the supervoxels' degree,
+        regardless of the size of the complete merge table.
+        """
+        if self._sv_index is None:
+            self._build_sv_index()
+
+        supervoxels = np.asarray(supervoxels, np.uint64)
+        positions = self._sv_index.rows_for_keys(supervoxels)
+        ids_b = self.merge_table_df['id_b'].values[positions]
+        positions = positions[np.isin(ids_b, supervoxels)]
+        return self._extract_rows(positions)
+
+
+    def _extract_rows(self, positions):
+        """
+        Return a copy of the given rows of the merge table,
+        with their current bodies (see _row_bodies()).
+        """
+        subset_df = self.merge_table_df.iloc[positions].copy()
+        if self._body_overlay is not None:
+            subset_df['body'] = self._body_overlay.apply(positions, subset_df['body'].values)
+        return subset_df
+
+
+    def start_kafka_updates(self, server, uuid, instance, start_offset=None):
+        """
+        Start a background thread which follows the kafka log for the given
+        labelmap instance and applies each mutation to the mapping and merge
+        table as it arrives (via apply_kafka_msgs()), so that the mapping
+        stays in sync with DVID and extract_edges() can (nearly always)
+        use the fast "premapped" path.
+
+        Args:
+            server, uuid, instance:
+                The labelmap instance whose mutations should be tracked.
+                Mutations in other branches of the DAG are ignored.
+
+            start_offset:
+                The kafka offset to start from.
+                To avoid missing any mutations, this should be an offset obtained
+                via read_kafka_latest_offset() BEFORE the mapping was fetched.
+                (Mutations which were already reflected in the mapping are harmless to replay.)
+        """
+        assert self._kafka_thread is None, "Kafka updates have already been started."
+        self._kafka_stop_event = threading.Event()
+        self._kafka_thread = threading.Thread( target=self._kafka_update_loop,
+                                               args=(server, uuid, instance, start_offset),
+                                               name='merge-graph-kafka-updates',
+                                               daemon=True )
+        self._kafka_thread.start()
+
+
+    def stop_kafka_updates(self):
+        if self._kafka_thread is None:
+            return
+        self._kafka_stop_event.set()
+        self._kafka_thread.join()
+        self._kafka_thread = None
+
+
+    def _kafka_update_loop(self, server, uuid, instance, start_offset):
+        self.kafka_offset = start_offset
+        for batch in tail_kafka_messages(server, uuid, instance, start_offset, stop_event=self._kafka_stop_event):
+            if not batch:
+                continue
+            try:
+                self.apply_kafka_msgs([msg for (_offset, msg) in batch], server, instance)
+            except Exception:
+                # Don't let one bad message kill the thread.
+                # extract_edges() verifies the mapping against DVID anyway,
+                # so the worst consequence of a skipped update is a slower request.
+                _logger.error("Failed to apply kafka messages to the merge graph", exc_info=True)
+            self.kafka_offset = batch[-1][0] + 1
+
+
+    def apply_kafka_msgs(self, kafka_msgs, server=None, instance=None):
+        """
+        Update the mapping (and the merge table 'body' column) in-place,
+        according to the given labelmap kafka messages.
+        Handles 'merge', 'cleave', 'split', and 'split-supervoxel' messages.
+        Other messages (including '-complete' messages) are ignored.
+
+        Only the rows of the bodies and supervoxels touched by each mutation are modified.
+
+        Note:
+            Edges for supervoxels created via supervoxel splits are NOT added to the
+            merge table, since that would require copying the entire table.
+            Their new IDs are added to the mapping, and find_missing_adjacencies()
+            will supply edges for them in extract_edges() (as it always has).
+
+        Args:
+            kafka_msgs:
+                List of parsed JSON messages from a labelmap instance's kafka log.
+
+            server, instance:
+                The labelmap instance the messages came from.
+                Required for 'split' messages, which do not list the split supervoxels,
+                so they must be fetched from DVID (at the message's UUID).
+
+        Returns:
+            The number of mutations applied.
+        """
+        msgs_df = labelmap_kafka_msgs_to_df(kafka_msgs)
+        msgs_df = msgs_df.query('action in ("merge", "cleave", "split", "split-supervoxel")')
+        if len(msgs_df) == 0:
+            return 0
+
+        # Fetch supervoxels for split bodies before obtaining the write lock.
+        split_svs = {}
+        for msg in msgs_df.query('action == "split"')['msg']:
+            try:
+                split_svs[msg['MutationID']] = fetch_supervoxels(server, msg['UUID'], instance, msg['NewLabel'])
+            except HTTPError as ex:
+                if ex.response is None or ex.response.status_code != 404:
+                    raise
+                # The new body no longer exists, so its supervoxels will be handled by a later message.
+                split_svs[msg['MutationID']] = np.zeros(0, np.uint64)
+
+        # For each mutation: (mutid, bodies whose cached edges are now stale, bodies which still exist)
+        mutated_bodies = []
+
+        with self._rwlock.context(write=True):
+            for row in msgs_df.itertuples():
+                msg = row.msg
+                if row.action == 'merge':
+                    svs = self._body_supervoxels(msg['Labels'])
+                    self._remap_supervoxels(svs, row.target_body)
+                    mutated_bodies.append((row.mutid, [row.target_body, *msg['Labels']], [row.target_body]))
+                elif row.action == 'cleave':
+                    self._remap_supervoxels(msg['CleavedSupervoxels'], msg['CleavedLabel'])
+                    mutated_bodies.append((row.mutid, [row.target_body, msg['CleavedLabel']], [row.target_body, msg['CleavedLabel']]))
+                elif row.action == 'split':
+                    for old_sv, split_info in (msg['SVSplits'] or {}).items():
+                        self._remap_supervoxels([int(old_sv)], 0)
+                        self._remap_supervoxels([split_info['Remain']], row.target_body)
+                    self._remap_supervoxels(split_svs[row.mutid], msg['NewLabel'])
+                    mutated_bodies.append((row.mutid, [row.target_body, msg['NewLabel']], [row.target_body, msg['NewLabel']]))
+                elif row.action == 'split-supervoxel':
+                    body = self._lookup_bodies([row.target_sv])[0]
+                    self._remap_supervoxels([row.target_sv], 0)
+                    self._remap_supervoxels([msg['SplitSupervoxel'], msg['RemainSupervoxel']], body)
+                    mutated_bodies.append((row.mutid, [body], [body]))
+
+            self.last_mutid = msgs_df['mutid'].iloc[-1]
+
+        for mutid, stale_bodies, _ in mutated_bodies:
+            self._edge_cache.invalidate_bodies(stale_bodies, mutid)
+
+        # Proofreaders are likely to cleave the bodies they just edited.
+        if self.prefetcher is not None:
+            self.prefetcher.enqueue(body for (_, _, bodies) in mutated_bodies for body in bodies)
+
+        if self.compaction_threshold is not None and self._delta_size() > self.compaction_threshold:
+            self.compact()
+
+        return len(msgs_df)
+
+
+    def compact(self):
+        """
+        Fold the updates which have accumulated in the indexes' deltas
+        (and the supervoxels which have been added to the mapping)
+        into new arrays, so that lookups and updates remain fast.
+
+        This takes O(N) time, but the new arrays are built while holding
+        only the read lock, so requests are only blocked while they are swapped in.
+        If the merge graph is updated in the meantime, the new arrays are discarded.
+
+        Returns:
+            True if the merge graph was compacted, False otherwise.
+        """
+        with Timer("Compacting merge graph", _logger):
+            with self._rwlock.context(write=False):
+                update_count = self._update_count
+                mapping, body_column, body_index, mapping_index, sv_index = self._compacted_state()
+
+            with self._rwlock.context(write=True):
+                if self._update_count != update_count:
+                    _logger.info("Merge graph was updated during compaction. Not compacting.")
+                    return False
+
+                if self._body_overlay is not None:
+                    self.merge_table_df['body'] = body_column
+                self.mapping = mapping
+                self._clear_overlays()
+                self._body_index, self._mapping_index, self._sv_index = body_index, mapping_index, sv_index
+                return True
+
+
+    def _compacted_state(self):
+        """
+        Helper for compact() and save_snapshot().
+        The caller must hold the (read) lock.
+
+        Returns:
+            (mapping, body_column, body_index, mapping_index, sv_index),
+            with all overlays and deltas folded in.  Arrays which
+            needn't change are returned as-is rather than copied.
+        """
+        body_column = self.merge_table_df['body'].values
+        if self._body_overlay is not None:
+            body_column = self._body_overlay.materialize(body_column)
+
+        mapping = self.mapping
+        if self._mapping_overlay is not None or len(self._extra_mapping_svs) > 0:
+            mapping_svs = mapping.index.values
+            mapping_bodies = mapping.values
+            if self._mapping_overlay is not None:
+                mapping_bodies = self._mapping_overlay.materialize(mapping_bodies)
+
+            sorter = self._extra_mapping_sorter
+            positions = np.searchsorted(mapping_svs, self._extra_mapping_svs[sorter])
+            mapping_svs = np.insert(mapping_svs, positions, self._extra_mapping_svs[sorter])
+            mapping_bodies = np.insert(mapping_bodies, positions, self._extra_mapping_bodies[sorter])
+
+            mapping = pd.Series(mapping_bodies, index=pd.Index(mapping_svs, name='sv', copy=False),
+                                name=self.mapping.name, copy=False)
+
+        if len(self._extra_mapping_svs) > 0:
+            # The mapping's rows have shifted, so its index must be rebuilt.
+            mapping_index = SortedRowIndex(mapping.values)
+        else:
+            mapping_index = self._mapping_index.compacted()
+
+        body_index = self._body_index.compacted()
+        sv_index = None
+        if self._sv_index is not None:
+            sv_index = self._sv_index.compacted()
+        return mapping, body_column, body_index, mapping_index, sv_index
+
+
+    def _delta_size(self):
+        """
+        The size of the updates which compact() would fold into the merge graph's arrays.
+        """
+        return (self._body_index.delta_size
+                + self._mapping_index.delta_size
+                + (self._sv_index.delta_size if self._sv_index is not None else 0)
+                + len(self._extra_mapping_svs))
+
+
+    def _lookup_bodies(self, svs):
+        """
+        Return the body for each of the given supervoxels, according to the mapping.
+        Supervoxels which aren't in the mapping are implicitly mapped to themselves.
+        """
+        svs = np.asarray(svs, np.uint64)
+        rows, found = self._mapping_rows(svs)
+        bodies = svs.copy()
+        bodies[found] = self._mapping_bodies(rows[found])
+        return bodies
+
+
+    def _body_supervoxels(self, bodies):
+        """
+        Return the supervoxels of the given bodies, according to the mapping.
+        Bodies which aren't in the mapping are presumed to be single-supervoxel
+        bodies (whose supervoxel ID is the same as the body ID).
+        """
+        bodies = np.asarray(bodies, np.uint64)
+        svs = self._mapping_svs(self._mapping_index.rows_for_keys(bodies))
+        unmapped_bodies = bodies[self._mapping_index.counts(bodies) == 0]
+        return np.concatenate((svs, unmapped_bodies))
+
+
+    def _mapping_rows(self, svs):
+        """
+        Locate the given supervoxels in the mapping (including its extra entries).
+
+        Returns:
+            (rows, found), where rows are positions in the mapping
+            (as listed in the mapping index), valid only where found is True.
+        """
+        mapping_svs = self.mapping.index.values
+        rows = np.searchsorted(mapping_svs, svs).astype(np.int64)
+        found = (rows < len(mapping_svs))
+        found[found] = (mapping_svs[rows[found]] == svs[found])
+
+        if len(self._extra_mapping_svs) > 0 and not found.all():
+            missing = np.flatnonzero(~found)
+            extra_svs, sorter = self._extra_mapping_svs, self._extra_mapping_sorter
+            i = np.searchsorted(extra_svs, svs[missing], sorter=sorter)
+            in_extra = (i < len(extra_svs))
+            in_extra[in_extra] = (extra_svs[sorter[i[in_extra]]] == svs[missing[in_extra]])
+            rows[missing[in_extra]] = len(mapping_svs) + sorter[i[in_extra]]
+            found[missing[in_extra]] = True
+
+        return rows, found
+
+
+    def _mapping_svs(self, rows):
+        """
+        Return the supervoxels at the given positions in the mapping (including its extra entries).
+        """
+        rows = np.asarray(rows, np.int64)
+        if len(self._extra_mapping_svs) == 0:
+            return self.mapping.index.values[rows]
+
+        is_extra = (rows >= len(self.mapping))
+        svs = np.empty(len(rows), np.uint64)
+        svs[~is_extra] = self.mapping.index.values[rows[~is_extra]]
+        svs[is_extra] = self._extra_mapping_svs[rows[is_extra] - len(self.mapping)]
+        return svs
+
+
+    def _mapping_bodies(self, rows):
+        """
+        Return the bodies at the given positions in the mapping (including its extra entries).
+        """
+        rows = np.asarray(rows, np.int64)
+        is_extra = (rows >= len(self.mapping))
+        base_rows = rows[~is_extra]
+
+        bodies = np.empty(len(rows), np.uint64)
+        bodies[~is_extra] = self.mapping.values[base_rows]
+        if self._mapping_overlay is not None:
+            bodies[~is_extra] = self._mapping_overlay.apply(base_rows, bodies[~is_extra])
+        bodies[is_extra] = self._extra_mapping_bodies[rows[is_extra] - len(self.mapping)]
+        return bodies
+
+
+    def _set_mapping_bodies(self, rows, body):
+        """
+        Assign the given body to the given positions in the mapping (including its extra entries).
+        """
+        rows = np.asarray(rows, np.int64)
+        is_extra = (rows >= len(self.mapping))
+        self._extra_mapping_bodies[rows[is_extra] - len(self.mapping)] = body
+
+        base_rows = rows[~is_extra]
+        if self._mapping_overlay is not None:
+            self._mapping_overlay.set(base_rows, body)
+        else:
+            self.mapping.iloc[base_rows] = body
+
+
+    def _add_mapping_svs(self, svs):
+        """
+        Add the given supervoxels (which must not be in the mapping yet)
+        to the mapping's extra entries, mapped to themselves.
+
+        Returns:
+            Their positions in the mapping (as listed in the mapping index).
+        """
+        first_row = len(self.mapping) + len(self._extra_mapping_svs)
+        rows = np.arange(first_row, first_row + len(svs))
+        self._extra_mapping_svs = np.append(self._extra_mapping_svs, svs)
+        self._extra_mapping_bodies = np.append(self._extra_mapping_bodies, svs)
+        self._extra_mapping_sorter = np.argsort(self._extra_mapping_svs)
+        self._mapping_index.insert(rows, svs)
+        return rows
+
+
+    def _row_bodies(self, rows):
+        """
+        Return the current 'body' column values of the given merge table rows.
+        """
+        bodies = self.merge_table_df['body'].values[rows]
+        if self._body_overlay is not None:
+            bodies = self._body_overlay.apply(rows, bodies)
+        return bodies
+
+
+    def _set_row_bodies(self, rows, bodies):
+        """
+        Set the 'body' column values of the given merge table rows.
+        """
+        if self._body_overlay is not None:
+            self._body_overlay.set(rows, bodies)
+        else:
+            body_col = self.merge_table_df.columns.get_loc('body')
+            self.merge_table_df.iloc[rows, body_col] = bodies
+
+
+    def _remap_supervoxels(self, svs, body):
+        """
+        Assign the given supervoxels to the given body in the mapping,
+        and update the 'body' column of all merge table rows which might be affected.
+        The caller must hold the write lock.
+        """
+        svs = np.unique(np.asarray(svs, np.uint64))
+        body = np.uint64(body)
+        if len(svs) == 0:
+            return
+
+        self._update_count += 1
+        old_bodies = self._lookup_bodies(svs)
+
+        # Add supervoxels that aren't in the mapping yet.
+        rows, found = self._mapping_rows(svs)
+        if not found.all():
+            rows[~found] = self._add_mapping_svs(svs[~found])
+
+        self._set_mapping_bodies(rows, body)
+        self._mapping_index.update(rows, old_bodies, body)
+
+        # Which rows might change?
+        # - Rows that currently belong to any affected body
+        # - Rows whose supervoxels belong to any affected body (after the update),
+        #   e.g. edges between two bodies that were just merged.
+        affected_bodies = pd.unique(np.append(old_bodies, body))
+        affected_bodies = affected_bodies[affected_bodies != 0]
+        affected_svs = np.concatenate((svs, self._body_supervoxels(affected_bodies)))
+
+        rows = np.union1d(self._body_index.rows_for_keys(affected_bodies),
+                          self._sv_index.rows_for_keys(affected_svs))
+
+        # Cut edges that span across bodies
+        bodies_a = self._lookup_bodies(self.merge_table_df['id_a'].values[rows])
+        bodies_b = self._lookup_bodies(self.merge_table_df['id_b'].values[rows])
+        new_row_bodies = np.where(bodies_a == bodies_b, bodies_a, np.uint64(0))
+
+        old_row_bodies = self._row_bodies(rows)
+        self._set_row_bodies(rows, new_row_bodies)
+        self._body_index.update(rows, old_row_bodies, new_row_bodies)
 
 
-    def get_key_lock(self, dvid_server, uuid, instance, body_id):
+    def edge_cache_stats(self):
         """
-        Rather than using a single Lock to protect all bodies at once,
-        we permit fine-grained locking for individual cached bodies.
-        Each body's unique lock is produced by this function.
+        Return the hit/miss/eviction counters (and current size) of the edge cache.
         """
-        key = (dvid_server, uuid, instance, body_id)
-        with self._edge_cache_main_lock:
-            key_lock = self._edge_cache_key_locks[key]
-        return key_lock
+        return self._edge_cache.stats()
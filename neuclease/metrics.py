@@ -0,0 +1,209 @@
+"""
+Minimal Prometheus-style metrics (counters, gauges, and histograms),
+which can be rendered in the Prometheus text exposition format
+(e.g. for a /metrics endpoint).
+
+This avoids a dependency on prometheus_client, and is only as
+elaborate as the cleave server needs.
+
+Example:
+
+    >>> REQUEST_SECONDS = Histogram('myapp_request_seconds', 'Time spent per request', ['endpoint'])
+    >>> with REQUEST_SECONDS.time(endpoint='/foo'):
+    ...     do_work()
+    >>> print(REGISTRY.render())
+"""
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import numpy as np
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Registry:
+    """
+    A collection of metrics to be rendered together.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            assert metric.name not in self._metrics, f"Duplicate metric name: {metric.name}"
+            self._metrics[metric.name] = metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+            lines.extend(metric.render_samples())
+        return '\n'.join(lines) + '\n'
+
+
+# The default registry, used by all metrics unless otherwise specified.
+REGISTRY = Registry()
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        assert set(labels.keys()) == set(self.labelnames), \
+            f"Metric {self.name} requires labels {self.labelnames}, not {tuple(labels.keys())}"
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def _labelstr(self, key, extra=()):
+        pairs = [*zip(self.labelnames, key), *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def render_samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{self._labelstr(key)} {_format(value)}' for key, value in items]
+
+
+class Counter(_Metric):
+    """
+    A value which only goes up.
+    If ``function`` is given, it is called to obtain the (unlabeled) value at render time.
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, function=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._function = function
+
+    def inc(self, amount=1, **labels):
+        assert amount >= 0, "Counters can't be decremented"
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0)
+
+    def render_samples(self):
+        if self._function is not None:
+            return [f'{self.name} {_format(self._function())}']
+        return super().render_samples()
+
+
+class Gauge(Counter):
+    """
+    A value which can go up or down.
+    If ``function`` is given, it is called to obtain the (unlabeled) value at render time.
+    """
+    TYPE = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(1, **labels)
+        try:
+            yield
+        finally:
+            self.dec(1, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations (e.g. durations) in cumulative buckets,
+    from which quantiles can be estimated by the Prometheus server.
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = np.zeros(len(self.buckets)+1, np.int64)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager.
+        Observe the wall-clock duration of the 'with' block.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def render_samples(self):
+        with self._lock:
+            items = sorted((key, (counts.copy(), total)) for key, (counts, total) in self._values.items())
+
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = np.cumsum(counts)
+            for le, count in zip((*self.buckets, float('inf')), cumulative):
+                lines.append(f'{self.name}_bucket{self._labelstr(key, [("le", _format(le))])} {count}')
+            lines.append(f'{self.name}_sum{self._labelstr(key)} {_format(total)}')
+            lines.append(f'{self.name}_count{self._labelstr(key)} {cumulative[-1]}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return repr(float(value))
+
+
+# Shared by the cleave server and LabelmapMergeGraph
+CLEAVE_STAGE_SECONDS = Histogram('cleave_server_stage_seconds', 'Time spent in each stage of a cleave request', ['stage'])
+PREFETCH_STAGE_SECONDS = Histogram('cleave_server_prefetch_stage_seconds',
+                                   'Time spent in each stage of extracting edges for the background prefetcher', ['stage'])
@@ -0,0 +1,60 @@
+"""
+Micro-benchmark for the edge cleaning/relabeling step of cleave(),
+comparing the compiled implementation used by prepare_cleave_graph()
+with the original pandas-based implementation.
+
+Not collected by pytest.  Run it directly:
+
+    python -m neuclease.tests.benchmark_cleave
+"""
+import numpy as np
+
+from neuclease.util import Timer
+from neuclease.cleave import _relabel_and_clean_edges
+from neuclease.tests.test_cleave import _clean_edges_pandas
+
+
+def synthetic_body(num_nodes, num_edges, seed=0):
+    """
+    Generate a random body graph with non-consecutive supervoxel IDs,
+    including some duplicate edges (in both orientations) and self-loops.
+    """
+    rng = np.random.RandomState(seed)
+    node_ids = np.unique(rng.randint(0, 2**40, size=num_nodes, dtype=np.uint64))
+    num_nodes = len(node_ids)
+    edges = node_ids[rng.randint(0, num_nodes, size=(num_edges,2))]
+    edges[::100, 1] = edges[::100, 0]
+    edges = np.concatenate((edges, edges[::20, ::-1]))
+    edge_weights = rng.random_sample(len(edges)).astype(np.float32)
+    return edges, edge_weights, node_ids
+
+
+def benchmark(num_nodes, num_edges, repeats=3):
+    edges, edge_weights, node_ids = synthetic_body(num_nodes, num_edges)
+
+    # Compile first
+    _relabel_and_clean_edges(edges[:10], edge_weights[:10], node_ids)
+
+    pandas_times = []
+    compiled_times = []
+    for _ in range(repeats):
+        with Timer() as timer:
+            expected_edges, _ = _clean_edges_pandas(edges, edge_weights, node_ids)
+        pandas_times.append(timer.seconds)
+
+        with Timer() as timer:
+            _, cleaned_edges, _ = _relabel_and_clean_edges(edges, edge_weights, node_ids)
+        compiled_times.append(timer.seconds)
+
+    assert (cleaned_edges == expected_edges).all()
+
+    pandas_time = min(pandas_times)
+    compiled_time = min(compiled_times)
+    print(f"{num_nodes:>10,} nodes {len(edges):>12,} edges: "
+          f"pandas {pandas_time:7.3f}s  compiled {compiled_time:7.3f}s  "
+          f"({pandas_time / compiled_time:4.1f}x)")
+
+
+if __name__ == "__main__":
+    for num_nodes, num_edges in [(10_000, 50_000), (100_000, 500_000), (1_000_000, 5_000_000)]:
+        benchmark(num_nodes, num_edges)
@@ -0,0 +1,224 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from dvidutils import LabelMapper
+
+import neuclease.adjacency
+from neuclease.adjacency import (find_missing_adjacencies, _iter_blocks_by_priority, _iter_face_volumes, _UnionFind,
+                                _dilate_labels, compute_label_adjacencies)
+from neuclease.dvid.labelmap import encode_block_coords
+
+
+def _fake_labelindex(block_svs_list):
+    blocks = {}
+    for i, block_svs in enumerate(block_svs_list):
+        blocks[i] = SimpleNamespace(counts={sv: 1 for sv in block_svs})
+    return SimpleNamespace(blocks=blocks)
+
+
+def test_union_find():
+    uf = _UnionFind(5)
+    assert uf.num_sets == 5
+    assert uf.union(0, 1)
+    assert uf.union(3, 4)
+    assert not uf.union(1, 0)
+    assert uf.num_sets == 3
+    assert uf.find(1) == uf.find(0)
+    assert uf.num_distinct([0, 1, 3, 4]) == 2
+    assert uf.num_distinct([2]) == 1
+
+
+def test_iter_blocks_by_priority():
+    # Supervoxels 1..6 each belong to their own component.
+    svs = np.array([1,2,3,4,5,6], np.uint64)
+    cc = np.array([0,1,2,3,4,5], np.uint64)
+    cc_mapper = LabelMapper(svs, cc)
+
+    block_svs_list = [
+        [1,2],        # 0: 2 components
+        [3,3],        # 1: 1 component (never useful)
+        [1,2,3,4],    # 2: 4 components
+        [5,6],        # 3: 2 components
+        [1,3],        # 4: 2 components, but redundant once block 2 is searched
+        [4,5],        # 5: 2 components
+    ]
+    labelindex = _fake_labelindex(block_svs_list)
+    coords_zyx = np.arange(len(block_svs_list))[:, None] * np.array([[64, 0, 0]])
+
+    uf = _UnionFind(len(svs))
+    visited = []
+    for coord_zyx, block_svs in _iter_blocks_by_priority(coords_zyx, labelindex, cc_mapper, uf):
+        block_index = coord_zyx[0] // 64
+        visited.append(block_index)
+        assert sorted(block_svs) == sorted(set(block_svs_list[block_index]))
+
+        # Pretend all components in the block were found to be adjacent.
+        block_ccs = cc_mapper.apply(block_svs)
+        for cc_b in block_ccs[1:]:
+            uf.union(block_ccs[0], cc_b)
+
+        if uf.num_sets == 1:
+            break
+
+    # The biggest block comes first.
+    # Blocks 0 and 4 are then redundant, and block 1 is never useful.
+    assert visited[0] == 2
+    assert sorted(visited[1:]) == [3, 5]
+    assert uf.num_sets == 1
+
+
+def test_iter_face_volumes():
+    block_vol = np.full((64,64,64), 2, np.uint64)
+    block_cache = {
+        (0, 0, 0): np.full((64,64,64), 1, np.uint64),   # below, in Z
+        (64, 0, 64): np.full((64,64,64), 3, np.uint64), # above, in X
+        (64, 64, 64): np.full((64,64,64), 4, np.uint64) # not face-adjacent
+    }
+
+    face_vols = [*_iter_face_volumes((64, 0, 0), block_vol, block_cache, search_distance=4)]
+    assert len(face_vols) == 2
+
+    # Each face volume extends 2*(search_distance//2) + 1 voxels into each block.
+    z_face, x_face = face_vols
+    assert z_face.shape == (10, 64, 64)
+    assert (z_face[:5] == 1).all() and (z_face[5:] == 2).all()
+
+    assert x_face.shape == (64, 64, 10)
+    assert (x_face[..., :5] == 2).all() and (x_face[..., 5:] == 3).all()
+
+
+def test_face_adjacencies():
+    """
+    Labels on opposite sides of a face must be found to be adjacent
+    if (and only if) they would be found adjacent within a single volume,
+    even at the edge of the dilation's reach.
+    """
+    pytest.importorskip('skimage')
+    search_distance = 4
+
+    for gap in (4, 5):
+        lower_vol = np.zeros((64,64,64), np.uint64)
+        upper_vol = np.zeros((64,64,64), np.uint64)
+
+        # Label 1 is 'gap' voxels below the face; label 2 is right at the face.
+        lower_vol[64-gap-1, 10, 10] = 1
+        upper_vol[0, 10, 10] = 2
+
+        full_vol = np.concatenate((lower_vol, upper_vol), axis=0)
+        expected = compute_label_adjacencies(_dilate_labels(full_vol, search_distance)).values.tolist()
+
+        face_vols = [*_iter_face_volumes((64, 0, 0), upper_vol, {(0,0,0): lower_vol}, search_distance)]
+        assert len(face_vols) == 1
+        found = compute_label_adjacencies(_dilate_labels(face_vols[0], search_distance)).values.tolist()
+
+        assert found == expected
+        assert found == ([[1,2]] if gap <= 2*(search_distance//2) else [])
+
+
+@pytest.fixture
+def synthetic_body(monkeypatch):
+    """
+    A body with supervoxels 1-4 in two blocks, stacked in Z:
+
+    - Block (0,0,0): 1 and 2 are adjacent; 3 is nearby, but not adjacent to either.
+    - Block (64,0,0): 3 and 4 are adjacent.
+
+    The DVID fetch functions used by find_missing_adjacencies()
+    are replaced with functions that return this body's data.
+    """
+    block_vols = {
+        (0,0,0): np.zeros((64,64,64), np.uint64),
+        (64,0,0): np.zeros((64,64,64), np.uint64),
+    }
+    block_vols[(0,0,0)][:32, :, :16] = 1
+    block_vols[(0,0,0)][32:, :, :16] = 2
+    block_vols[(0,0,0)][:, :, 32:] = 3
+    block_vols[(64,0,0)][:, :, :32] = 3
+    block_vols[(64,0,0)][:, :, 32:] = 4
+
+    blocks = {}
+    for coord_zyx, block_vol in block_vols.items():
+        encoded_block_id = encode_block_coords([coord_zyx])[0]
+        svs, counts = np.unique(block_vol[block_vol != 0], return_counts=True)
+        blocks[encoded_block_id] = SimpleNamespace(counts=dict(zip(svs, counts)))
+    labelindex = SimpleNamespace(blocks=blocks)
+
+    fetched_blocks = []
+    def fetch_labelmap_specificblocks(server, uuid, instance, corners_zyx, supervoxels=False, format='array', threads=0):
+        assert supervoxels and format == 'blocks'
+        fetched_blocks.extend(map(tuple, corners_zyx.tolist()))
+        return {(*corner,): block_vols[(*corner,)].copy() for corner in corners_zyx.tolist()}
+
+    monkeypatch.setattr(neuclease.adjacency, 'fetch_labelindex', lambda *args, **kwargs: labelindex)
+    monkeypatch.setattr(neuclease.adjacency, 'fetch_labelmap_specificblocks', fetch_labelmap_specificblocks)
+
+    svs = np.array([1,2,3,4], np.uint64)
+    return svs, fetched_blocks
+
+
+@pytest.mark.parametrize('batch_size, lookahead', [(16, 0), (1, 1), (1, 3)])
+def test_find_missing_adjacencies(synthetic_body, batch_size, lookahead):
+    svs, fetched_blocks = synthetic_body
+    known_edges = np.zeros((0,2), np.uint64)
+
+    new_edges, orig_num_cc, final_num_cc, block_table = \
+        find_missing_adjacencies('server', 'uuid', 'segmentation', 100, known_edges, svs,
+                                 batch_size=batch_size, lookahead=lookahead)
+
+    # The block with the most components is searched first.
+    assert fetched_blocks[0] == (0,0,0)
+    assert sorted(fetched_blocks) == [(0,0,0), (64,0,0)]
+
+    # 3 isn't adjacent to 1 or 2, so the body remains split.
+    assert sorted(map(tuple, new_edges.tolist())) == [(1,2), (3,4)]
+    assert orig_num_cc == 4
+    assert final_num_cc == 2
+    assert block_table is None
+
+
+def test_find_missing_adjacencies_connect_non_adjacent(synthetic_body):
+    svs, _fetched_blocks = synthetic_body
+    known_edges = np.zeros((0,2), np.uint64)
+
+    new_edges, orig_num_cc, final_num_cc, block_table = \
+        find_missing_adjacencies('server', 'uuid', 'segmentation', 100, known_edges, svs,
+                                 connect_non_adjacent=True, return_block_table=True)
+
+    # 3 is linked to the others because it shares a block with them.
+    assert sorted(map(tuple, new_edges.tolist())) == [(1,2), (1,3), (3,4)]
+    assert orig_num_cc == 4
+    assert final_num_cc == 1
+
+    block_table = block_table.set_index(['sv_a', 'sv_b'])
+    assert sorted(block_table.query('detected').index) == [(1,2), (3,4)]
+    assert sorted(block_table.query('applied').index) == [(1,2), (1,3), (3,4)]
+    assert block_table.loc[(2,3), ['z', 'y', 'x']].tolist() == [0,0,0]
+    assert block_table.loc[(3,4), ['z', 'y', 'x']].tolist() == [64,0,0]
+
+
+def test_find_missing_adjacencies_already_connected(synthetic_body):
+    svs, fetched_blocks = synthetic_body
+    known_edges = np.array([[1,2], [2,3], [3,4]], np.uint64)
+
+    new_edges, orig_num_cc, final_num_cc, block_table = \
+        find_missing_adjacencies('server', 'uuid', 'segmentation', 100, known_edges, svs,
+                                 return_block_table=True)
+
+    assert len(new_edges) == 0
+    assert orig_num_cc == final_num_cc == 1
+    assert len(block_table) == 0
+    assert not fetched_blocks
+
+    # Known edges reduce the number of components to link.
+    known_edges = np.array([[3,4]], np.uint64)
+    new_edges, orig_num_cc, final_num_cc, _ = \
+        find_missing_adjacencies('server', 'uuid', 'segmentation', 100, known_edges, svs)
+    assert new_edges.tolist() == [[1,2]]
+    assert (orig_num_cc, final_num_cc) == (3, 2)
+    assert fetched_blocks == [(0,0,0)]
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_adjacency'])
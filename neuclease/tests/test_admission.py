@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from neuclease.admission import AdmissionController, AdmissionRejected
+
+
+def test_admission_limits():
+    controller = AdmissionController(num_workers=1, max_queued=2, max_per_user=2, retry_after=7)
+    release = threading.Event()
+
+    futures = []
+    futures.append(controller.submit('alice', release.wait))
+    futures.append(controller.submit('alice', release.wait))
+
+    # Alice has reached her limit
+    with pytest.raises(AdmissionRejected) as exc_info:
+        controller.submit('alice', release.wait)
+    assert exc_info.value.retry_after == 7
+
+    # But Bob can still submit one more request, after which the queue is full.
+    futures.append(controller.submit('bob', release.wait))
+    with pytest.raises(AdmissionRejected):
+        controller.submit('carol', release.wait)
+
+    stats = controller.stats()
+    assert stats['running'] + stats['queued'] == 3
+    assert stats['rejected'] == 2
+    assert stats['users'] == {'alice': 2, 'bob': 1}
+
+    release.set()
+    for f in futures:
+        assert f.result() is True
+
+    # Everything has drained, so new requests are accepted again.
+    assert controller.submit('alice', lambda: 123).result() == 123
+    assert controller.stats()['users'] == {}
+
+
+def test_admission_check():
+    controller = AdmissionController(num_workers=1, max_queued=1, max_per_user=1)
+    release = threading.Event()
+
+    controller.check('alice')
+    future = controller.submit('alice', release.wait)
+
+    with pytest.raises(AdmissionRejected):
+        controller.check('alice')
+
+    # check() doesn't reserve anything
+    controller.check('bob')
+    controller.check('bob')
+    assert controller.stats()['users'] == {'alice': 1}
+
+    release.set()
+    future.result()
+
+
+def test_admission_cancel():
+    controller = AdmissionController(num_workers=1, max_queued=1)
+    release = threading.Event()
+
+    running = controller.submit('alice', release.wait)
+    queued = controller.submit('bob', release.wait)
+    with pytest.raises(AdmissionRejected):
+        controller.submit('carol', release.wait)
+
+    # Cancelling the queued request frees its place.
+    assert queued.cancel()
+    assert controller.stats()['users'] == {'alice': 1}
+    controller.check('carol')
+
+    release.set()
+    running.result()
+    assert controller.stats()['users'] == {}
+
+
+def test_admission_exceptions():
+    controller = AdmissionController(num_workers=2, max_queued=0)
+
+    def fail():
+        raise RuntimeError("fail")
+
+    with pytest.raises(RuntimeError):
+        controller.submit('alice', fail).result()
+
+    stats = controller.stats()
+    assert stats['running'] == stats['queued'] == 0
+    assert stats['users'] == {}
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_admission'])
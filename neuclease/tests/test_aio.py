@@ -0,0 +1,131 @@
+"""
+Test module for the asyncio API in neuclease.dvid.aio
+"""
+import asyncio
+
+import pytest
+import numpy as np
+import pandas as pd
+
+pytest.importorskip('aiohttp')
+
+from neuclease.dvid import DvidInstanceInfo, fetch_labels, fetch_sizes, fetch_labelindex
+from neuclease.dvid import aio
+
+##
+## These tests rely on the global setupfunction 'labelmap_setup',
+## defined in conftest.py and used here via pytest magic
+##
+
+def _run(coro_func, *args, **kwargs):
+    """
+    Run the given coroutine function with a fresh session.
+    """
+    async def run():
+        async with aio.AsyncDvidSession() as session:
+            return await coro_func(*args, **kwargs, session=session)
+    return asyncio.run(run())
+
+
+def test_gather_bounded():
+    running = 0
+    max_running = 0
+
+    async def job(i):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(running, max_running)
+        await asyncio.sleep(0.001)
+        running -= 1
+        return i
+
+    results = asyncio.run(aio.gather_bounded((job(i) for i in range(100)), 10))
+    assert results == list(range(100))
+    assert max_running == 10
+
+
+def test_gather_bounded_lazy():
+    created = 0
+    finished = 0
+
+    async def job(i):
+        nonlocal finished
+        await asyncio.sleep(0.001 * (i % 3))
+        finished += 1
+        return i
+
+    def jobs():
+        nonlocal created
+        for i in range(20):
+            # A new coroutine is only created when one of the 4 workers is free.
+            assert created - finished < 4
+            created += 1
+            yield job(i)
+
+    # Results are in input order, even though they finish out of order.
+    results = asyncio.run(aio.gather_bounded(jobs(), 4))
+    assert results == list(range(20))
+
+
+def test_gather_bounded_exceptions():
+    async def job(i):
+        await asyncio.sleep(0.001)
+        if i == 5:
+            raise RuntimeError("job failed")
+        return i
+
+    results = asyncio.run(aio.gather_bounded((job(i) for i in range(10)), 3, return_exceptions=True))
+    assert results[:5] == list(range(5))
+    assert isinstance(results[5], RuntimeError)
+    assert results[6:] == list(range(6, 10))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(aio.gather_bounded((job(i) for i in range(10)), 3))
+
+
+def test_fetch_supervoxels(labelmap_setup):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation')
+
+    supervoxels = _run(aio.fetch_supervoxels, *instance_info, 1)
+    assert (supervoxels == [1,2,3,4,5]).all()
+
+    sv_df = _run(aio.fetch_supervoxels_for_bodies, *instance_info, [1])
+    assert (sv_df['sv'] == [1,2,3,4,5]).all()
+    assert (sv_df['body'] == 1).all()
+
+
+def test_fetch_labels(labelmap_setup):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation')
+
+    label = _run(aio.fetch_label, *instance_info, (0, 1, 3), supervoxels=True)
+    assert label == 2
+
+    coords = [[0,0,0], [0,0,1], [0,0,2],
+              [0,0,3], [0,0,4], [0,0,4]]
+
+    labels = _run(aio.fetch_labels_batched, *instance_info, coords, supervoxels=True, batch_size=2)
+    assert labels.dtype == np.uint64
+    assert (labels == fetch_labels(*instance_info, coords, supervoxels=True)).all()
+
+
+def test_fetch_sizes(labelmap_setup):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation')
+
+    sizes = _run(aio.fetch_sizes_batched, *instance_info, [5,4,3,2,1], supervoxels=True, batch_size=2)
+    expected = fetch_sizes(*instance_info, [5,4,3,2,1], supervoxels=True)
+    pd.testing.assert_series_equal(sizes, expected)
+
+
+def test_fetch_labelindex(labelmap_setup):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation')
+
+    labelindex = _run(aio.fetch_labelindex, *instance_info, 1)
+    assert labelindex == fetch_labelindex(*instance_info, 1)
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_aio'])
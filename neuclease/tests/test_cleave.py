@@ -1,8 +1,11 @@
 import pytest
 import numpy as np
-from neuclease.cleave import cleave, CleaveResults
+import pandas as pd
+from dvidutils import LabelMapper
 
-@pytest.fixture(params=('seeded-mst', 'seeded-watershed', 'agglomerative-clustering'))
+from neuclease.cleave import cleave, CleaveResults, prepare_cleave_graph, cleave_prepared
+
+@pytest.fixture(params=('seeded-mst', 'seeded-mst-networkx', 'seeded-watershed', 'agglomerative-clustering'))
 def cleave_method(request):
     yield request.param
     
@@ -162,6 +165,106 @@ def test_stability(cleave_method):
         assert (repeat_results.contains_unlabeled_components == first_results.contains_unlabeled_components)
 
 
+def test_seeded_mst_matches_networkx():
+    """
+    The compiled seeded-mst implementation should produce
+    exactly the same results as the networkx implementation,
+    even when many weights are tied.
+    """
+    np.random.seed(0)
+    for _ in range(20):
+        N = 500
+        E = 2000
+
+        # Randomly-generated graph.
+        node_ids = np.arange(N, dtype=np.uint64)
+        edges = np.random.randint(0,N, size=(E,2), dtype=np.uint32)
+        edge_weights = (np.random.randint(0,4, size=(E,)) / 5 + 0.2).astype(np.float32)
+
+        seeds = { 1: np.random.randint(N, size=(5,)),
+                  2: np.random.randint(N, size=(5,)),
+                  3: np.random.randint(N, size=(1,)) }
+
+        nx_results = cleave(edges.copy(), edge_weights, seeds, node_ids, method='seeded-mst-networkx')
+        results = cleave(edges.copy(), edge_weights, seeds, node_ids, method='seeded-mst')
+
+        assert (results.output_labels == nx_results.output_labels).all()
+        assert results.disconnected_components == nx_results.disconnected_components
+        assert results.contains_unlabeled_components == nx_results.contains_unlabeled_components
+
+
+def test_cleave_prepared(cleave_method):
+    """
+    A prepared graph can be cleaved repeatedly with different seeds,
+    with the same results as cleaving from scratch.
+    """
+    np.random.seed(0)
+    N = 500
+    E = 2000
+
+    node_ids = np.arange(N, dtype=np.uint64)
+    edges = np.random.randint(0,N, size=(E,2), dtype=np.uint32)
+    edge_weights = np.random.random(size=(E,)).astype(np.float32)
+    orig_edges = edges.copy()
+
+    graph = prepare_cleave_graph(edges, edge_weights, node_ids)
+    assert (edges == orig_edges).all(), "Input edges should not be modified"
+
+    for _ in range(3):
+        seeds = { 1: np.random.randint(N, size=(5,)),
+                  2: np.random.randint(N, size=(5,)) }
+
+        prepared_results = cleave_prepared(graph, seeds, method=cleave_method)
+        results = cleave(edges, edge_weights, seeds, node_ids, method=cleave_method)
+
+        assert (prepared_results.output_labels == results.output_labels).all()
+        assert prepared_results.disconnected_components == results.disconnected_components
+        assert prepared_results.contains_unlabeled_components == results.contains_unlabeled_components
+
+
+def _clean_edges_pandas(edges, edge_weights, node_ids):
+    """
+    The original (pandas-based) edge cleaning from cleave(),
+    kept as a reference for test_clean_edges() and benchmark_cleave.py.
+    """
+    edges = np.sort(edges, axis=1)
+    edges_df = pd.DataFrame({'u': edges[:,0], 'v': edges[:,1], 'weight': edge_weights})
+    edges_df.drop_duplicates(['u', 'v'], keep='last', inplace=True)
+    edges_df = edges_df.query('u != v')
+    edges = edges_df[['u', 'v']].values
+    edge_weights = edges_df['weight'].values
+
+    mapper = LabelMapper(node_ids, np.arange(len(node_ids), dtype=np.uint32))
+    return mapper.apply(edges), edge_weights
+
+
+def test_clean_edges():
+    """
+    The compiled edge cleaning in prepare_cleave_graph() must produce
+    exactly the same edges (in the same order) as the original pandas code.
+    """
+    np.random.seed(0)
+    N = 1000
+    E = 10_000
+
+    # Non-consecutive, unsorted node IDs, and plenty of duplicates and self-loops.
+    node_ids = np.random.permutation(np.arange(N, dtype=np.uint64) * 7 + 2**40)
+    edges = node_ids[np.random.randint(0, N, size=(E,2))]
+    edges[::10, 1] = edges[::10, 0]
+    edges = np.concatenate((edges, edges[::3, ::-1]))
+    edge_weights = np.random.random(len(edges)).astype(np.float32)
+
+    expected_edges, expected_weights = _clean_edges_pandas(edges, edge_weights, node_ids)
+    graph = prepare_cleave_graph(edges, edge_weights, node_ids)
+
+    assert graph.cleaned_edges.dtype == np.uint32
+    assert (graph.cleaned_edges == expected_edges).all()
+    assert (graph.edge_weights == expected_weights).all()
+
+    with pytest.raises(KeyError):
+        prepare_cleave_graph(np.array([[2**40, 1]], np.uint64), np.ones(1, np.float32), node_ids)
+
+
 def test_empty_cleave(cleave_method):
     # Simple graph (a line of 10 adjacent nodes)
     node_ids = 10*np.arange(10, dtype=np.uint64)
@@ -0,0 +1,52 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+from neuclease.cleave_assignments import group_assignments, assignments_to_json, encode_binary_response, decode_binary_response
+
+
+def test_group_assignments():
+    supervoxels = np.random.permutation(np.arange(1000, dtype=np.uint64) * 3 + 2**40)
+    labels = np.random.randint(0, 5, size=1000).astype(np.uint32)
+
+    unique_labels, groups = group_assignments(supervoxels, labels)
+
+    # Compare with pandas
+    df = pd.DataFrame({'node': supervoxels, 'label': labels}).sort_values('node')
+    expected = { label: group['node'].tolist() for label, group in df.groupby('label') }
+
+    assert unique_labels.tolist() == sorted(expected.keys())
+    for label, group in zip(unique_labels, groups):
+        assert group.tolist() == expected[label]
+
+    unique_labels, groups = group_assignments(np.zeros(0, np.uint64), np.zeros(0, np.uint32))
+    assert len(unique_labels) == 0 and groups == []
+
+
+def test_binary_response_roundtrip():
+    unique_labels, groups = group_assignments(np.array([10, 20, 30, 40, 2**63], np.uint64),
+                                              np.array([2, 1, 2, 0, 1], np.uint32))
+    cleave_response = {
+        "body-id": 123,
+        "seeds": {"1": [20], "2": [10]},
+        "assignments": dict(zip(map(str, unique_labels.tolist()), groups)),
+        "warnings": ["Cleave result is not complete. 1 supervoxels remain unassigned."],
+        "info": []
+    }
+
+    buf = encode_binary_response(cleave_response)
+    assert len(buf) % 8 == 0
+
+    decoded = decode_binary_response(buf)
+    assert decoded.keys() == cleave_response.keys()
+    for key in ["body-id", "seeds", "warnings", "info"]:
+        assert decoded[key] == cleave_response[key]
+
+    assert assignments_to_json(decoded["assignments"]) == {"0": [40], "1": [20, 2**63], "2": [10, 30]}
+
+    with pytest.raises(ValueError):
+        decode_binary_response(b'garbage!' + buf[8:])
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_cleave_assignments'])
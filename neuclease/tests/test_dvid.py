@@ -5,6 +5,7 @@ import sys
 import time
 import logging
 import datetime
+import threading
 from multiprocessing.pool import ThreadPool
 
 import pytest
@@ -24,7 +25,12 @@ from neuclease.dvid import (dvid_api_wrapper, DvidInstanceInfo, fetch_supervoxel
                             post_merge, fetch_sparsevol_coarse, fetch_sparsevol_coarse_via_labelindex, post_branch,
                             post_hierarchical_cleaves, fetch_mapping, fetch_mutations, post_commit, post_newversion)
 
-from neuclease.dvid._dvid import default_dvid_session
+from neuclease.dvid._dvid import (default_dvid_session, new_dvid_session, configure_dvid_sessions, DVID_SESSION_SETTINGS,
+                                  enable_dvid_response_cache, disable_dvid_response_cache,
+                                  enable_dvid_single_flight, disable_dvid_single_flight, dvid_telemetry)
+from neuclease.dvid.response_cache import DvidResponseCache
+from neuclease.dvid.labelmap.labelops_pb2 import LabelIndex
+from neuclease.dvid.telemetry import endpoint_template
 from neuclease.util import box_to_slicing, extract_subvol, ndrange
 
 logger = logging.getLogger(__name__)
@@ -49,6 +55,39 @@ def test_default_dvid_session():
     assert len(set(ids)) == 2
 
 
+def test_dvid_session_settings():
+    """
+    Verify that the default sessions share a connection pool,
+    and that the session settings can be overridden.
+    """
+    def session(_):
+        time.sleep(0.01)
+        return default_dvid_session()
+
+    with ThreadPool(2) as pool:
+        sessions = list(pool.map(session, range(20)))
+
+    adapters = {id(s.get_adapter('http://foo')) for s in sessions}
+    assert len(adapters) == 1
+
+    s = new_dvid_session(retries=7, pool_size=3, keep_alive=False)
+    adapter = s.get_adapter('http://foo')
+    assert adapter.max_retries.total == 7
+    assert 503 in adapter.max_retries.status_forcelist
+    assert adapter._pool_maxsize == 3
+    assert s.headers['Connection'] == 'close'
+
+    orig_settings = DVID_SESSION_SETTINGS.copy()
+    old_session = default_dvid_session()
+    try:
+        configure_dvid_sessions(retries=5)
+        new_session = default_dvid_session()
+        assert new_session is not old_session
+        assert new_session.get_adapter('http://foo').max_retries.total == 5
+    finally:
+        configure_dvid_sessions(**orig_settings)
+
+
 def test_dvid_api_wrapper():
     f = dvid_api_wrapper(lambda server, uuid, instance, x, *, session=None: (server, uuid, instance, x))
     server, uuid, instance, x = f("http://foo", "bar", "baz", 5)
@@ -58,6 +97,185 @@ def test_dvid_api_wrapper():
     assert (server, uuid, instance, x) == ("http://foo", "bar", "baz", 5)
 
 
+def test_response_cache_eviction(tmpdir):
+    cache = DvidResponseCache(f'{tmpdir}/cache', max_bytes=250)
+    keys = [('http://foo', 'abc', f'key/{i}', '[]', b'') for i in range(3)]
+
+    cache.put(keys[0], b'0'*100, {'Content-Type': 'text/plain'})
+    cache.put(keys[1], b'1'*100)
+    assert cache.get(keys[0]) == (b'0'*100, {'Content-Type': 'text/plain'})
+
+    # Evicts keys[1], which was used least recently.
+    cache.put(keys[2], b'2'*100)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == (b'2'*100, {})
+    assert len(cache) == 2
+    assert cache.total_bytes == 200
+
+    # Replacing an entry doesn't count its old size.
+    cache.put(keys[2], b'2'*50)
+    assert cache.total_bytes == 150
+    assert len(cache) == 2
+
+    # Entries persist across instances
+    cache2 = DvidResponseCache(f'{tmpdir}/cache', max_bytes=250)
+    assert cache2.get(keys[0])[0] == b'0'*100
+    assert cache2.total_bytes == 150
+
+    # Evicting several entries at once
+    cache2.put(('http://foo', 'abc', 'key/big', '[]', b''), b'3'*240)
+    assert cache2.total_bytes == 240
+    assert len(cache2) == 1
+
+
+def test_response_cache(labelmap_setup, tmpdir):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation')
+
+    cache = enable_dvid_response_cache(f'{tmpdir}/cache')
+    try:
+        # The test repo node is locked, so the responses can be cached.
+        supervoxels = fetch_supervoxels(*instance_info, 1)
+        assert cache.hits == 0 and len(cache) == 1
+
+        cached_supervoxels = fetch_supervoxels(*instance_info, 1)
+        assert cache.hits == 1
+        assert (cached_supervoxels == supervoxels).all()
+
+        labels = fetch_labels(*instance_info, [[0,0,0], [0,0,1]], supervoxels=True)
+        cached_labels = fetch_labels(*instance_info, [[0,0,0], [0,0,1]], supervoxels=True)
+        assert cache.hits == 2
+        assert (cached_labels == labels).all()
+    finally:
+        disable_dvid_response_cache()
+
+
+def test_dvid_single_flight():
+    started = threading.Event()
+    release = threading.Event()
+    num_calls = 0
+
+    @dvid_api_wrapper
+    def fetch_thing(server, uuid, ids, *, session=None):
+        nonlocal num_calls
+        num_calls += 1
+        started.set()
+        release.wait()
+        return np.array(ids), LabelIndex(label=ids[0])
+
+    single_flight = enable_dvid_single_flight()
+    try:
+        with ThreadPool(2) as pool:
+            first = pool.apply_async(fetch_thing, ('localhost:8000', 'abc123', [1,2,3]))
+            started.wait()
+            second = pool.apply_async(fetch_thing, ('http://localhost:8000', 'abc123', [1,2,3]))
+
+            # Wait for the second call to join the first one.
+            while single_flight.joins == 0:
+                time.sleep(0.01)
+            release.set()
+
+            first, second = first.get(), second.get()
+
+        assert num_calls == 1
+        assert (first[0] == [1,2,3]).all() and (second[0] == [1,2,3]).all()
+        assert first[1] == second[1]
+
+        # Each caller gets its own copy
+        assert first[0] is not second[0]
+        assert first[1] is not second[1]
+
+        # Calls are not coalesced once they're finished.
+        fetch_thing('localhost:8000', 'abc123', [1,2,3])
+        assert num_calls == 2
+    finally:
+        disable_dvid_single_flight()
+
+
+def test_dvid_single_flight_sessions():
+    release = threading.Event()
+    num_calls = 0
+
+    @dvid_api_wrapper
+    def fetch_thing(server, uuid, *, session=None):
+        nonlocal num_calls
+        num_calls += 1
+        release.wait()
+        return session.params['u']
+
+    alice_session = new_dvid_session('test', 'alice')
+    bob_session = new_dvid_session('test', 'bob')
+
+    enable_dvid_single_flight()
+    try:
+        with ThreadPool(2) as pool:
+            alice = pool.apply_async(fetch_thing, ('localhost:8000', 'abc123'), {'session': alice_session})
+            bob = pool.apply_async(fetch_thing, ('localhost:8000', 'abc123'), {'session': bob_session})
+
+            # Different users' calls are not coalesced.
+            for _ in range(500):
+                if num_calls == 2:
+                    break
+                time.sleep(0.01)
+            assert num_calls == 2
+            release.set()
+
+            assert alice.get() == 'alice'
+            assert bob.get() == 'bob'
+    finally:
+        release.set()
+        disable_dvid_single_flight()
+
+
+def test_endpoint_template():
+    assert endpoint_template('http://emdata:8000/api/node/abc123/segmentation/sparsevol/123?format=rles') \
+        == '/api/node/{uuid}/{instance}/sparsevol/{id}'
+    assert endpoint_template('http://emdata:8000/api/node/abc123/grayscale/raw/0_1_2/64_64_64/0_0_-64') \
+        == '/api/node/{uuid}/{instance}/raw/{coord}/{coord}/{coord}'
+    assert endpoint_template('http://emdata:8000/api/node/abc123/segmentation_annotations/key/my-key') \
+        == '/api/node/{uuid}/{instance}/key/{key}'
+    assert endpoint_template('http://emdata:8000/api/repo/abc123/info') == '/api/repo/{uuid}/info'
+    assert endpoint_template('http://emdata:8000/api/server/info') == '/api/server/info'
+
+
+def test_dvid_telemetry(labelmap_setup, tmpdir):
+    dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
+    instance_info = DvidInstanceInfo(dvid_server, dvid_repo, 'segmentation')
+
+    with dvid_telemetry(f'{tmpdir}/telemetry.csv') as telemetry:
+        for _ in range(3):
+            fetch_supervoxels(*instance_info, 1)
+        fetch_labels(*instance_info, [[0,0,0], [0,0,1]], supervoxels=True)
+
+        with pytest.raises(Exception):
+            fetch_supervoxels(*instance_info, 999)
+
+    # Not recorded
+    fetch_supervoxels(*instance_info, 1)
+
+    records = telemetry.to_dataframe()
+    assert len(records) == 5
+    assert (records['seconds'] > 0).all()
+
+    sv_records = records.query('endpoint == "/api/node/{uuid}/{instance}/supervoxels/{id}"')
+    assert (sv_records['function'] == 'fetch_supervoxels').all()
+    assert sv_records['status'].tolist() == [200, 200, 200, 404]
+    assert (sv_records['response_bytes'] > 0).all()
+
+    label_records = records.query('endpoint == "/api/node/{uuid}/{instance}/labels"')
+    assert (label_records['method'] == 'GET').all()
+    assert (label_records['request_bytes'] > 0).all()
+
+    summary = telemetry.summary()
+    assert set(summary['endpoint']) == {*sv_records['endpoint'], *label_records['endpoint']}
+    assert summary['total_seconds'].is_monotonic_decreasing
+    assert (summary['p50_seconds'] <= summary['p99_seconds']).all()
+    assert summary.set_index('endpoint').loc[sv_records['endpoint'].iloc[0], 'errors'] == 1
+
+    csv_records = pd.read_csv(f'{tmpdir}/telemetry.csv')
+    assert len(csv_records) == 5
+
+
 def test_fetch_maxlabel(labelmap_setup):
     dvid_server, dvid_repo, _merge_table_path, _mapping_path, _supervoxel_vol = labelmap_setup
     maxlabel = fetch_maxlabel(dvid_server, dvid_repo, 'segmentation')
@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+import numpy as np
+
+from neuclease.edge_cache import EdgeCache
+
+
+def _value(mutid, num_edges):
+    svs = np.arange(num_edges+1, dtype=np.uint64)
+    edges = np.zeros((num_edges, 2), np.uint64)
+    scores = np.zeros(num_edges, np.float32)
+    return (mutid, svs, edges, scores)
+
+
+def test_edge_cache_lru():
+    entry_bytes = 8 + 8*11 + 16*10 + 4*10
+    cache = EdgeCache(3*entry_bytes)
+
+    for body in (1,2,3):
+        cache.put(('server', 'uuid', 'seg', body), _value(100, 10))
+    assert cache.total_bytes == 3*entry_bytes
+
+    # Touch body 1, so body 2 becomes the least-recently-used
+    assert cache.get(('server', 'uuid', 'seg', 1), 100) is not None
+    cache.put(('server', 'uuid', 'seg', 4), _value(100, 10))
+
+    assert ('server', 'uuid', 'seg', 2) not in cache
+    assert ('server', 'uuid', 'seg', 1) in cache
+    assert cache.evictions == 1
+
+    # Stale mutation ID
+    assert cache.get(('server', 'uuid', 'seg', 3), 101) is None
+    assert ('server', 'uuid', 'seg', 3) not in cache
+
+    # Too big to cache at all
+    cache.put(('server', 'uuid', 'seg', 5), _value(100, 1000))
+    assert ('server', 'uuid', 'seg', 5) not in cache
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['entries'] == 2
+    assert stats['bytes'] == 2*entry_bytes
+
+
+def test_edge_cache_shared_arrays():
+    """
+    Arrays which appear more than once in an entry (or are views of another array in it)
+    are only counted once.
+    """
+    mutid, svs, edges, scores = _value(100, 10)
+    graph = (edges, edges[:, 0], scores[:5], svs)
+
+    cache = EdgeCache()
+    cache.put(('server', 'uuid', 'seg', 1), (mutid, svs, edges, scores, graph))
+    assert cache.total_bytes == 8 + 8*11 + 16*10 + 4*10
+
+    # Views are counted as the size of their base (once), even if the base isn't in the entry.
+    cache.put(('server', 'uuid', 'seg', 2), (mutid, edges[:, 0], edges[:, 1]))
+    assert cache.total_bytes == (8 + 8*11 + 16*10 + 4*10) + (8 + 16*10)
+
+
+def test_edge_cache_invalidate_bodies():
+    cache = EdgeCache()
+    cache.put(('server', 'uuid', 'seg', 1), _value(100, 10))
+    cache.put(('server', 'uuid', 'seg', 2), _value(105, 10))
+    cache.put(('server', 'other-uuid', 'seg', 2), _value(90, 10))
+
+    # Body 2 was already cached with mutation 105 at one uuid, so only the other entry is dropped.
+    assert cache.invalidate_bodies([2], 100) == 1
+    assert ('server', 'uuid', 'seg', 2) in cache
+    assert ('server', 'other-uuid', 'seg', 2) not in cache
+
+    assert cache.invalidate_bodies([1,2]) == 2
+    assert len(cache) == 0
+    assert cache.total_bytes == 0
+
+
+def test_edge_cache_key_locks():
+    cache = EdgeCache()
+    key = ('server', 'uuid', 'seg', 1)
+    counter = [0]
+
+    def work():
+        with cache.key_lock(key):
+            counter[0] += 1
+
+    threads = [threading.Thread(target=work) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert counter[0] == 20
+
+    # Locks are discarded when no longer in use.
+    assert cache.stats()['key-locks'] == 0
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_edge_cache'])
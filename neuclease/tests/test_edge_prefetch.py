@@ -0,0 +1,89 @@
+import time
+
+import pytest
+import numpy as np
+
+from neuclease.edge_cache import EdgeCache
+from neuclease.edge_prefetch import EdgePrefetcher
+
+
+class _FakeMergeGraph:
+    """
+    Stands in for LabelmapMergeGraph, which would need a DVID server.
+    """
+    def __init__(self):
+        self._edge_cache = EdgeCache()
+        self.extracted = []
+
+    def extract_edges(self, server, uuid, instance, body_id, find_missing=True, *, prefetch=False):
+        assert prefetch
+        cached = self._edge_cache.get((server, uuid, instance, body_id), count=False)
+        if cached is not None:
+            return cached
+
+        self.extracted.append(body_id)
+        value = (1, np.array([body_id], np.uint64), np.zeros((0,2), np.uint64), np.zeros(0, np.float32))
+        self._edge_cache.put((server, uuid, instance, body_id), value)
+        return value
+
+
+def _wait_for_pending(prefetcher):
+    for _ in range(100):
+        if prefetcher.stats()['pending'] == 0:
+            break
+        time.sleep(0.01)
+
+
+def test_edge_prefetch():
+    merge_graph = _FakeMergeGraph()
+    prefetcher = EdgePrefetcher(merge_graph, num_threads=1, min_interval=0.0, max_pending=3)
+
+    # Nothing is prefetched until the first request tells us which instance to use.
+    prefetcher.enqueue([1,2,3,4,0])
+    prefetcher.start()
+    try:
+        time.sleep(0.1)
+        assert merge_graph.extracted == []
+        assert prefetcher.stats()['dropped'] == 1
+
+        # Body 3 was just requested, so it needn't be prefetched.
+        prefetcher.note_request('server', 'uuid', 'seg', 3)
+
+        _wait_for_pending(prefetcher)
+    finally:
+        prefetcher.stop()
+
+    # Most recent first; oldest (1) was dropped
+    assert merge_graph.extracted == [4, 2]
+    assert ('server', 'uuid', 'seg', 4) in merge_graph._edge_cache
+
+    # Prefetching isn't counted as cache hits or misses.
+    assert merge_graph._edge_cache.hits == merge_graph._edge_cache.misses == 0
+
+
+def test_edge_prefetch_new_uuid():
+    merge_graph = _FakeMergeGraph()
+    prefetcher = EdgePrefetcher(merge_graph, num_threads=1, min_interval=0.0, max_pending=3)
+    prefetcher.start()
+    try:
+        # Requested bodies are not prefetched while the instance stays the same.
+        for body in [1,2,3,4]:
+            prefetcher.note_request('server', 'uuid', 'seg', body)
+        _wait_for_pending(prefetcher)
+        assert merge_graph.extracted == []
+
+        # When clients move to a new uuid, the recently requested bodies
+        # (except the one just requested, and the oldest, which was forgotten)
+        # are prefetched from the new uuid.
+        prefetcher.note_request('server', 'new-uuid', 'seg', 3)
+        _wait_for_pending(prefetcher)
+    finally:
+        prefetcher.stop()
+
+    assert merge_graph.extracted == [4, 2]
+    assert ('server', 'new-uuid', 'seg', 4) in merge_graph._edge_cache
+    assert ('server', 'new-uuid', 'seg', 2) in merge_graph._edge_cache
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_edge_prefetch'])
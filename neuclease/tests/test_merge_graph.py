@@ -1,15 +1,19 @@
+import os
+import json
 import logging
 import pytest
 from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import pandas as pd
 
 from libdvid import DVIDNodeService
 
 from neuclease.dvid import ( DvidInstanceInfo, post_key, post_branch, create_instance,
                              fetch_mutation_id, post_cleave, post_split_supervoxel, post_merge )
 from neuclease.merge_graph import LabelmapMergeGraph
-from neuclease.merge_table import load_merge_table, MAPPED_MERGE_TABLE_DTYPE
+from neuclease.merge_table import load_merge_table, MERGE_TABLE_DTYPE, MAPPED_MERGE_TABLE_DTYPE
+from neuclease.util import Timer
 
 ##
 ## These tests rely on the global setupfunction 'labelmap_setup',
@@ -122,6 +126,285 @@ def test_extract_edges_with_large_gap(labelmap_setup):
 
 
 
+def test_extract_rows_by_sv(labelmap_setup):
+    _dvid_server, _dvid_repo, merge_table_path, mapping_path, _supervoxel_vol = labelmap_setup
+    merge_graph = LabelmapMergeGraph(merge_table_path)
+    merge_graph.apply_mapping(mapping_path)
+    orig_table = merge_graph.merge_table_df.copy()
+
+    for svs in ([1,2,3], [2,4,5], [3], [1,2,3,4,5], [99]):
+        _svs = set(svs)
+        expected = orig_table.query('id_a in @_svs and id_b in @_svs')
+        subset_df = merge_graph.extract_rows_by_sv(svs)
+        assert (subset_df.index == expected.index).all()
+        assert (subset_df[['id_a', 'id_b']].values == expected[['id_a', 'id_b']].values).all()
+
+def test_apply_kafka_msgs(labelmap_setup):
+    _dvid_server, _dvid_repo, merge_table_path, mapping_path, _supervoxel_vol = labelmap_setup
+    merge_graph = LabelmapMergeGraph(merge_table_path)
+    merge_graph.apply_mapping(mapping_path)
+
+    def check_bodies():
+        mapping = merge_graph.mapping
+        bodies_a = mapping.reindex(merge_graph.merge_table_df['id_a'].values).values
+        bodies_b = mapping.reindex(merge_graph.merge_table_df['id_b'].values).values
+        expected = np.where(bodies_a == bodies_b, bodies_a, 0)
+        assert (merge_graph.merge_table_df['body'].values == expected).all()
+        assert set(merge_graph.extract_premapped_rows(1).index) == set(np.flatnonzero(expected == 1))
+
+    # Cleave supervoxels 4,5 into a new body, then merge them back.
+    msgs = [{'Action': 'cleave', 'UUID': 'abc123', 'MutationID': 10, 'OrigLabel': 1, 'CleavedLabel': 6, 'CleavedSupervoxels': [4,5]}]
+    assert merge_graph.apply_kafka_msgs(msgs) == 1
+    assert (merge_graph.mapping.loc[[1,2,3,4,5]] == [1,1,1,6,6]).all()
+    assert merge_graph.last_mutid == 10
+    check_bodies()
+
+    msgs = [{'Action': 'merge', 'UUID': 'abc123', 'MutationID': 11, 'Target': 1, 'Labels': [6]},
+            {'Action': 'merge-complete', 'UUID': 'abc123', 'MutationID': 11}]
+    assert merge_graph.apply_kafka_msgs(msgs) == 1
+    assert (merge_graph.mapping.loc[[1,2,3,4,5]] == 1).all()
+    assert merge_graph.last_mutid == 11
+    check_bodies()
+
+
+def test_snapshot(labelmap_setup, tmpdir):
+    _dvid_server, _dvid_repo, merge_table_path, mapping_path, _supervoxel_vol = labelmap_setup
+    merge_graph = LabelmapMergeGraph(merge_table_path, 'abc123')
+    merge_graph.apply_mapping(mapping_path)
+    merge_graph.kafka_offset = 100
+
+    snapshot_dir = f'{tmpdir}/snapshot'
+    merge_graph.save_snapshot(snapshot_dir)
+    restored = LabelmapMergeGraph.load_snapshot(snapshot_dir)
+    shared = LabelmapMergeGraph.load_snapshot(snapshot_dir, shared=True)
+    base_body_column = shared.merge_table_df['body'].values
+    orig_body_column = base_body_column.copy()
+
+    assert restored.primary_uuid == 'abc123'
+    assert restored.kafka_offset == 100
+    assert (restored.merge_table_df == merge_graph.merge_table_df).all().all()
+    assert (restored.mapping == merge_graph.mapping).all()
+    assert (restored.extract_premapped_rows(1).index == merge_graph.extract_premapped_rows(1).index).all()
+
+    # The restored merge graph can still be updated.
+    msgs = [{'Action': 'cleave', 'UUID': 'abc123', 'MutationID': 10, 'OrigLabel': 1, 'CleavedLabel': 6, 'CleavedSupervoxels': [4,5]}]
+    restored.apply_kafka_msgs(msgs)
+    assert (restored.mapping.loc[[1,2,3,4,5]] == [1,1,1,6,6]).all()
+    assert len(restored.extract_premapped_rows(6)) == 1
+
+
+def _synthetic_merge_graph(num_rows, svs_per_body=100, seed=0):
+    """
+    Create a merge graph (without DVID) from a random merge table whose edges
+    connect nearby supervoxels, and a mapping which groups consecutive supervoxels into bodies.
+    """
+    rng = np.random.default_rng(seed)
+    num_svs = num_rows // 4
+    a = rng.integers(1, num_svs, num_rows).astype(np.uint64)
+    b = np.minimum(a + rng.integers(1, 50, num_rows).astype(np.uint64), np.uint64(num_svs))
+
+    table = np.zeros(num_rows, MERGE_TABLE_DTYPE)
+    table['id_a'] = np.minimum(a, b)
+    table['id_b'] = np.maximum(a, b)
+
+    svs = np.arange(1, num_svs+1, dtype=np.uint64)
+    mapping = pd.Series((svs - 1) // svs_per_body + 1, index=pd.Index(svs, name='sv'), name='body')
+
+    merge_graph = LabelmapMergeGraph(pd.DataFrame(table), 'abc123', no_kafka=True)
+    merge_graph.apply_mapping(mapping)
+    return merge_graph
+
+
+def _check_merge_graph(merge_graph, expected_mapping, bodies):
+    """
+    Verify the merge graph's lookups against the given mapping (a pd.Series),
+    which must list every supervoxel in the merge table.
+    """
+    svs = expected_mapping.index.values
+    assert (merge_graph._lookup_bodies(svs) == expected_mapping.values).all()
+
+    bodies_a = expected_mapping.loc[merge_graph.merge_table_df['id_a'].values].values
+    bodies_b = expected_mapping.loc[merge_graph.merge_table_df['id_b'].values].values
+    expected_row_bodies = np.where(bodies_a == bodies_b, bodies_a, 0)
+    assert (merge_graph._row_bodies(np.arange(len(merge_graph.merge_table_df))) == expected_row_bodies).all()
+
+    for body in bodies:
+        assert sorted(merge_graph._body_supervoxels([body])) == sorted(svs[expected_mapping.values == body])
+
+        subset_df = merge_graph.extract_premapped_rows(body)
+        assert (subset_df.index == np.flatnonzero(expected_row_bodies == body)).all()
+        assert (subset_df['body'] == body).all()
+
+
+def test_apply_kafka_msgs_with_deltas(tmpdir):
+    """
+    The results of apply_kafka_msgs() must not depend on whether the
+    updates are written in-place, compacted, or kept in overlays (shared snapshots),
+    or whether the indexes were restored from a snapshot.
+    """
+    in_place = _synthetic_merge_graph(40_000)
+    in_place.compaction_threshold = None
+
+    compacted = _synthetic_merge_graph(40_000)
+    compacted.compaction_threshold = 0
+
+    snapshot_dir = f'{tmpdir}/snapshot'
+    in_place.save_snapshot(snapshot_dir)
+    restored = LabelmapMergeGraph.load_snapshot(snapshot_dir)
+    shared = LabelmapMergeGraph.load_snapshot(snapshot_dir, shared=True)
+    base_body_column = shared.merge_table_df['body'].values
+    orig_body_column = base_body_column.copy()
+
+    expected_mapping = in_place.mapping.copy()
+    body_5_sv = expected_mapping.index[expected_mapping == 5][0]
+    msgs = [{'Action': 'cleave', 'UUID': 'abc123', 'MutationID': 10, 'OrigLabel': 3,
+             'CleavedLabel': 1_000_001, 'CleavedSupervoxels': list(range(201, 251))},
+            {'Action': 'merge', 'UUID': 'abc123', 'MutationID': 11, 'Target': 5, 'Labels': [6, 7]},
+            {'Action': 'split-supervoxel', 'UUID': 'abc123', 'MutationID': 12, 'Body': 5,
+             'Supervoxel': int(body_5_sv), 'SplitSupervoxel': 2_000_001, 'RemainSupervoxel': 2_000_002},
+            {'Action': 'merge', 'UUID': 'abc123', 'MutationID': 13, 'Target': 1_000_001, 'Labels': [8]}]
+
+    expected_mapping.loc[201:250] = 1_000_001
+    expected_mapping.loc[expected_mapping.isin([6, 7]).values] = 5
+    expected_mapping.loc[body_5_sv] = 0
+    expected_mapping.loc[2_000_001] = 5
+    expected_mapping.loc[2_000_002] = 5
+    expected_mapping.loc[expected_mapping.isin([8]).values] = 1_000_001
+    bodies = [3, 5, 1_000_001]
+
+    for merge_graph in (in_place, compacted, restored, shared):
+        # Apply the messages one at a time, to exercise compaction between them.
+        for msg in msgs:
+            assert merge_graph.apply_kafka_msgs([msg]) == 1
+        assert merge_graph.last_mutid == 13
+        _check_merge_graph(merge_graph, expected_mapping, bodies)
+
+    assert in_place._delta_size() > 0
+    assert compacted._delta_size() == 0
+
+    # The shared snapshot arrays were not modified.
+    assert shared._delta_size() > 0
+    assert np.shares_memory(shared.merge_table_df['body'].values, base_body_column)
+    assert (base_body_column == orig_body_column).all()
+    assert (shared.mapping == LabelmapMergeGraph.load_snapshot(snapshot_dir).mapping).all()
+
+    # Snapshots of the updated merge graphs include all updates.
+    for name, merge_graph in (('in-place', in_place), ('shared', shared)):
+        merge_graph.save_snapshot(f'{tmpdir}/{name}')
+        updated = LabelmapMergeGraph.load_snapshot(f'{tmpdir}/{name}')
+        assert updated._delta_size() == 0
+        _check_merge_graph(updated, expected_mapping, bodies)
+
+    for merge_graph in (restored, shared):
+        assert merge_graph.compact()
+        assert merge_graph._delta_size() == 0
+        _check_merge_graph(merge_graph, expected_mapping, bodies)
+
+
+def test_remap_cost_independent_of_table_size():
+    """
+    Applying a mutation must not take time proportional to the size of the merge table,
+    i.e. the index arrays must not be rebuilt (or copied) for each kafka message.
+    """
+    def median_remap_seconds(merge_graph):
+        base_orders = (merge_graph._body_index.order, merge_graph._mapping_index.order, merge_graph._sv_index.order)
+
+        timings = []
+        for i in range(21):
+            body = 100 + 2*i
+            svs = merge_graph._body_supervoxels([body])
+            with Timer() as timer, merge_graph._rwlock.context(write=True):
+                merge_graph._remap_supervoxels(svs, body+1)
+            timings.append(timer.seconds)
+
+        assert merge_graph._body_index.order is base_orders[0]
+        assert merge_graph._mapping_index.order is base_orders[1]
+        assert merge_graph._sv_index.order is base_orders[2]
+
+        # The first remap may include one-time (e.g. jit compilation) costs.
+        return np.median(timings[1:])
+
+    small_seconds = median_remap_seconds(_synthetic_merge_graph(100_000))
+    large_seconds = median_remap_seconds(_synthetic_merge_graph(4_000_000))
+
+    # Rebuilding the indexes would make this ratio ~10x (or more).
+    assert large_seconds < 4 * small_seconds, \
+        f"Remapping took {large_seconds:.4f}s for the large table, vs. {small_seconds:.4f}s for the small table"
+
+
+def _private_dirty_bytes():
+    """
+    Return the amount of memory which is private to this process (and has been written),
+    i.e. not shared with its parent or backed by a file.
+    """
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                return 1024 * int(line.split()[1])
+    raise RuntimeError("Private_Dirty not found in /proc/self/smaps_rollup")
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/smaps_rollup'), reason="Requires Linux /proc/self/smaps_rollup")
+def test_shared_snapshot_worker_memory(tmpdir):
+    """
+    Worker processes which are forked from a process that loaded a shared
+    snapshot (see cleave_server --workers) must not need private copies
+    of the merge graph's arrays (or even of the pages they modify) to apply kafka updates.
+    """
+    merge_graph = _synthetic_merge_graph(4_000_000)
+    merge_graph.save_snapshot(f'{tmpdir}/snapshot')
+    del merge_graph
+
+    shared = LabelmapMergeGraph.load_snapshot(f'{tmpdir}/snapshot', shared=True)
+
+    # Apply one update before forking, as the server does when it replays the kafka log.
+    shared.apply_kafka_msgs([{'Action': 'merge', 'UUID': 'abc123', 'MutationID': 10, 'Target': 1, 'Labels': [2]}])
+
+    def mutations(i):
+        return [{'Action': 'cleave', 'UUID': 'abc123', 'MutationID': 11 + 3*i, 'OrigLabel': 10 + i,
+                 'CleavedLabel': 10_000_001 + i, 'CleavedSupervoxels': list(range(1001 + 100*i, 1051 + 100*i))},
+                {'Action': 'merge', 'UUID': 'abc123', 'MutationID': 12 + 3*i, 'Target': 50 + i, 'Labels': [60 + i, 70 + i]},
+                {'Action': 'split-supervoxel', 'UUID': 'abc123', 'MutationID': 13 + 3*i, 'Body': 5,
+                 'Supervoxel': 401 + i, 'SplitSupervoxel': 20_000_001 + 2*i, 'RemainSupervoxel': 20_000_002 + 2*i}]
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Worker process
+        try:
+            os.close(read_fd)
+
+            # The first update in a new process writes to many of the Python objects
+            # it inherited (e.g. refcounts), which copies their pages.  That's not what we're measuring.
+            shared.apply_kafka_msgs(mutations(0))
+
+            before = _private_dirty_bytes()
+            for i in range(1, 4):
+                shared.apply_kafka_msgs(mutations(i))
+            after = _private_dirty_bytes()
+
+            bodies = shared._lookup_bodies([1101, 6001, 20_000_003]).tolist()
+            os.write(write_fd, json.dumps({'growth': after - before, 'bodies': bodies}).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    result = json.loads(result)
+
+    # The worker applied the updates...
+    assert result['bodies'] == [10_000_002, 51, 5]
+
+    # ...without copying the body column, the mapping, or the indexes (each of which is >= 8 MiB).
+    # (Modifying them in-place would copy ~4 MiB of their pages, too.)
+    assert result['growth'] < 2 * 2**20, \
+        f"Worker memory grew by {result['growth'] / 2**20:.1f} MiB after applying updates"
+
+    # The parent's merge graph is unaffected.
+    assert shared._lookup_bodies([1101, 6001]).tolist() == [12, 61]
+
 def _setup_test_append_edges_for_split(labelmap_setup, branch_name):
     dvid_server, dvid_repo, _merge_table_path, _mapping_path, supervoxel_vol = labelmap_setup
     uuid = post_branch(dvid_server, dvid_repo, branch_name, '')
@@ -253,8 +536,7 @@ def test_extract_edges_multithreaded(labelmap_setup):
     def _test(force_dirty):
         if force_dirty:
             # A little white-box manipulation here to ensure that the cache is out-of-date.
-            with merge_graph._edge_cache_main_lock:
-                merge_graph._edge_cache.clear()
+            merge_graph._edge_cache.clear()
 
         # Extraction should still work.
         mutid, dvid_supervoxels, edges, _scores = merge_graph.extract_edges(*instance_info, 1)
@@ -0,0 +1,43 @@
+import pytest
+
+from neuclease.metrics import Registry, Counter, Gauge, Histogram
+
+
+def test_metrics_render():
+    registry = Registry()
+    requests = Counter('test_requests_total', 'Requests', ['status'], registry=registry)
+    in_flight = Gauge('test_in_flight', 'In-flight', registry=registry)
+    callback = Gauge('test_callback', 'Callback', registry=registry, function=lambda: 7)
+    latency = Histogram('test_seconds', 'Latency', ['stage'], registry=registry, buckets=(0.1, 1.0))
+
+    requests.inc(status=200)
+    requests.inc(2, status=500)
+    with in_flight.track_inprogress():
+        assert in_flight.value() == 1
+    assert in_flight.value() == 0
+    assert callback.value() == 7
+
+    latency.observe(0.05, stage='a')
+    latency.observe(0.5, stage='a')
+    latency.observe(5.0, stage='a')
+
+    text = registry.render()
+    lines = text.splitlines()
+    assert '# TYPE test_requests_total counter' in lines
+    assert 'test_requests_total{status="200"} 1' in lines
+    assert 'test_requests_total{status="500"} 2' in lines
+    assert 'test_in_flight 0' in lines
+    assert 'test_callback 7' in lines
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="a"} 5.55' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+
+    with pytest.raises(AssertionError):
+        requests.inc(status=200, extra='x')
+
+
+if __name__ == "__main__":
+    pytest.main(['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_metrics'])
@@ -6,11 +6,12 @@ import logging
 import functools
 import subprocess
 
+import ujson
 import pytest
 import requests
 
 import neuclease
-
+from neuclease.cleave_assignments import decode_binary_response
 from neuclease.tests.conftest import TEST_DATA_DIR
 
 logger = logging.getLogger(__name__)
@@ -80,11 +81,144 @@ def cleave_server_setup(labelmap_setup):
 
 
 @show_request_exceptions
+def test_in_flight_requests_streaming():
+    """
+    Streamed responses must be counted as in-flight until they're finished.
+    """
+    from flask import Flask, Response
+    from neuclease.cleave_server import _RequestMetricsMiddleware, IN_FLIGHT_REQUESTS
+
+    app = Flask('test_in_flight_requests_streaming')
+    app.wsgi_app = _RequestMetricsMiddleware(app.wsgi_app)
+
+    in_flight_counts = []
+
+    @app.route('/stream')
+    def stream():
+        def generate():
+            for i in range(3):
+                in_flight_counts.append(IN_FLIGHT_REQUESTS.value())
+                yield f'{i}\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    before = IN_FLIGHT_REQUESTS.value()
+    r = app.test_client().get('/stream')
+    assert r.data == b'0\n1\n2\n'
+    r.close()
+
+    assert in_flight_counts == [before+1]*3
+    assert IN_FLIGHT_REQUESTS.value() == before
+
+
+def test_batch_request_limits(monkeypatch):
+    """
+    /compute-cleaves rejects oversized batches, keeps at most --batch-cleave-threads
+    of a batch's cleaves in the executor, and abandons the rest of the batch if the
+    client disconnects.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import neuclease.cleave_server as cleave_server
+
+    started = []
+    def run_cleave(data):
+        started.append(data['body-id'])
+        return dict(data), 200
+
+    monkeypatch.setattr(cleave_server, '_run_cleave_or_error', run_cleave)
+    monkeypatch.setattr(cleave_server, 'BATCH_CLEAVE_THREADS', 2)
+    monkeypatch.setattr(cleave_server, 'MAX_BATCH_CLEAVES', 10)
+    monkeypatch.setattr(cleave_server, 'CLEAVE_ADMISSION', None)
+
+    batch = [{'body-id': i, 'user': 'testuser'} for i in range(10)]
+    with ThreadPoolExecutor(2) as executor:
+        monkeypatch.setattr(cleave_server, 'BATCH_CLEAVE_EXECUTOR', executor)
+        client = cleave_server.app.test_client()
+
+        r = client.post('/compute-cleaves', json=[*batch, {'body-id': 10}])
+        assert r.status_code == 413
+
+        r = client.post('/compute-cleaves', json=batch)
+        results = [ujson.loads(line) for line in r.data.decode().splitlines()]
+        assert sorted(result['batch-index'] for result in results) == list(range(10))
+        assert all(result['status-code'] == 200 for result in results)
+
+        # Disconnect after the first result
+        started.clear()
+        r = client.post('/compute-cleaves', json=batch, buffered=False)
+        next(iter(r.response))
+        r.close()
+        assert len(started) == 2
+
+
+def test_request_admission(monkeypatch):
+    """
+    When the server is too busy, cleave requests are rejected before
+    any DVID requests are made, and batches are rejected, too.
+    Once a batch has started, its cleaves wait for a place in the queue.
+    """
+    import threading
+    import neuclease.cleave_server as cleave_server
+    from neuclease.admission import AdmissionController
+
+    def fetch_mutation_id(*args, **kwargs):
+        raise AssertionError("Rejected requests shouldn't fetch anything from DVID")
+
+    started = []
+    def run_cleave(data):
+        started.append(data['body-id'])
+        return dict(data), 200
+
+    admission = AdmissionController(num_workers=1, max_queued=0, max_per_user=1, retry_after=7)
+    monkeypatch.setattr(cleave_server, 'CLEAVE_ADMISSION', admission)
+    monkeypatch.setattr(cleave_server, 'fetch_mutation_id', fetch_mutation_id)
+    monkeypatch.setattr(cleave_server, '_run_cleave_or_error', run_cleave)
+    monkeypatch.setattr(cleave_server, 'BATCH_CLEAVE_THREADS', 2)
+    monkeypatch.setattr(cleave_server, 'BATCH_ADMISSION_RETRY_SECONDS', 0.01)
+    client = cleave_server.app.test_client()
+
+    release = threading.Event()
+    busy = admission.submit('otheruser', release.wait)
+    try:
+        request = {"body-id": 1, "user": "testuser", "server": "127.0.0.1", "port": 8000,
+                   "uuid": "abc123", "segmentation-instance": "segmentation", "seeds": {"1": [1]}}
+        r = client.post('/compute-cleave', json=request)
+        assert r.status_code == 503
+        assert r.headers['Retry-After'] == '7'
+
+        r = client.post('/compute-cleaves', json=[request])
+        assert r.status_code == 503
+    finally:
+        release.set()
+        busy.result()
+
+    # With only one worker (and one cleave per user), the batch proceeds one cleave at a time.
+    batch = [{'body-id': i, 'user': 'testuser'} for i in range(5)]
+    r = client.post('/compute-cleaves', json=batch)
+    results = [ujson.loads(line) for line in r.data.decode().splitlines()]
+    assert sorted(result['batch-index'] for result in results) == list(range(5))
+    assert sorted(started) == list(range(5))
+    assert admission.stats()['users'] == {}
+
+
+def _stage_count(port, stage):
+    """
+    Return the number of times the given cleave stage has been timed by the server (see /metrics).
+    """
+    r = requests.get(f'http://127.0.0.1:{port}/metrics')
+    r.raise_for_status()
+    prefix = f'cleave_server_stage_seconds_count{{stage="{stage}"}} '
+    for line in r.text.splitlines():
+        if line.startswith(prefix):
+            return int(line[len(prefix):])
+    return 0
+
+
 def test_simple_request(cleave_server_setup):
     """
     Make a trivial request for a cleave.
     """
     dvid_server, dvid_port, dvid_repo, port = cleave_server_setup
+    fetch_mutid_count = _stage_count(port, 'fetch_mutation_id')
     
     data = { "user": "bergs",
              "body-id": 1,
@@ -102,8 +236,74 @@ def test_simple_request(cleave_server_setup):
     assignments = r.json()["assignments"]
     assert assignments["1"] == [1,2,3]
     assert assignments["2"] == [4,5]
+
+    assert _stage_count(port, 'fetch_mutation_id') == fetch_mutid_count + 1
             
 
+@show_request_exceptions
+def test_binary_response(cleave_server_setup):
+    """
+    Request a cleave in the binary response format.
+    """
+    dvid_server, dvid_port, dvid_repo, port = cleave_server_setup
+    
+    data = { "user": "bergs",
+             "body-id": 1,
+             "port": dvid_port,
+             "seeds": {"1": [1], "2": [5]},
+             "server": dvid_server,
+             "uuid": dvid_repo,
+             "segmentation-instance": "segmentation",
+             "mesh-instance": "segmentation_meshes_tars" }
+
+    r = requests.post(f'http://127.0.0.1:{port}/compute-cleave', json=data,
+                      headers={'Accept': 'application/octet-stream'})
+    r.raise_for_status()
+    assert r.headers['Content-Type'] == 'application/octet-stream'
+
+    response = decode_binary_response(r.content)
+    assert response["body-id"] == 1
+    assert response["assignments"]["1"].tolist() == [1,2,3]
+    assert response["assignments"]["2"].tolist() == [4,5]
+
+
+@show_request_exceptions
+def test_batch_request(cleave_server_setup):
+    """
+    Request several cleaves at once via /compute-cleaves.
+    """
+    dvid_server, dvid_port, dvid_repo, port = cleave_server_setup
+
+    batch = []
+    for seeds in [{"1": [1], "2": [5]}, {"1": [1, 2, 3, 4], "2": [5]}, {"1": [1], "2": [999]}]:
+        batch.append({ "user": "bergs",
+                       "body-id": 1,
+                       "port": dvid_port,
+                       "seeds": seeds,
+                       "server": dvid_server,
+                       "uuid": dvid_repo,
+                       "segmentation-instance": "segmentation" })
+
+    r = requests.post(f'http://127.0.0.1:{port}/compute-cleaves', json=batch)
+    r.raise_for_status()
+
+    results = [ujson.loads(line) for line in r.content.decode().splitlines()]
+    results = sorted(results, key=lambda result: result["batch-index"])
+    assert [result["batch-index"] for result in results] == [0, 1, 2]
+
+    assert results[0]["status-code"] == 200
+    assert results[0]["assignments"]["1"] == [1,2,3]
+    assert results[0]["assignments"]["2"] == [4,5]
+
+    assert results[1]["status-code"] == 200
+    assert results[1]["assignments"]["1"] == [1,2,3,4]
+    assert results[1]["assignments"]["2"] == [5]
+
+    # Seed doesn't belong to the body
+    assert results[2]["status-code"] == 412
+    assert results[2]["errors"]
+
+
 @show_request_exceptions
 def test_fetch_log(cleave_server_setup):
     """
@@ -10,7 +10,7 @@ from neuclease.util import (uuids_match, read_csv_header, read_csv_col, connecte
                             connected_components_nonconsecutive, graph_tool_available,
                             closest_approach, approximate_closest_approach, upsample, is_lexsorted, lexsort_columns,
                             lexsort_inplace, gen_json_objects, ndrange, ndrange_array, compute_parallel, iter_batches,
-                            is_box_coverage_complete)
+                            is_box_coverage_complete, SortedRowIndex, ArrayOverlay, SingleFlight)
 
 def test_uuids_match():
     assert uuids_match('abcd', 'abcdef') == True
@@ -418,6 +418,120 @@ def test_is_box_coverage_complete():
              [[50, 50, 100], [75, 150, 300]]]
     assert not is_box_coverage_complete(boxes, full_box)
 
+
+def test_sorted_row_index():
+    def check(index, keys):
+        for key in np.unique(keys):
+            assert (index.rows(key) == (keys == key).nonzero()[0]).all()
+            assert index.count(key) == (keys == key).sum()
+        assert (index.keys == np.unique(keys)).all()
+        assert len(index.rows(1000)) == 0
+
+        query = [3, 5, 7, 1000]
+        assert (index.rows_for_keys(query) == np.isin(keys, query).nonzero()[0]).all()
+        assert (index.counts(query) == [(keys == k).sum() for k in query]).all()
+
+        # Compacting the index doesn't change its contents.
+        compacted = index.compacted()
+        assert compacted.delta_size == 0
+        assert (compacted.rows_for_keys(np.unique(keys)) == np.arange(len(keys))).all()
+        assert (compacted.keys == index.keys).all()
+
+    np.random.seed(0)
+    keys = np.random.randint(0, 20, 1000).astype(np.uint64)
+    index = SortedRowIndex(keys)
+    check(index, keys)
+
+    # Updates are recorded in the delta; the base arrays are never modified.
+    base_order = index.order
+    base_order.flags.writeable = False
+
+    new_keys = np.random.randint(15, 30, 100).astype(np.uint64)
+    index.append(new_keys)
+    keys = np.concatenate((keys, new_keys))
+    check(index, keys)
+
+    # Several rounds, so some rows move back to their original keys.
+    for _ in range(5):
+        rows = np.random.choice(len(keys), 200, replace=False)
+        new_keys = np.random.randint(0, 40, 200).astype(np.uint64)
+        index.update(rows, keys[rows], new_keys)
+        keys[rows] = new_keys
+        check(index, keys)
+
+    assert index.order is base_order
+    assert index.delta_size > 0
+
+    rows = np.random.choice(len(keys), 300, replace=False)
+    index.delete_rows(rows, keys[rows])
+    keys = np.delete(keys, rows)
+    check(index, keys)
+    assert len(index) == len(keys)
+
+    with pytest.raises(AssertionError):
+        index.remove([0], [keys[0] + 1])
+
+
+def test_array_overlay():
+    base = np.arange(100, dtype=np.uint64)
+    base.flags.writeable = False
+
+    overlay = ArrayOverlay(np.uint64)
+    assert (overlay.apply([1, 2], base[[1, 2]]) == [1, 2]).all()
+
+    overlay.set([50, 10, 30], 7)
+    overlay.set([30, 20], [8, 9])
+    assert len(overlay) == 4
+    assert (overlay.positions == [10, 20, 30, 50]).all()
+
+    positions = [5, 10, 20, 30, 50, 99]
+    assert (overlay.apply(positions, base[positions]) == [5, 7, 9, 8, 7, 99]).all()
+
+    expected = base.copy()
+    expected[[10, 20, 30, 50]] = [7, 9, 8, 7]
+    assert (overlay.materialize(base) == expected).all()
+    assert (base == np.arange(100)).all()
+
+
+def test_single_flight():
+    import time
+    import threading
+
+    single_flight = SingleFlight()
+    calls = []
+    def slow_call(x):
+        calls.append(x)
+        time.sleep(0.2)
+        return [x]
+
+    results = []
+    def run():
+        results.append(single_flight.run('key', slow_call, 1))
+
+    threads = [threading.Thread(target=run) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Only one call was made, and everyone got the same result object.
+    assert calls == [1]
+    assert sorted(joined for (_, joined) in results) == [False, True, True, True, True]
+    assert all(result is results[0][0] for (result, _) in results)
+    assert len(single_flight) == 0
+
+    # Once the call has finished, the next call runs again.
+    assert single_flight.run('key', slow_call, 2) == ([2], False)
+
+    # Exceptions are raised in every caller.
+    def fail():
+        raise RuntimeError("fail")
+
+    with pytest.raises(RuntimeError):
+        single_flight.run('key', fail)
+    assert len(single_flight) == 0
+
+
 if __name__ == "__main__":
     args = ['-s', '--tb=native', '--pyargs', 'neuclease.tests.test_util']
     args += ['-x']
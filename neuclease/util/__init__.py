@@ -6,6 +6,8 @@ from .box import *
 from .grid import *
 from .sparse_block_mask import *
 from .graph import *
+from .row_index import *
+from .single_flight import *
 from .downsample_with_numba import *
 from .skeleton import *
 from .segmentation import *
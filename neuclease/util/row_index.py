@@ -0,0 +1,478 @@
+"""
+A CSR-style index from integer keys to the rows of a table which contain them,
+and a sparse overlay of changes to a read-only array.
+"""
+import numpy as np
+from numba import jit
+
+
+class SortedRowIndex:
+    """
+    Index the rows of a table by a column of integer keys,
+    so that the rows for any key can be found without scanning the whole column.
+
+    Internally, the index consists of an immutable "CSR" structure (the base):
+
+        - ``order``: A permutation of the table's row positions, sorted by key.
+                     Within each key's group, the rows are kept in ascending order.
+        - ``offsets``: The start of each key's group within ``order``
+                       (plus a final entry for the end of the last group).
+        - The sorted unique keys of the base (see ``keys``).
+
+    ...plus a small "delta" of (key, row) pairs which have been added to
+    (or removed from) the index since the base was built, sorted by (key, row).
+
+    Lookups take O(log(K) + log(D) + R) time for K unique keys, D delta entries and R matching rows.
+    The index can be updated (when rows are appended or removed, or their keys change)
+    in O(D + U*log(N)) time for U updated rows, without modifying (or copying) the base,
+    so the base arrays may be memory-mapped read-only (and shared between processes).
+    Use compacted() to fold the delta into a new base, in O(N) time.
+
+    Example:
+
+        >>> index = SortedRowIndex(merge_table_df['body'].values)
+        >>> body_rows_df = merge_table_df.iloc[index.rows(body_id)]
+    """
+
+    def __init__(self, keys):
+        keys = np.asarray(keys)
+        assert keys.ndim == 1
+        assert np.issubdtype(keys.dtype, np.integer)
+
+        order = np.argsort(keys, kind='stable').astype(np.int64, copy=False)
+        self._init_base(order, keys[order], len(keys))
+
+
+    @classmethod
+    def from_arrays(cls, order, keys, offsets, num_rows=None):
+        """
+        Construct an index (with an empty delta) from the base arrays of
+        another (compacted) index, e.g. after saving them to disk.
+        The arrays are not copied, so they may be read-only memory-mapped arrays.
+        """
+        index = cls.__new__(cls)
+        index.order = order
+        index._keys = keys
+        index.offsets = offsets
+        index.num_rows = len(order) if num_rows is None else num_rows
+        index._clear_delta()
+        return index
+
+
+    def _init_base(self, order, sorted_keys, num_rows):
+        """
+        Initialize the base from the given row order and the key for each of those rows.
+        """
+        group_starts = 1 + np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1])
+        if len(sorted_keys) > 0:
+            group_starts = np.concatenate(([0], group_starts))
+
+        self.order = order
+        self._keys = sorted_keys[group_starts]
+        self.offsets = np.append(group_starts, len(sorted_keys)).astype(np.int64)
+        self.num_rows = num_rows
+        self._clear_delta()
+
+
+    def _clear_delta(self):
+        self._added_keys = np.zeros(0, self._keys.dtype)
+        self._added_rows = np.zeros(0, np.int64)
+        self._removed_keys = np.zeros(0, self._keys.dtype)
+        self._removed_rows = np.zeros(0, np.int64)
+
+
+    def __len__(self):
+        return self.num_rows
+
+
+    @property
+    def delta_size(self):
+        """
+        The number of (key, row) pairs which have been added
+        to (or removed from) the index since its base was built.
+        """
+        return len(self._added_keys) + len(self._removed_keys)
+
+
+    @property
+    def keys(self):
+        """
+        The sorted unique keys which have at least one row.
+        """
+        if self.delta_size == 0:
+            return self._keys
+        counts = np.diff(self.offsets) - _delta_counts(self._removed_keys, self._keys)
+        return np.union1d(self._keys[counts > 0], self._added_keys)
+
+
+    def count(self, key):
+        """
+        Return the number of rows with the given key.
+        """
+        return int(self.counts([key])[0])
+
+
+    def counts(self, keys):
+        """
+        Return the number of rows with each of the given keys.
+        """
+        keys = np.asarray(keys, self._keys.dtype)
+        groups = np.searchsorted(self._keys, keys)
+        valid = (groups < len(self._keys))
+        valid[valid] = (self._keys[groups[valid]] == keys[valid])
+
+        counts = np.zeros(len(keys), np.int64)
+        counts[valid] = self.offsets[groups[valid]+1] - self.offsets[groups[valid]]
+        counts += _delta_counts(self._added_keys, keys)
+        counts -= _delta_counts(self._removed_keys, keys)
+        return counts
+
+
+    def rows(self, key):
+        """
+        Return the (ascending) positions of the rows with the given key.
+        """
+        g = self._group(key)
+        if g is None:
+            rows = np.zeros(0, np.int64)
+        else:
+            rows = self.order[self.offsets[g]:self.offsets[g+1]]
+
+        if self.delta_size == 0:
+            return rows
+
+        removed = _delta_rows(self._removed_keys, self._removed_rows, [key])
+        if len(removed) > 0:
+            rows = rows[~np.isin(rows, removed)]
+
+        added = _delta_rows(self._added_keys, self._added_rows, [key])
+        if len(added) > 0:
+            rows = np.sort(np.concatenate((rows, added)))
+        return rows
+
+
+    def rows_for_keys(self, keys):
+        """
+        Return the (ascending) positions of all rows whose key is any of the given keys.
+        Keys which do not appear in the index are ignored.
+        """
+        keys = _unique_sorted(np.asarray(keys, self._keys.dtype))
+        if len(keys) == 0:
+            return np.zeros(0, np.int64)
+
+        rows = np.zeros(0, np.int64)
+        if len(self._keys) > 0:
+            groups = np.searchsorted(self._keys, keys)
+            valid = (groups < len(self._keys))
+            valid[valid] = (self._keys[groups[valid]] == keys[valid])
+            groups = groups[valid]
+
+            starts = self.offsets[groups]
+            lengths = self.offsets[groups+1] - starts
+            rows = self.order[_concat_ranges(starts, lengths)]
+
+        if self.delta_size > 0:
+            removed = _delta_rows(self._removed_keys, self._removed_rows, keys)
+            if len(removed) > 0:
+                rows = rows[~np.isin(rows, removed)]
+
+            added = _delta_rows(self._added_keys, self._added_rows, keys)
+            if len(added) > 0:
+                rows = np.concatenate((rows, added))
+
+        return np.sort(rows)
+
+
+    def insert(self, rows, keys):
+        """
+        Add the given rows (which must not already be present in the index).
+        """
+        keys, rows = _sorted_pairs(np.asarray(keys, self._keys.dtype), np.asarray(rows, np.int64))
+        if len(rows) == 0:
+            return
+
+        # Rows which are returning to the key they have in the base
+        # are simply dropped from the list of removed rows.
+        positions, found = _find_pairs(self._removed_keys, self._removed_rows, keys, rows)
+        self._removed_keys = np.delete(self._removed_keys, positions[found])
+        self._removed_rows = np.delete(self._removed_rows, positions[found])
+
+        keys, rows = keys[~found], rows[~found]
+        positions, _ = _find_pairs(self._added_keys, self._added_rows, keys, rows)
+        self._added_keys = np.insert(self._added_keys, positions, keys)
+        self._added_rows = np.insert(self._added_rows, positions, rows)
+
+        self.num_rows = max(self.num_rows, int(rows.max(initial=-1)) + 1)
+
+
+    def append(self, keys):
+        """
+        Append new rows to the end of the indexed table, with the given keys.
+        """
+        keys = np.asarray(keys, self._keys.dtype)
+        self.insert(np.arange(self.num_rows, self.num_rows + len(keys)), keys)
+
+
+    def remove(self, rows, keys):
+        """
+        Remove the given rows from the index, without renumbering the other rows.
+        The caller must supply the keys under which the rows are currently indexed.
+        """
+        keys, rows = _sorted_pairs(np.asarray(keys, self._keys.dtype), np.asarray(rows, np.int64))
+        if len(rows) == 0:
+            return
+
+        # Rows which were added since the base was built are simply dropped from the list of added rows.
+        positions, found = _find_pairs(self._added_keys, self._added_rows, keys, rows)
+        self._added_keys = np.delete(self._added_keys, positions[found])
+        self._added_rows = np.delete(self._added_rows, positions[found])
+
+        # The others must be in the base.
+        keys, rows = keys[~found], rows[~found]
+        groups = np.searchsorted(self._keys, keys)
+        assert (groups < len(self._keys)).all() and (self._keys[groups] == keys).all(), \
+            "Can't remove rows for keys which are not in the index."
+
+        base_positions = _group_positions(self.order, self.offsets, groups, rows)
+        positions, already_removed = _find_pairs(self._removed_keys, self._removed_rows, keys, rows)
+        assert (base_positions < self.offsets[groups+1]).all() and (self.order[base_positions] == rows).all() \
+            and not already_removed.any(), \
+            "Can't remove rows which are not indexed under the given keys."
+
+        self._removed_keys = np.insert(self._removed_keys, positions, keys)
+        self._removed_rows = np.insert(self._removed_rows, positions, rows)
+
+
+    def update(self, rows, old_keys, new_keys):
+        """
+        Change the keys for the given rows.
+        (Either set of keys may be given as a scalar, to apply to all rows.)
+        """
+        rows = np.asarray(rows, np.int64)
+        old_keys = np.broadcast_to(np.asarray(old_keys, self._keys.dtype), rows.shape)
+        new_keys = np.broadcast_to(np.asarray(new_keys, self._keys.dtype), rows.shape)
+
+        changed = (old_keys != new_keys)
+        self.remove(rows[changed], old_keys[changed])
+        self.insert(rows[changed], new_keys[changed])
+
+
+    def delete_rows(self, rows, keys):
+        """
+        Delete the given rows from the index, and renumber the remaining rows
+        to match a table from which those rows have been dropped.
+        The caller must supply the keys under which the rows are currently indexed.
+
+        Since every row must be renumbered, this takes O(N) time (and compacts the index).
+        """
+        rows = np.asarray(rows, np.int64)
+        keys = np.asarray(keys, self._keys.dtype)
+        self.remove(rows, keys)
+
+        compacted = self.compacted()
+        rows = np.sort(rows)
+        order = compacted.order - np.searchsorted(rows, compacted.order)
+        self._init_base(order, np.repeat(compacted._keys, np.diff(compacted.offsets)), self.num_rows - len(rows))
+
+
+    def compacted(self):
+        """
+        Return an equivalent index whose base includes all of this index's delta.
+        Takes O(N) time.  This index is not modified.
+        """
+        if self.delta_size == 0:
+            return SortedRowIndex.from_arrays(self.order, self._keys, self.offsets, self.num_rows)
+
+        order = self.order
+        sorted_keys = np.repeat(self._keys, np.diff(self.offsets))
+
+        if len(self._removed_keys) > 0:
+            groups = np.searchsorted(self._keys, self._removed_keys)
+            positions = _group_positions(self.order, self.offsets, groups, self._removed_rows)
+            order = np.delete(order, positions)
+            sorted_keys = np.delete(sorted_keys, positions)
+
+        if len(self._added_keys) > 0:
+            positions, _ = _find_pairs(sorted_keys, order, self._added_keys, self._added_rows)
+            order = np.insert(order, positions, self._added_rows)
+            sorted_keys = np.insert(sorted_keys, positions, self._added_keys)
+
+        index = SortedRowIndex.__new__(SortedRowIndex)
+        index._init_base(order, sorted_keys, self.num_rows)
+        return index
+
+
+    def _group(self, key):
+        g = np.searchsorted(self._keys, self._keys.dtype.type(key))
+        if g == len(self._keys) or self._keys[g] != key:
+            return None
+        return g
+
+
+class ArrayOverlay:
+    """
+    Sparse changes to a (large) array which must not be modified itself,
+    e.g. because it is memory-mapped read-only and shared between processes.
+
+    The changed positions are kept sorted, along with their new values.
+    Updates take O(D + U*log(D)) time and lookups take O(Q*log(D)) time,
+    for D changed positions, U updated positions, and Q queried positions.
+
+    Example:
+
+        >>> overlay = ArrayOverlay(np.uint64)
+        >>> overlay.set([10, 20], 5)
+        >>> overlay.apply([10, 11], base_array[[10, 11]])
+    """
+
+    def __init__(self, dtype):
+        self.positions = np.zeros(0, np.int64)
+        self.values = np.zeros(0, dtype)
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    def set(self, positions, values):
+        """
+        Record new values for the given (unique) positions.
+        (The values may be given as a scalar, to apply to all positions.)
+        """
+        positions = np.asarray(positions, np.int64)
+        values = np.broadcast_to(np.asarray(values, self.values.dtype), positions.shape)
+
+        i = np.searchsorted(self.positions, positions)
+        found = (i < len(self.positions))
+        found[found] = (self.positions[i[found]] == positions[found])
+        self.values[i[found]] = values[found]
+
+        new_order = np.argsort(positions[~found], kind='stable')
+        self.positions = np.insert(self.positions, i[~found][new_order], positions[~found][new_order])
+        self.values = np.insert(self.values, i[~found][new_order], values[~found][new_order])
+
+
+    def apply(self, positions, values):
+        """
+        Given the values of the underlying array at the given positions,
+        return them with the overlay's changes applied.
+        """
+        if len(self.positions) == 0:
+            return values
+
+        positions = np.asarray(positions, np.int64)
+        i = np.searchsorted(self.positions, positions)
+        found = (i < len(self.positions))
+        found[found] = (self.positions[i[found]] == positions[found])
+
+        values = np.array(values, self.values.dtype)
+        values[found] = self.values[i[found]]
+        return values
+
+
+    def materialize(self, array):
+        """
+        Return a copy of the given (underlying) array, with the overlay's changes applied.
+        """
+        array = np.array(array)
+        array[self.positions] = self.values
+        return array
+
+
+def _unique_sorted(a):
+    """
+    Return the sorted unique values of the given 1D array.
+    (Faster than np.unique() if the array is already sorted.)
+    """
+    if len(a) == 0:
+        return a
+    if (a[1:] >= a[:-1]).all():
+        return a[np.append([True], a[1:] != a[:-1])]
+    return np.unique(a)
+
+
+def _concat_ranges(starts, lengths):
+    """
+    Concatenate the ranges [start, start+length) without a Python loop:
+    each element's position is its range start plus its position within the range.
+    """
+    range_ends = np.cumsum(lengths)
+    total = range_ends[-1] if len(range_ends) else 0
+    return np.repeat(starts - (range_ends - lengths), lengths) + np.arange(total)
+
+
+def _delta_counts(delta_keys, keys):
+    """
+    Count the entries of the (sorted) delta_keys which match each of the given keys.
+    """
+    return (np.searchsorted(delta_keys, keys, 'right') - np.searchsorted(delta_keys, keys, 'left'))
+
+
+def _delta_rows(delta_keys, delta_rows, keys):
+    """
+    Return the delta_rows whose delta_keys match any of the given (unique) keys.
+    """
+    keys = np.asarray(keys, delta_keys.dtype)
+    starts = np.searchsorted(delta_keys, keys, 'left')
+    lengths = np.searchsorted(delta_keys, keys, 'right') - starts
+    return delta_rows[_concat_ranges(starts, lengths)]
+
+
+def _sorted_pairs(keys, rows):
+    """
+    Sort the given (key, row) pairs by key, then row.
+    """
+    assert keys.shape == rows.shape
+    order = np.lexsort((rows, keys))
+    return keys[order], rows[order]
+
+
+def _find_pairs(keys, rows, query_keys, query_rows):
+    """
+    Locate the given (key, row) pairs within the given arrays of (key, row)
+    pairs (sorted by key, then row).
+
+    Returns:
+        (positions, found), where positions are the insertion points
+        for the query pairs, and found indicates which of them are present.
+    """
+    positions = _pair_positions(keys, rows, query_keys, query_rows)
+    found = (positions < len(keys))
+    found[found] = (keys[positions[found]] == query_keys[found]) & (rows[positions[found]] == query_rows[found])
+    return positions, found
+
+
+@jit(nopython=True, nogil=True)
+def _pair_positions(keys, rows, query_keys, query_rows):
+    """
+    Binary search for each query (key, row) pair within the given
+    arrays of (key, row) pairs (sorted by key, then row).
+    """
+    positions = np.empty(len(query_keys), np.int64)
+    for i in range(len(query_keys)):
+        key = query_keys[i]
+        row = query_rows[i]
+        lo = 0
+        hi = len(keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys[mid] < key or (keys[mid] == key and rows[mid] < row):
+                lo = mid + 1
+            else:
+                hi = mid
+        positions[i] = lo
+    return positions
+
+
+@jit(nopython=True, nogil=True)
+def _group_positions(order, offsets, groups, rows):
+    """
+    For each (group, row) pair, find the position within ``order``
+    at which the row is (or would be) located within its group.
+    """
+    positions = np.empty(len(rows), np.int64)
+    for i in range(len(rows)):
+        start = offsets[groups[i]]
+        stop = offsets[groups[i]+1]
+        positions[i] = start + np.searchsorted(order[start:stop], rows[i])
+    return positions
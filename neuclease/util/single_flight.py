@@ -0,0 +1,71 @@
+"""
+Collapse concurrent duplicate calls into a single call.
+"""
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Ensures that at most one call for a given key is in progress at a time.
+    If another thread calls run() with the same key while the first call
+    is still in progress, it doesn't call the function again.
+    Instead, it waits for the first call to finish, and shares its result
+    (or its exception).
+
+    Once the call finishes, the key is forgotten, i.e. this is not a cache.
+
+    Example:
+
+        >>> single_flight = SingleFlight()
+        >>> result, joined = single_flight.run(('fetch', url), requests.get, url)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {} # key -> Future
+
+        self.calls = 0
+        self.joins = 0
+
+
+    def __len__(self):
+        """
+        The number of calls in progress.
+        """
+        return len(self._calls)
+
+
+    def run(self, key, func, *args, **kwargs):
+        """
+        Call ``func(*args, **kwargs)``, unless a call with the same key
+        is already in progress, in which case its result is returned instead.
+
+        Returns:
+            (result, joined), where joined is True if the result came from
+            another thread's call.  Note that the result object is shared with
+            the other callers, so it should not be modified.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            joined = (future is not None)
+            if joined:
+                self.joins += 1
+            else:
+                future = self._calls[key] = Future()
+                self.calls += 1
+
+        if joined:
+            return future.result(), True
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]